@@ -0,0 +1,229 @@
+"""
+In-process benchmark of the bot handlers.
+Synthetic updates go through the real dispatcher and handlers to a bot backed by the fake Bot API,
+throughput, latency and SQL queries per update are measured for growing catalogs and carts
+and compared with the stored baseline.
+"""
+
+import itertools
+import json
+import os
+import statistics
+import time
+from queue import Queue
+from typing import Callable, Dict, Iterable, List, NamedTuple
+from django.db import connection
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+from upsale.apps.core import models
+from upsale.apps.core.catalog import catalog
+from upsale.apps.core.session import sessions
+from upsale.apps.bot.client import outbound
+from upsale.apps.bot.client.callback import encode
+from upsale.apps.bot.client.constant import GO_BUTTON, CART_BUTTON, CONFIRM_BUTTON, PLUS_ONE
+from upsale.apps.bot.client.fakeapi import FakeBotApi, FakeRequest, FakeTransport, \
+    message_update, callback_update
+from upsale.apps.bot.client.metrics import UpdateStats
+from upsale.apps.bot.client.routing import register_handlers
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'benchmark.json')
+CATALOG_SIZES = (10, 100, 1000, 10000)
+CART_SIZES = (1, 10, 100, 1000)
+CART_CATALOG = 50
+USER_ID = 42
+TOKEN = '123456:benchmark'
+UNLIMITED = 1e9
+
+
+class Result(NamedTuple):
+    """Measurements of one scenario"""
+    scenario: str
+    size: int
+    latencies: List[float]
+    queries: List[int]
+    seconds: float
+
+    @property
+    def throughput(self) -> float:
+        """Updates served per second including their Bot API calls"""
+        return len(self.latencies) / self.seconds
+
+    @property
+    def p50(self) -> float:
+        return statistics.median(self.latencies)
+
+    @property
+    def p95(self) -> float:
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    @property
+    def max_queries(self) -> int:
+        return max(self.queries)
+
+
+class Benchmark:
+    """Runs scenarios against the current database.
+    Use as a context manager: the outbound queue of the process is replaced with
+    an unlimited one that sends to the fake Bot API while the benchmark runs."""
+
+    def __init__(self, runs: int = 20, latency: float = 0):
+        self.runs = runs
+        self.latency = latency
+        self.api = FakeBotApi()
+        self.bot = Bot(TOKEN, request=FakeRequest(self.api))
+        self.dispatcher = Dispatcher(self.bot, Queue(), workers=0, use_context=True)
+        register_handlers(self.dispatcher)
+        self._update_ids = itertools.count(1)
+        self._queue = None
+
+    def __enter__(self):
+        sessions.clear()
+        self._queue = outbound.queue
+        outbound.queue = outbound.OutboundQueue(
+            FakeTransport(self.api, self.latency), UNLIMITED, UNLIMITED, UNLIMITED, workers=4)
+        return self
+
+    def __exit__(self, *args):
+        outbound.queue.drain()
+        outbound.queue = self._queue
+
+    def run(self, catalog_sizes: Iterable[int] = CATALOG_SIZES,
+            cart_sizes: Iterable[int] = CART_SIZES) -> List[Result]:
+        """Runs all scenarios for every size"""
+        results = [self.products(size) for size in catalog_sizes]
+        fill_catalog(CART_CATALOG)
+        for units in cart_sizes:
+            results += [self.show_cart(units), self.increase_count(units), self.confirm_order(units)]
+        return results
+
+    def products(self, size: int) -> Result:
+        """User opens catalog of size products"""
+        fill_catalog(size)
+        return self.measure('products', size, lambda update_id: message_update(
+            update_id, USER_ID, GO_BUTTON))
+
+    def show_cart(self, units: int) -> Result:
+        """User opens cart with given number of packs"""
+        fill_cart(units)
+        return self.measure('show_cart', units, lambda update_id: message_update(
+            update_id, USER_ID, CART_BUTTON))
+
+    def increase_count(self, units: int) -> Result:
+        """User presses +1 in the cart with given number of packs"""
+        data = encode(PLUS_ONE, fill_cart(units)[0].sku_id)
+        return self.measure('increase_count', units, lambda update_id: callback_update(
+            update_id, USER_ID, data))
+
+    def confirm_order(self, units: int) -> Result:
+        """User confirms order of the cart with given number of packs"""
+        return self.measure('confirm_order', units, lambda update_id: message_update(
+            update_id, USER_ID, CONFIRM_BUTTON), prepare=lambda: fill_cart(units))
+
+    def measure(self, scenario: str, size: int, build: Callable[[int], dict],
+                prepare: Callable = None) -> Result:
+        """Processes runs updates one by one waiting for their Bot API calls.
+        Preparation before every update is not measured"""
+        latencies, queries, seconds = [], [], 0
+        for _ in range(self.runs):
+            if prepare:
+                prepare()
+            update = Update.de_json(build(next(self._update_ids)), self.bot)
+            stats = UpdateStats()
+            started = time.perf_counter()
+            with connection.execute_wrapper(stats):
+                self.dispatcher.process_update(update)
+            latencies.append(time.perf_counter() - started)
+            outbound.queue.drain()
+            seconds += time.perf_counter() - started
+            queries.append(stats.queries)
+        return Result(scenario, size, latencies, queries, seconds)
+
+
+def buyer() -> models.Buyer:
+    """Returns buyer of the benchmark with a cart"""
+    (user, _) = models.Buyer.objects.get_or_create(id=USER_ID, defaults={
+        'first_name': 'Bench', 'last_name': 'Mark', 'full_name': 'Bench Mark', 'name': 'bench',
+        'language_code': 'uk', 'phone_number': '380000000000'})
+    models.Cart.objects.get_or_create(buyer=user)
+    return user
+
+
+def fill_catalog(size: int):
+    """Replaces catalog with size products of two packs each"""
+    models.Product.objects.all().delete()
+    packs = [models.Pack.objects.get_or_create(unit='g', size=size)[0] for size in (250, 1000)]
+    models.Product.objects.bulk_create(
+        models.Product(name=f'Coffee {number}', description='Benchmark coffee',
+                       image=f'https://example.com/{number}.jpg')
+        for number in range(size))
+    models.StockKeepingUnit.objects.bulk_create(
+        models.StockKeepingUnit(product_id=product_id, pack=pack, price=100 * pack.size / 250)
+        for product_id in models.Product.objects.values_list('id', flat=True)
+        for pack in packs)
+    models.Product.objects.update_sku_summary()
+    catalog.invalidate()
+
+
+def fill_cart(units: int) -> List[models.CartItem]:
+    """Replaces content of the cart with units packs spread over as many skus as possible"""
+    cart = buyer().cart
+    cart.cartitem_set.all().delete()
+    skus = list(models.StockKeepingUnit.objects.order_by('id')[:units])
+    quantity, rest = divmod(units, len(skus))
+    items = models.CartItem.objects.bulk_create(
+        models.CartItem(cart=cart, sku=sku, quantity=quantity + (number < rest))
+        for number, sku in enumerate(skus))
+    cart.bump_version()
+    sessions.drop(USER_ID)
+    return items
+
+
+def report(results: Iterable[Result]) -> Iterable[str]:
+    """Formats results as a table"""
+    yield f'{"scenario":<16}{"size":>7}{"updates/s":>12}{"p50 ms":>10}{"p95 ms":>10}{"queries":>9}'
+    for result in results:
+        yield (f'{result.scenario:<16}{result.size:>7}{result.throughput:>12.1f}'
+               f'{result.p50 * 1000:>10.2f}{result.p95 * 1000:>10.2f}{result.max_queries:>9}')
+
+
+def compare(results: Iterable[Result], baseline: Dict[str, dict], tolerance: float = None) -> List[str]:
+    """Returns descriptions of results that are worse than the baseline.
+    Queries per update must not grow, p95 latency is checked only if tolerance is given"""
+    regressions = []
+    for result in results:
+        expected = baseline.get(result.scenario, {}).get(str(result.size))
+        if not expected:
+            continue
+        name = f'{result.scenario}[{result.size}]'
+        if result.max_queries > expected['queries']:
+            regressions.append(
+                f'{name}: {result.max_queries} queries per update, baseline is {expected["queries"]}')
+        if tolerance and result.p95 * 1000 > expected['p95_ms'] * tolerance:
+            regressions.append(
+                f'{name}: p95 is {result.p95 * 1000:.2f}ms, baseline is {expected["p95_ms"]}ms')
+    return regressions
+
+
+def to_baseline(results: Iterable[Result]) -> Dict[str, dict]:
+    """Builds baseline from results"""
+    baseline = {}
+    for result in results:
+        baseline.setdefault(result.scenario, {})[str(result.size)] = {
+            'queries': result.max_queries, 'p95_ms': round(result.p95 * 1000, 2)}
+    return baseline
+
+
+def load_baseline(path: str = BASELINE) -> Dict[str, dict]:
+    """Reads baseline, returns empty one if the file is missing"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_baseline(baseline: Dict[str, dict], path: str = BASELINE):
+    """Writes baseline"""
+    with open(path, 'w') as file:
+        json.dump(baseline, file, indent=4, sort_keys=True)
+        file.write('\n')
@@ -0,0 +1,122 @@
+"""
+Compact callback data of inline buttons.
+Payload is a version byte, an action code and unsigned varint fields,
+optionally followed by a truncated HMAC, encoded with urlsafe base64 without padding.
+Payloads of the old str(dict) format are still decoded.
+"""
+
+import base64
+import hashlib
+import hmac
+from ast import literal_eval
+from functools import lru_cache
+from typing import NamedTuple, Tuple
+from upsale.settings import BOTS
+from upsale.apps.bot.client.constant import ID, ACTION, NOOP, SHOW_DESCRIPTION, SHOW_PRODUCT, \
+    SHOW_PRICES, ADD_TO_CART, PLUS_ONE, MINUS_ONE, REMOVE_ONE, CLEAN_CART
+
+VERSION = 1
+SIGNED = 0x80
+SIGNATURE_SIZE = 4
+MAX_SIZE = 64
+
+LEGACY_ACTIONS = {
+    'description': SHOW_DESCRIPTION,
+    'product': SHOW_PRODUCT,
+    'show_prices': SHOW_PRICES,
+    'add_to_cart': ADD_TO_CART,
+    'plus_one': PLUS_ONE,
+    'minus_one': MINUS_ONE,
+    'remove_one': REMOVE_ONE,
+}
+LEGACY_DATA = {'empty': NOOP, 'clean_cart': CLEAN_CART}
+
+
+class InvalidCallback(ValueError):
+    """Raised when callback data could not be decoded"""
+
+
+class Callback(NamedTuple):
+    """Decoded callback data"""
+    action: int
+    fields: Tuple[int, ...] = ()
+
+    @property
+    def id(self) -> int:
+        """Returns id of the object the button is about"""
+        return self.fields[0]
+
+
+def encode(action: int, *fields: int, secret: str = BOTS['client']['CALLBACK_SECRET']) -> str:
+    """Packs action and fields to callback data"""
+    header = VERSION | SIGNED if secret else VERSION
+    payload = bytes([header]) + _varints((action, *fields))
+    if secret:
+        payload += _sign(payload, secret)
+    data = base64.urlsafe_b64encode(payload).rstrip(b'=').decode()
+    if len(data) > MAX_SIZE:
+        raise ValueError(f'Callback data is longer than {MAX_SIZE} bytes')
+    return data
+
+
+@lru_cache(maxsize=4096)
+def decode(data: str, secret: str = BOTS['client']['CALLBACK_SECRET']) -> Callback:
+    """Unpacks callback data, raises InvalidCallback if it's malformed or forged"""
+    if data in LEGACY_DATA:
+        return Callback(LEGACY_DATA[data])
+    if data.startswith('{'):
+        return _decode_legacy(data)
+    try:
+        payload = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+    except ValueError as error:
+        raise InvalidCallback(data) from error
+    if not payload or payload[0] & ~SIGNED != VERSION:
+        raise InvalidCallback(data)
+    if payload[0] & SIGNED:
+        payload, signature = payload[:-SIGNATURE_SIZE], payload[-SIGNATURE_SIZE:]
+        if not secret or not hmac.compare_digest(signature, _sign(payload, secret)):
+            raise InvalidCallback(data)
+    elif secret:
+        raise InvalidCallback(data)
+    values = _unvarints(payload[1:], data)
+    if not values:
+        raise InvalidCallback(data)
+    return Callback(values[0], values[1:])
+
+
+def _decode_legacy(data: str) -> Callback:
+    try:
+        literal = literal_eval(data)
+        return Callback(LEGACY_ACTIONS[literal[ACTION]], (int(literal[ID]),))
+    except (ValueError, SyntaxError, KeyError, TypeError) as error:
+        raise InvalidCallback(data) from error
+
+
+def _sign(payload: bytes, secret: str) -> bytes:
+    return hmac.new(secret.encode(), payload, hashlib.sha256).digest()[:SIGNATURE_SIZE]
+
+
+def _varints(values) -> bytes:
+    result = bytearray()
+    for value in values:
+        if value < 0:
+            raise ValueError('Callback fields must not be negative')
+        while value > 0x7f:
+            result.append(value & 0x7f | 0x80)
+            value >>= 7
+        result.append(value)
+    return bytes(result)
+
+
+def _unvarints(payload: bytes, data: str) -> Tuple[int, ...]:
+    values = []
+    value = shift = 0
+    for byte in payload:
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append(value)
+            value = shift = 0
+    if shift:
+        raise InvalidCallback(data)
+    return tuple(values)
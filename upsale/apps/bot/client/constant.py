@@ -10,3 +10,9 @@ CART_BUTTON = '🛒 Корзина'
 EMPTY_CART_BUTTON = '🧹 Очистить корзину'
 
 (ID, ACTION) = range(2)
+
+(NOOP, SHOW_DESCRIPTION, SHOW_PRODUCT, SHOW_PRICES, ADD_TO_CART,
+ PLUS_ONE, MINUS_ONE, REMOVE_ONE, CLEAN_CART) = range(9)
+
+ADDRESS_CONVERSATION = 'address'
+(CITY, BRANCH_NUMBER) = ('city', 'branch_number')
@@ -0,0 +1,241 @@
+"""
+Local stand-in for the Telegram Bot API.
+Answers bot requests with minimal valid results and records every call,
+so the bot and its handlers could be run end-to-end without network access.
+"""
+
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+from urllib.request import Request, urlopen
+from telegram import Message
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'upsale', 'username': 'upsale_bot'}
+
+
+class FakeBotApi:
+    """Keeps state of the fake Bot API and builds results for its methods"""
+
+    def __init__(self):
+        self.calls = []
+        self.updates = []
+        self.webhook = {}
+        self._changed = threading.Condition()
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._methods = {
+            'getMe': lambda params: BOT_USER,
+            'getMyCommands': lambda params: [],
+            'setWebhook': self._set_webhook,
+            'deleteWebhook': self._delete_webhook,
+            'getWebhookInfo': self._get_webhook_info,
+            'getUpdates': self._get_updates,
+            'sendMessage': self._send_message,
+            'sendPhoto': self._send_photo,
+            'editMessageText': self._edit_message,
+            'editMessageCaption': self._edit_message,
+            'editMessageReplyMarkup': self._edit_message,
+        }
+
+    def call(self, method: str, params: dict):
+        """Records the call and returns its result"""
+        with self._changed:
+            self.calls.append((method, params))
+            self._changed.notify_all()
+        handler = self._methods.get(method)
+        return handler(params) if handler else True
+
+    def calls_of(self, method: str) -> list:
+        """Returns parameters of all calls of the method"""
+        with self._changed:
+            return [params for name, params in self.calls if name == method]
+
+    def wait_for(self, method: str, count: int = 1, timeout: float = 5) -> list:
+        """Blocks until the method is called at least count times"""
+        with self._changed:
+            self._changed.wait_for(
+                lambda: sum(1 for name, _ in self.calls if name == method) >= count, timeout)
+        return self.calls_of(method)
+
+    def reset(self):
+        """Forgets all recorded calls"""
+        with self._changed:
+            self.calls.clear()
+
+    def _message(self, params: dict, **content) -> dict:
+        return {
+            'message_id': int(params.get('message_id') or next(self._message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+            'from': BOT_USER,
+            **content
+        }
+
+    def _send_message(self, params: dict) -> dict:
+        return self._message(params, text=params.get('text', ''))
+
+    def _send_photo(self, params: dict) -> dict:
+        file_id = params.get('photo')
+        if not str(file_id).startswith('photo-'):
+            file_id = f'photo-{next(self._file_ids)}'
+        photo = {'file_id': file_id, 'file_unique_id': file_id, 'width': 320, 'height': 320}
+        return self._message(params, photo=[photo], caption=params.get('caption'))
+
+    def _edit_message(self, params: dict):
+        if 'inline_message_id' in params:
+            return True
+        return self._message(params, text=params.get('text', ''), caption=params.get('caption'))
+
+    def _set_webhook(self, params: dict) -> bool:
+        self.webhook = dict(params)
+        return True
+
+    def _delete_webhook(self, _: dict) -> bool:
+        self.webhook = {}
+        return True
+
+    def _get_webhook_info(self, _: dict) -> dict:
+        return {'url': self.webhook.get('url', ''), 'has_custom_certificate': False,
+                'pending_update_count': len(self.updates)}
+
+    def _get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset') or 0)
+        with self._changed:
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            return list(self.updates)
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    """Serves /bot<token>/<method> requests of the Bot API"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self._respond(self._params(body))
+
+    def do_GET(self):
+        self._respond(dict(parse_qsl(self.path.partition('?')[2])))
+
+    def _params(self, body: bytes) -> dict:
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            return dict(parse_qsl(body.decode()))
+        return {}
+
+    def _respond(self, params: dict):
+        method = self.path.partition('?')[0].rsplit('/', 1)[-1]
+        result = self.server.api.call(method, params)
+        payload = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeBotApiServer(ThreadingHTTPServer):
+    """Http server of the fake Bot API. Use url as base_url of the bot"""
+    daemon_threads = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, api: FakeBotApi = None):
+        super().__init__((host, port), FakeBotApiHandler)
+        self.api = api or FakeBotApi()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        """Serves requests in a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving and closes the socket"""
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+class FakeTransport:
+    """Outbound transport that makes calls to the fake Bot API in-process.
+    Optional latency simulates network round trips for load tests."""
+
+    def __init__(self, api: FakeBotApi = None, latency: float = 0):
+        self.api = api or FakeBotApi()
+        self.latency = latency
+
+    def send(self, bot, method: str, params: dict):
+        if self.latency:
+            time.sleep(self.latency)
+        name = method.split('_')[0] + ''.join(part.title() for part in method.split('_')[1:])
+        params = {key: value.to_dict() if hasattr(value, 'to_dict') else value
+                  for key, value in params.items()}
+        result = self.api.call(name, params)
+        if isinstance(result, dict) and 'message_id' in result:
+            return Message.de_json(result, bot)
+        return result
+
+
+class FakeRequest:
+    """Replacement of telegram.utils.request.Request that calls the fake Bot API in-process.
+    Pass it as request of telegram.Bot to make a bot that never goes to network."""
+    con_pool_size = 1
+
+    def __init__(self, api: FakeBotApi = None):
+        self.api = api or FakeBotApi()
+
+    def post(self, url: str, data: dict, timeout: float = None):
+        data = {key: value.to_dict() if hasattr(value, 'to_dict') else value
+                for key, value in (data or {}).items()}
+        return self.api.call(url.rsplit('/', 1)[-1], data)
+
+    def stop(self):
+        pass
+
+
+def user(user_id: int) -> dict:
+    """Builds telegram user"""
+    return {'id': user_id, 'is_bot': False, 'first_name': 'User', 'last_name': str(user_id),
+            'username': f'user{user_id}', 'language_code': 'uk'}
+
+
+def message_update(update_id: int, user_id: int, text: str = None, contact: dict = None) -> dict:
+    """Builds update with a private message from the user"""
+    message = {'message_id': update_id, 'date': int(time.time()), 'from': user(user_id),
+               'chat': {'id': user_id, 'type': 'private'}}
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            message['entities'] = [
+                {'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    if contact is not None:
+        message['contact'] = contact
+    return {'update_id': update_id, 'message': message}
+
+
+def callback_update(update_id: int, user_id: int, data: str, message_id: int = 1) -> dict:
+    """Builds update with a press of inline button of the message"""
+    message = {'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER,
+               'chat': {'id': user_id, 'type': 'private'}, 'caption': ''}
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'from': user(user_id), 'message': message,
+        'chat_instance': str(user_id), 'data': data}}
+
+
+def post_update(url: str, update: dict, timeout: float = 5) -> int:
+    """Delivers update to the webhook the way Telegram does. Returns http status"""
+    request = Request(url, data=json.dumps(update).encode(),
+                      headers={'Content-Type': 'application/json'})
+    with urlopen(request, timeout=timeout) as response:
+        return response.status
@@ -4,164 +4,188 @@ Handlers for all commands for client part of a telegram bot
 
 from typing import List
 import itertools
-from django.db.models import Q
+from django.db import close_old_connections
 from telegram import Update
-from telegram.ext import CallbackContext
+from telegram.ext import CallbackContext, ConversationHandler
 from upsale.apps.core import models
+from upsale.apps.core.catalog import catalog
+from upsale.apps.core.session import sessions
 from . import templates as views
 from . import helpers
+from .outbound import BULK
+from .constant import CITY, BRANCH_NUMBER
+
+def refresh_connection(_: Update, __: CallbackContext) -> None:
+    """Closes connection of the thread if it's broken or older than CONN_MAX_AGE,
+    the way Django does between requests. Runs before handlers of every update"""
+    close_old_connections()
 
 def start_command(update: Update, context: CallbackContext) -> None:
     """Creates user in database and respond with welcome message"""
     user = update.effective_user
-    (buyer, _) = models.Buyer.objects.get_or_create(
-        id=user.id,
-        defaults={
-            'first_name': user.first_name,
-            'last_name': user.last_name,
-            'full_name':user.full_name,
-            'name':user.name,
-            'username':user.username,
-            'language_code':user.language_code,
-            'link':user.link,
-            'is_bot':user.is_bot
-            }
-    )
-    models.Cart.objects.get_or_create(
-        buyer=buyer
-    )
+    try:
+        buyer = sessions.get(user.id).buyer
+    except models.Cart.DoesNotExist:
+        (buyer, _) = models.Buyer.objects.get_or_create(
+            id=user.id,
+            defaults={
+                'first_name': user.first_name,
+                'last_name': user.last_name,
+                'full_name':user.full_name,
+                'name':user.name,
+                'username':user.username,
+                'language_code':user.language_code,
+                'link':user.link,
+                'is_bot':user.is_bot
+                }
+        )
+        models.Cart.objects.get_or_create(
+            buyer=buyer
+        )
+    # Buyer that blocked the bot and came back gets broadcasts again
+    models.Buyer.objects.filter(pk=user.id, blocked=True).update(blocked=False)
     if not buyer.phone_number:
         helpers.respond(context.bot, update.effective_chat.id, views.get_contact_view())
     else:
         helpers.respond(context.bot, update.effective_chat.id, views.welcome_message())
 
 def save_contact(update: Update, context: CallbackContext):
-    buyer = models.Buyer.objects.get(pk=update.effective_user.id)
+    buyer = sessions.get(update.effective_user.id).buyer
     buyer.phone_number = update.message.contact.phone_number
-    buyer.save()
+    buyer.save(update_fields=['phone_number'])
     helpers.respond(context.bot, update.effective_chat.id, views.welcome_message())
 
 def products(update: Update, context: CallbackContext) -> None:
     """Respond with a list of available products"""
-    helpers.respond(context.bot, update.effective_chat.id, views.select_product_message())
-    for product in models.Product.objects.all():
-        helpers.photo(context.bot, update.effective_chat.id, views.product_view(product))
+    chat_id = update.effective_chat.id
+    helpers.respond(context.bot, chat_id, views.select_product_message())
+    for product in catalog.products():
+        helpers.photo(context.bot, chat_id, views.product_view(product), product, priority=BULK)
+
+def show_info(update: Update, _: CallbackContext) -> None:
+    """Buttons that only show information, e.g. price or count, do nothing"""
 
-def expand_product(update: Update, _: CallbackContext) -> None:
+def expand_product(update: Update, context: CallbackContext) -> None:
     """Respond with product description"""
-    product = models.Product.objects.get(pk=helpers.data_id(update.callback_query.data))
+    product = catalog.product(context.callback.id)
     helpers.edit(update.callback_query, views.product_description_view(product))
 
-def collapse_product(update: Update, _: CallbackContext) -> None:
+def collapse_product(update: Update, context: CallbackContext) -> None:
     """Edit existing product message and hide description part"""
-    product = models.Product.objects.get(pk=helpers.data_id(update.callback_query.data))
+    product = catalog.product(context.callback.id)
     helpers.edit(update.callback_query, views.product_view(product))
 
-def prices(update: Update, _: CallbackContext) -> None:
+def prices(update: Update, context: CallbackContext) -> None:
     """Shows product packs / prices"""
-    product = models.Product.objects.get(pk=helpers.data_id(update.callback_query.data))
-    cart = models.Cart.objects.get(buyer=update.effective_user.id)
-    helpers.edit(update.callback_query, views.product_price_view(product, cart))
+    product = catalog.product(context.callback.id)
+    session = sessions.get(update.effective_user.id)
+    helpers.edit(update.callback_query, views.product_price_view(product, session))
 
-def add_sku_to_cart(update: Update, _: CallbackContext) -> None:
+def add_sku_to_cart(update: Update, context: CallbackContext) -> None:
     """Adds sku to cart"""
-    cart = models.Cart.objects.get(buyer=update.effective_user.id)
-    sku = models.StockKeepingUnit.objects.get(pk=helpers.data_id(update.callback_query.data))
-    if not cart.contains(sku):
-        cart.add_sku(sku)
-    helpers.edit(update.callback_query, views.product_price_view(sku.product, cart))
+    session = sessions.get(update.effective_user.id)
+    sku = catalog.sku(context.callback.id)
+    if not session.contains(sku):
+        session.add_sku(sku)
+    helpers.edit(update.callback_query, views.product_price_view(sku.product, session))
 
 def show_cart(update: Update, context: CallbackContext) -> None:
     """Respond with all items in the cart"""
-    cart = models.Cart.objects.get(buyer=update.effective_user.id)
-    if cart.is_empty():
+    session = sessions.get(update.effective_user.id)
+    if session.is_empty():
         helpers.respond(context.bot, update.effective_chat.id, views.cart_is_empty_message())
         return
 
     helpers.respond(context.bot, update.effective_chat.id, views.cart_message())
-    items = sorted(cart.items.all(), key=lambda x: x.product.id)
-    groups = itertools.groupby(items, lambda x: x.product)
-    for product, group in groups:
-        helpers.photo(context.bot, update.effective_chat.id, views.cart_item_view(product, group))
+    groups = itertools.groupby(session.lines(), lambda x: x.sku.product_id)
+    for product_id, lines in groups:
+        product = catalog.product(product_id)
+        helpers.photo(context.bot, update.effective_chat.id, views.cart_item_view(product, lines), product)
 
-    price = cart.get_total_price()
+    price = session.total_price()
     total_message = helpers.respond(context.bot, update.effective_chat.id, views.total_price_view(price))
-    cart.total_message_id = total_message.message_id
-    cart.save()
+    total_message.add_done_callback(lambda future: helpers.remember_total_message(session, future))
 
 def increase_count(update: Update, context: CallbackContext):
     """Add one more pack to the cart"""
-    cart = models.Cart.objects.get(buyer=update.effective_user.id)
-    sku = models.StockKeepingUnit.objects.get(pk=helpers.data_id(update.callback_query.data))
-    cart.add_sku(sku)
-    items = cart.items.filter(product=sku.product)
-    helpers.edit(update.callback_query, views.cart_item_view(sku.product, items))
+    session = sessions.get(update.effective_user.id)
+    sku = catalog.sku(context.callback.id)
+    session.add_sku(sku)
+    lines = session.product_lines(sku.product)
+    helpers.edit(update.callback_query, views.cart_item_view(sku.product, lines), debounce=True)
 
-    price = cart.get_total_price()
-    context.bot.edit_message_reply_markup(message_id=cart.total_message_id,
-                                          chat_id=update.effective_chat.id,
-                                          **views.total_price_view(price))
+    price = session.total_price()
+    helpers.edit_markup(context.bot, update.effective_chat.id, session.cart.total_message_id,
+                        views.total_price_view(price), debounce=True)
 
 def decrease_count(update: Update, context: CallbackContext):
     """Remove sku from the cart"""
-    cart = models.Cart.objects.get(buyer=update.effective_user.id)
-    sku = models.StockKeepingUnit.objects.get(pk=helpers.data_id(update.callback_query.data))
-    cart.remove_sku(sku)
-    items = cart.items.filter(product=sku.product)
-    helpers.edit(update.callback_query, views.cart_item_view(sku.product, items))
+    session = sessions.get(update.effective_user.id)
+    sku = catalog.sku(context.callback.id)
+    session.remove_sku(sku)
+    lines = session.product_lines(sku.product)
+    helpers.edit(update.callback_query, views.cart_item_view(sku.product, lines), debounce=True)
 
-    price = cart.get_total_price()
-    context.bot.edit_message_reply_markup(message_id=cart.total_message_id,
-                                          chat_id=update.effective_chat.id,
-                                          **views.total_price_view(price))
+    price = session.total_price()
+    helpers.edit_markup(context.bot, update.effective_chat.id, session.cart.total_message_id,
+                        views.total_price_view(price), debounce=True)
 
 def remove_sku(update: Update, context: CallbackContext):
     """Remove all packs of specific type from the cart"""
-    cart = models.Cart.objects.get(buyer=update.effective_user.id)
-    sku = models.StockKeepingUnit.objects.get(pk=helpers.data_id(update.callback_query.data))
-    cart.clear_sku(sku)
-    items = cart.items.filter(product=sku.product)
-    helpers.edit(update.callback_query, views.cart_item_view(sku.product, items))
-
-    price = cart.get_total_price()
-    context.bot.edit_message_reply_markup(
-        message_id=cart.total_message_id,
-        chat_id=update.effective_chat.id,
-        **views.total_price_view(price))
+    session = sessions.get(update.effective_user.id)
+    sku = catalog.sku(context.callback.id)
+    session.clear_sku(sku)
+    lines = session.product_lines(sku.product)
+    helpers.edit(update.callback_query, views.cart_item_view(sku.product, lines), debounce=True)
+
+    price = session.total_price()
+    helpers.edit_markup(context.bot, update.effective_chat.id, session.cart.total_message_id,
+                        views.total_price_view(price), debounce=True)
 
 def clean_cart(update: Update, context: CallbackContext):
     """Remove all products from the cart"""
-    cart = models.Cart.objects.get(buyer=update.effective_user.id)
-    cart.items.clear()
+    sessions.get(update.effective_user.id).clear()
     helpers.respond(context.bot, update.effective_chat.id, views.cart_is_cleaned_message())
     helpers.respond(context.bot, update.effective_chat.id, views.welcome_message())
 
 def confirm_order(update: Update, context: CallbackContext):
-    """Confirm order"""
-    user = models.Buyer.objects.get(pk=update.effective_user.id)
-    cart = models.Cart.objects.get(buyer=update.effective_user.id)
-    order = models.Order.objects.create(buyer=user)
-    for sku in cart.items.all():
-        models.OrderItem(order=order, sku=sku).save()
-    cart.items.clear()
+    """Turns the cart into an order and asks for delivery address"""
+    if sessions.get(update.effective_user.id).checkout() is None:
+        helpers.respond(context.bot, update.effective_chat.id, views.cart_is_empty_message())
+        return ConversationHandler.END
     helpers.respond(context.bot, update.effective_chat.id, views.get_city_view())
+    return CITY
 
 
-def save_address(update: Update, context: CallbackContext):
-    order = models.Order.objects.filter(
-        Q(buyer=update.effective_user.id),
-        Q(city__isnull=True) | Q(branch_number__isnull=True)
-    ).first()
+def order_without_address(update: Update):
+    """Returns the order the buyer is giving address for or None"""
+    return models.Order.objects.without_address().filter(buyer=update.effective_user.id).first()
+
+
+def save_city(update: Update, context: CallbackContext):
+    """Saves city of the order and asks for branch number"""
+    order = order_without_address(update)
     if not order:
-        return
-    if not order.city:
-        order.city = update.message.text
-        order.save()
-        helpers.respond(context.bot, update.effective_chat.id, views.get_branch_number_view())
-        return
-    if not order.branch_number:
-        order.branch_number = int(update.message.text)
-        order.save()
-        helpers.respond(context.bot, update.effective_chat.id, views.get_order_is_confirmed())
-        helpers.respond(context.bot, update.effective_chat.id, views.welcome_message())
+        return ConversationHandler.END
+    order.city = update.message.text
+    order.save()
+    helpers.respond(context.bot, update.effective_chat.id, views.get_branch_number_view())
+    return BRANCH_NUMBER
+
+
+def save_branch_number(update: Update, context: CallbackContext):
+    """Saves branch number of the order and finishes it"""
+    order = order_without_address(update)
+    if not order:
+        return ConversationHandler.END
+    order.branch_number = int(update.message.text)
+    order.save()
+    helpers.respond(context.bot, update.effective_chat.id, views.get_order_is_confirmed())
+    helpers.respond(context.bot, update.effective_chat.id, views.welcome_message())
+    return ConversationHandler.END
+
+
+def ask_branch_number(update: Update, context: CallbackContext):
+    """Asks for branch number again when the answer isn't a number"""
+    helpers.respond(context.bot, update.effective_chat.id, views.get_branch_number_view())
 
@@ -1,19 +1,61 @@
-from ast import literal_eval
-from upsale.apps.bot.client.constant import ID
+import logging
+from functools import wraps
+from django.db import close_old_connections
+from upsale.apps.bot.client import outbound
+from upsale.apps.bot.client.outbound import INTERACTIVE
 
-def respond(bot, chat_id, message):
-    return bot.send_message(chat_id=chat_id, **message)
+LOGGER = logging.getLogger(__name__)
 
-def photo(bot, chat_id, message):
-    bot.send_photo(chat_id=chat_id, **message)
+def sent_callback(write):
+    """Wraps a database write done when a message is sent. It runs in a thread of the outbound queue
+    that doesn't handle updates, so its connection is refreshed around the write and errors are logged"""
+    @wraps(write)
+    def callback(*args):
+        close_old_connections()
+        try:
+            write(*args)
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception('%s failed', write.__name__)
+        finally:
+            close_old_connections()
+    return callback
 
-def edit(query, message):
-    query.edit_message_caption(**message)
+def respond(bot, chat_id, message, priority=INTERACTIVE):
+    return outbound.submit(bot, chat_id, 'send_message', dict(chat_id=chat_id, **message), priority)
 
-def delete(update, context):
-    context.bot.delete_message(update.effective_chat.id, update.effective_message.message_id)
+def photo(bot, chat_id, message, product=None, priority=INTERACTIVE):
+    sent = outbound.submit(bot, chat_id, 'send_photo', dict(chat_id=chat_id, **message), priority)
+    if product is not None and not product.image_file_id:
+        sent.add_done_callback(lambda future: remember_photo(product, future))
+    return sent
+
+@sent_callback
+def remember_photo(product, future):
+    if not future.exception():
+        product.remember_photo(future.result().photo[-1].file_id)
+
+@sent_callback
+def remember_total_message(session, future):
+    if not future.exception():
+        session.remember_total_message(future.result().message_id)
+
+def edit(query, message, debounce=False):
+    chat_id = query.message.chat_id
+    message_id = query.message.message_id
+    params = dict(chat_id=chat_id, message_id=message_id, **message)
+    key = ('edit_message_caption', chat_id, message_id)
+    return outbound.submit(query.bot, chat_id, 'edit_message_caption', params, key=key, debounce=debounce)
 
-def data_id(data):
-    literal = literal_eval(data)
-    return literal[ID]
-    
\ No newline at end of file
+def edit_markup(bot, chat_id, message_id, message, debounce=False):
+    params = dict(chat_id=chat_id, message_id=message_id, **message)
+    key = ('edit_message_reply_markup', chat_id, message_id)
+    return outbound.submit(bot, chat_id, 'edit_message_reply_markup', params, key=key, debounce=debounce)
+
+def answer(query, text=None):
+    params = dict(callback_query_id=query.id, text=text)
+    return outbound.submit(query.bot, query.message.chat_id, 'answer_callback_query', params)
+
+def delete(update, context):
+    chat_id = update.effective_chat.id
+    params = dict(chat_id=chat_id, message_id=update.effective_message.message_id)
+    return outbound.submit(context.bot, chat_id, 'delete_message', params)
@@ -0,0 +1,176 @@
+"""
+Parallel execution of updates.
+Updates of one chat are handled one at a time in order of arrival, so two quick taps never
+read and change the same cart concurrently, updates of different chats run on a pool of workers.
+"""
+
+import logging
+import threading
+import time
+from functools import partial
+from collections import OrderedDict, deque, Counter
+from queue import Queue
+from typing import Callable, Hashable, Optional
+from telegram import Update
+from telegram.ext import Dispatcher, JobQueue
+from upsale.apps.bot.client import metrics, outbound
+
+LOGGER = logging.getLogger(__name__)
+# Seconds a stopping dispatcher waits for replies of the handled updates to be sent
+DRAIN_TIMEOUT = 30
+
+LANE_WAIT_SECONDS = metrics.Histogram(
+    'bot_lane_wait_seconds', 'Time tasks wait in their lane before a worker takes them', 'executor')
+metrics.register(LANE_WAIT_SECONDS)
+
+
+class LaneExecutor:
+    """Runs tasks of one lane serially and tasks of different lanes concurrently.
+    At most capacity tasks wait in all lanes, submit blocks while the executor is full."""
+
+    def __init__(self, name: str, workers: int, capacity: int):
+        self.name = name
+        self.workers = workers
+        self.capacity = capacity
+        self.lanes = OrderedDict()
+        self.busy = set()
+        self.queued = 0
+        self.counters = Counter()
+        self._threads = []
+        self._cond = threading.Condition()
+
+    def submit(self, lane: Hashable, task: Callable[[], None], timeout: float = None) -> bool:
+        """Queues the task to the end of the lane. Returns False if there was no room until timeout"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.queued < self.capacity, timeout):
+                self.counters['rejected'] += 1
+                return False
+            if not self._threads:
+                self._start()
+            self.lanes.setdefault(lane, deque()).append((task, time.monotonic()))
+            self.queued += 1
+            self._cond.notify_all()
+        return True
+
+    def metrics(self) -> dict:
+        """Returns depth of the queue, lanes with waiting tasks, the longest lane and counters of tasks"""
+        with self._cond:
+            return {
+                'queued': self.queued,
+                'lanes': len(self.lanes),
+                'longest_lane': max((len(tasks) for tasks in self.lanes.values()), default=0),
+                'in_flight': len(self.busy),
+                **{key: self.counters[key] for key in ('done', 'failed', 'rejected')}
+            }
+
+    def drain(self, timeout: float = None) -> bool:
+        """Waits until all queued tasks are done. Returns False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self.busy and not self.lanes, timeout)
+
+    def _start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'{self.name}_{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next(self):
+        """Takes the first task of the least recently served lane that isn't busy"""
+        for lane, tasks in self.lanes.items():
+            if lane in self.busy:
+                continue
+            task, queued_at = tasks.popleft()
+            if tasks:
+                self.lanes.move_to_end(lane)
+            else:
+                del self.lanes[lane]
+            self.queued -= 1
+            self.busy.add(lane)
+            LANE_WAIT_SECONDS.observe(self.name, time.monotonic() - queued_at)
+            return lane, task
+        return None, None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                lane, task = self._next()
+                while task is None:
+                    self._cond.wait()
+                    lane, task = self._next()
+                self._cond.notify_all()
+            try:
+                task()
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('Task of lane %s failed', lane)
+                result = 'failed'
+            else:
+                result = 'done'
+            with self._cond:
+                self.counters[result] += 1
+                self.busy.discard(lane)
+                self._cond.notify_all()
+
+
+def chat_lane(update) -> Optional[int]:
+    """Returns id of the chat or the user the update belongs to"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    return update.effective_user.id if update.effective_user else None
+
+
+class LaneDispatcher(Dispatcher):
+    """Dispatcher that hands updates over to lanes of their chats.
+    Updates without a chat, e.g. polling errors, are processed by the dispatcher thread."""
+
+    def __init__(self, bot, update_queue: Queue, lanes: LaneExecutor, **kwargs):
+        super().__init__(bot, update_queue, workers=0, **kwargs)
+        self.lanes = lanes
+
+    def process_update(self, update):
+        lane = chat_lane(update)
+        if lane is None:
+            super().process_update(update)
+        else:
+            self.lanes.submit(lane, partial(super().process_update, update))
+
+    def stop(self):
+        """Stops taking updates and waits until the queued ones are handled"""
+        super().stop()
+        self.drain()
+
+    def drain(self, timeout: float = DRAIN_TIMEOUT):
+        """Waits until the queued updates are handled, writes what they changed in persistence
+        and waits until their replies are sent, so nothing is lost when the process exits"""
+        self.lanes.drain()
+        if self.persistence:
+            self.persistence.flush()
+        if not outbound.queue.drain(timeout):
+            LOGGER.warning('Replies are still being sent after %ss', timeout)
+
+
+def lane_dispatcher(bot, workers: int, capacity: int, persistence=None) -> LaneDispatcher:
+    """Returns dispatcher for Updater(dispatcher=...), its update queue holds at most capacity updates,
+    so polling or the webhook waits when both the queue and the lanes are full"""
+    job_queue = JobQueue()
+    dispatcher = LaneDispatcher(bot, Queue(capacity), LaneExecutor('updates', workers, capacity),
+                                job_queue=job_queue, persistence=persistence, use_context=True)
+    job_queue.set_dispatcher(dispatcher)
+    return dispatcher
+
+
+def register_metrics(executor: LaneExecutor):
+    """Exports depth of lanes of the executor and counters of its tasks"""
+    labels = {'executor': executor.name}
+    for key, name, documentation in (
+            ('queued', 'bot_lane_queued', 'Tasks waiting in all lanes'),
+            ('lanes', 'bot_lanes', 'Lanes with waiting tasks'),
+            ('longest_lane', 'bot_lane_longest', 'Tasks waiting in the longest lane'),
+            ('in_flight', 'bot_lane_in_flight', 'Lanes with a running task')):
+        metrics.register(metrics.Collector(
+            name, documentation, 'gauge', partial(lambda key: [(labels, executor.metrics()[key])], key)))
+    metrics.register(metrics.Collector(
+        'bot_lane_tasks_total', 'Tasks finished or rejected by lanes', 'counter',
+        lambda: [({**labels, 'result': key}, value) for key, value in executor.metrics().items()
+                 if key in ('done', 'failed', 'rejected')]))
@@ -0,0 +1,46 @@
+"""
+Benchmarks bot handlers in-process on a throwaway test database.
+Fails if SQL queries per update or p95 latency are worse than the stored baseline.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from upsale.apps.bot.client.benchmark import Benchmark, BASELINE, CATALOG_SIZES, CART_SIZES, \
+    report, compare, to_baseline, load_baseline, save_baseline
+
+
+class Command(BaseCommand):
+    """Runs benchmark scenarios and compares them with the baseline"""
+    help = 'Benchmarks bot handlers with synthetic updates and a fake Bot API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--catalog-sizes', type=int, nargs='*', default=list(CATALOG_SIZES))
+        parser.add_argument('--cart-sizes', type=int, nargs='*', default=list(CART_SIZES))
+        parser.add_argument('--runs', type=int, default=20, help='Updates per scenario')
+        parser.add_argument('--latency', type=float, default=0,
+                            help='Simulated Bot API latency in seconds')
+        parser.add_argument('--baseline', default=BASELINE)
+        parser.add_argument('--tolerance', type=float, default=2,
+                            help='Allowed growth of p95 latency relative to the baseline')
+        parser.add_argument('--save-baseline', action='store_true',
+                            help='Store results as the new baseline instead of comparing')
+
+    def handle(self, *args, **options):
+        database = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with Benchmark(options['runs'], options['latency']) as benchmark:
+                results = benchmark.run(options['catalog_sizes'], options['cart_sizes'])
+        finally:
+            connection.creation.destroy_test_db(database, verbosity=0)
+
+        for line in report(results):
+            self.stdout.write(line)
+        if options['save_baseline']:
+            save_baseline(to_baseline(results), options['baseline'])
+            self.stdout.write(f'Baseline is saved to {options["baseline"]}')
+            return
+        regressions = compare(results, load_baseline(options['baseline']), options['tolerance'])
+        if regressions:
+            raise CommandError('Benchmark is worse than the baseline:\n' + '\n'.join(regressions))
+        self.stdout.write(self.style.SUCCESS('Benchmark is within the baseline'))
@@ -0,0 +1,135 @@
+"""
+Sends a message to every buyer of the bot.
+Buyers are read in order of id and sent in chunks through an outbound queue of bulk priority
+limited to --rate messages per second. The queue is separate from the one of the running bot,
+so --rate is capped at GLOBAL_RATE - INTERACTIVE_RESERVE and both together stay within
+the global limit of Telegram as long as replies don't exceed the reserve.
+After a chunk is delivered its last buyer is stored as the checkpoint of the broadcast
+and a stopped run started again with the same name resumes after it.
+Buyers that blocked the bot or deleted their account are marked and skipped by later broadcasts.
+"""
+
+import time
+from itertools import islice
+from typing import List, Tuple
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from telegram import Bot
+from telegram.error import BadRequest, Unauthorized
+from telegram.utils.request import Request
+from upsale.settings import BOTS
+from upsale.apps.core.models import Broadcast, Buyer
+from upsale.apps.bot.client import outbound
+
+LIMITS = BOTS['client']['RATE_LIMITS']
+MAX_RATE = LIMITS['GLOBAL_RATE'] - LIMITS['INTERACTIVE_RESERVE']
+
+
+def is_unreachable(error: Exception) -> bool:
+    """Returns True if Telegram will never deliver messages to the chat:
+    the bot was blocked, the account was deleted or the user never started the bot"""
+    return isinstance(error, Unauthorized) or (
+        isinstance(error, BadRequest) and 'chat not found' in error.message.lower())
+
+
+def send_chunk(queue: outbound.OutboundQueue, bot, text: str, buyer_ids: List[int]) -> list:
+    """Queues the message to the buyers. Returns their ids with futures of the calls"""
+    return [(buyer_id, queue.submit(bot, buyer_id, 'send_message', {'chat_id': buyer_id, 'text': text},
+                                    outbound.BULK))
+            for buyer_id in buyer_ids]
+
+
+def checkpoint(broadcast: Broadcast, calls: list) -> Tuple[int, int, int]:
+    """Waits for the calls of a chunk, marks unreachable buyers and moves the checkpoint past the chunk.
+    Returns numbers of sent, blocked and failed messages"""
+    blocked, failed = [], 0
+    for buyer_id, future in calls:
+        error = future.exception()
+        if error is None:
+            continue
+        if is_unreachable(error):
+            blocked.append(buyer_id)
+        else:
+            failed += 1
+    sent = len(calls) - len(blocked) - failed
+    broadcast.last_buyer_id = calls[-1][0]
+    broadcast.sent += sent
+    broadcast.blocked += len(blocked)
+    broadcast.failed += failed
+    with transaction.atomic():
+        Buyer.objects.filter(pk__in=blocked).update(blocked=True)
+        broadcast.save(update_fields=['last_buyer_id', 'sent', 'blocked', 'failed'])
+    return sent, len(blocked), failed
+
+
+class Command(BaseCommand):
+    """Sends the broadcast to buyers after its checkpoint, a chunk is queued while the previous one is sent"""
+    help = 'Sends a message to all buyers, resumes a stopped broadcast of the same name'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', help='Name of the broadcast')
+        parser.add_argument('--text', help='Text of a new broadcast')
+        parser.add_argument('--text-file', help='Path to a UTF-8 file with text of a new broadcast')
+        parser.add_argument('--rate', type=float, default=LIMITS['BROADCAST_RATE'],
+                            help=f'Messages per second, at most {MAX_RATE:g} to leave room for replies of the bot')
+        parser.add_argument('--chunk-size', type=int, default=100,
+                            help='Buyers per checkpoint, at most a chunk is sent again after a crash')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        if not 0 < options['rate'] <= MAX_RATE:
+            raise CommandError(f'Rate must be above 0 and at most {MAX_RATE:g} per second, '
+                               f"{LIMITS['INTERACTIVE_RESERVE']:g} of {LIMITS['GLOBAL_RATE']:g} "
+                               'are kept for replies of the bot')
+        if not BOTS['client']['API_TOKEN']:
+            raise CommandError('BOT_API_TOKEN is not set')
+        broadcast = self.get_broadcast(options)
+        if broadcast.finished:
+            self.stdout.write(f'Broadcast {broadcast.name} was finished at {broadcast.finished}')
+            return
+        if broadcast.last_buyer_id:
+            self.stdout.write(f'Resuming {broadcast.name} after buyer {broadcast.last_buyer_id}')
+
+        queue = outbound.OutboundQueue(outbound.BotTransport(), options['rate'], LIMITS['CHAT_RATE'],
+                                       LIMITS['CHAT_BURST'], LIMITS['WORKERS'])
+        bot = Bot(BOTS['client']['API_TOKEN'], base_url=BOTS['client']['API_URL'],
+                  request=Request(con_pool_size=LIMITS['WORKERS'] + 1))
+        buyer_ids = (Buyer.objects.filter(pk__gt=broadcast.last_buyer_id, blocked=False)
+                     .order_by('pk').values_list('pk', flat=True).iterator(chunk_size=options['chunk_size']))
+
+        started = time.perf_counter()
+        previous = None
+        while True:
+            chunk = list(islice(buyer_ids, options['chunk_size']))
+            calls = send_chunk(queue, bot, broadcast.text, chunk) if chunk else None
+            if previous:
+                self.report(broadcast, checkpoint(broadcast, previous), started)
+            if not calls:
+                break
+            previous = calls
+        broadcast.finished = timezone.now()
+        broadcast.save(update_fields=['finished'])
+        self.stdout.write(f'Sent {broadcast.sent}, blocked {broadcast.blocked}, failed {broadcast.failed} '
+                          f'in {time.perf_counter() - started:.2f}s')
+
+    def get_broadcast(self, options: dict) -> Broadcast:
+        """Returns the stored broadcast or creates it with the text from options"""
+        text = options['text']
+        if options['text_file']:
+            with open(options['text_file'], encoding='utf-8') as text_file:
+                text = text_file.read()
+        broadcast = Broadcast.objects.filter(name=options['name']).first()
+        if broadcast is None:
+            if not text or not text.strip():
+                raise CommandError('Text of a new broadcast is required, use --text or --text-file')
+            return Broadcast.objects.create(name=options['name'], text=text)
+        if text and text != broadcast.text:
+            raise CommandError(f'Broadcast {broadcast.name} has another text, choose a new name')
+        return broadcast
+
+    def report(self, broadcast: Broadcast, counts: Tuple[int, int, int], started: float):
+        if self.verbosity > 1:
+            sent, blocked, failed = counts
+            self.stdout.write(f'Up to buyer {broadcast.last_buyer_id}: sent {sent}, blocked {blocked}, '
+                              f'failed {failed}, {broadcast.sent / (time.perf_counter() - started):.1f}/s')
@@ -0,0 +1,36 @@
+"""
+Runs local stand-in for the Telegram Bot API.
+Start the bot with BOT_API_URL set to the printed url to work without network.
+"""
+
+from django.core.management.base import BaseCommand
+from upsale.apps.bot.client.fakeapi import FakeBotApi, FakeBotApiServer
+
+
+class PrintingBotApi(FakeBotApi):
+    """Fake Bot API that prints every call"""
+
+    def __init__(self, stdout):
+        super().__init__()
+        self.stdout = stdout
+
+    def call(self, method, params):
+        self.stdout.write(f'{method} {params}')
+        return super().call(method, params)
+
+
+class Command(BaseCommand):
+    """Serves fake Bot API until interrupted"""
+    help = 'Starts local fake Telegram Bot API server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8081)
+
+    def handle(self, *args, **options):
+        server = FakeBotApiServer(options['host'], options['port'], PrintingBotApi(self.stdout))
+        self.stdout.write(f'Fake Bot API is available at {server.url}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
@@ -1,46 +1,137 @@
 """
 An entry point for client part of the bot.
-Here are registered handlers for all commands.
+Updates are received with long polling by default or over HTTP with --webhook.
+Updates of one chat are handled in order, updates of different chats in parallel by --workers threads.
+With --processes the receiving process sends updates to worker processes partitioned by chat id.
 """
 
+import os
+from functools import partial
 from django.core.management.base import BaseCommand
+from telegram import Bot
 from telegram.ext import Updater
-from telegram.ext import CommandHandler, Filters, MessageHandler, CallbackQueryHandler
+from telegram.utils.request import Request
 from upsale.settings import BOTS
-from upsale.apps.bot.client.handlers import start_command, products, expand_product, \
-    collapse_product, prices, add_sku_to_cart, show_cart, increase_count, decrease_count, \
-    remove_sku, clean_cart, confirm_order, save_contact, save_address
-from upsale.apps.bot.client.constant import GO_BUTTON, CART_BUTTON, EXIT_BUTTON, \
-    PRODUCTS_BUTTON, CONFIRM_BUTTON
+from upsale.apps.bot.client.routing import register_handlers
+from upsale.apps.bot.client import metrics, lanes, partition
+from upsale.apps.bot.client.persistence import ConversationPersistence
 
 
 class Command(BaseCommand):
     """Creates bot dispatcher and register all commands"""
     help = 'Starts the client telegram bot'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--webhook', action='store_true',
+                            help='Receive updates over HTTP instead of long polling')
+        parser.add_argument('--host', default='0.0.0.0',
+                            help='Address the webhook server listens on')
+        parser.add_argument('--port', type=int, default=8443,
+                            help='Port the webhook server listens on')
+        parser.add_argument('--path', default='client',
+                            help='URL path of the webhook')
+        parser.add_argument('--secret', default=BOTS['client']['WEBHOOK_SECRET'],
+                            help='Secret path segment appended to the webhook path')
+        parser.add_argument('--url', default=BOTS['client']['WEBHOOK_URL'],
+                            help='Public base url of the webhook, e.g. https://example.com')
+        parser.add_argument('--max-connections', type=int, default=40,
+                            help='Maximum simultaneous webhook connections from Telegram')
+        parser.add_argument('--metrics-port', type=int,
+                            help='Serve Prometheus metrics on the port of 127.0.0.1')
+        parser.add_argument('--metrics-file',
+                            help='Write Prometheus metrics to the textfile every 15 seconds, '
+                                 'worker N writes them to the file with .N before its extension')
+        parser.add_argument('--workers', type=int, default=BOTS['client']['UPDATE_WORKERS'],
+                            help='Threads handling updates of different chats in parallel')
+        parser.add_argument('--queue-size', type=int, default=BOTS['client']['UPDATE_QUEUE_SIZE'],
+                            help='Updates waiting for workers before receiving of new ones is paused')
+        parser.add_argument('--processes', type=int, default=BOTS['client']['PROCESSES'],
+                            help='Worker processes handling updates, metrics of worker N '
+                                 'are served on --metrics-port + N')
+
     def handle(self, *args, **options):
-        updater = Updater(token=BOTS['client']['API_TOKEN'], use_context=True)
-        dispatcher = updater.dispatcher
-
-        dispatcher.add_handler(CommandHandler('start', start_command))
-
-        dispatcher.add_handler(MessageHandler(Filters.text(GO_BUTTON), products))
-        dispatcher.add_handler(MessageHandler(Filters.text(PRODUCTS_BUTTON), products))
-        dispatcher.add_handler(MessageHandler(Filters.text(EXIT_BUTTON), start_command))
-        dispatcher.add_handler(MessageHandler(Filters.text(CART_BUTTON), show_cart))
-        dispatcher.add_handler(MessageHandler(Filters.text(CONFIRM_BUTTON), confirm_order))
-        dispatcher.add_handler(MessageHandler(Filters.contact, save_contact))
-        dispatcher.add_handler(MessageHandler(Filters.all, save_address))
-
-        dispatcher.add_handler(CallbackQueryHandler(expand_product, pattern='.*description.*'))
-        dispatcher.add_handler(CallbackQueryHandler(collapse_product, pattern='.*product.*'))
-        dispatcher.add_handler(CallbackQueryHandler(prices, pattern='.*show_prices.*'))
-        dispatcher.add_handler(CallbackQueryHandler(add_sku_to_cart, pattern='.*add_to_cart.*'))
-        dispatcher.add_handler(CallbackQueryHandler(increase_count, pattern='.*plus_one.*'))
-        dispatcher.add_handler(CallbackQueryHandler(decrease_count, pattern='.*minus_one.*'))
-        dispatcher.add_handler(CallbackQueryHandler(remove_sku, pattern='.*remove_one.*'))
-        dispatcher.add_handler(CallbackQueryHandler(clean_cart, pattern='clean_cart'))
-
-        updater.start_polling()
+        token, base_url = BOTS['client']['API_TOKEN'], BOTS['client']['API_URL']
+        if options['processes'] > 1:
+            updater = build_front(token, base_url, options['processes'], options['workers'],
+                                  options['queue_size'], options['metrics_port'], options['metrics_file'])
+        else:
+            updater = build_updater(token, base_url, options['workers'], options['queue_size'])
+            register_handlers(updater.dispatcher)
+            lanes.register_metrics(updater.dispatcher.lanes)
+        if options['metrics_port']:
+            metrics.serve('127.0.0.1', options['metrics_port'])
+        if options['metrics_file']:
+            metrics.write_textfile_periodically(options['metrics_file'])
+
+        if options['webhook']:
+            start_webhook(updater, options)
+        else:
+            updater.start_polling()
         updater.idle()
-        
\ No newline at end of file
+
+
+def build_bot(token: str, base_url: str, workers: int) -> Bot:
+    # Connections for update workers, outbound senders, polling and the main thread
+    request = Request(con_pool_size=workers + BOTS['client']['RATE_LIMITS']['WORKERS'] + 2)
+    return Bot(token, base_url=base_url, request=request)
+
+
+def build_persistence() -> ConversationPersistence:
+    return ConversationPersistence(BOTS['client']['STATE_WRITE_INTERVAL'])
+
+
+def build_updater(token: str, base_url: str, workers: int, queue_size: int) -> Updater:
+    """Returns updater which dispatcher handles updates in lanes of their chats"""
+    dispatcher = lanes.lane_dispatcher(build_bot(token, base_url, workers), workers, queue_size,
+                                       build_persistence())
+    return Updater(dispatcher=dispatcher, workers=None, use_context=True)
+
+
+def worker_metrics_file(path: str, number: int) -> str:
+    """Returns metrics textfile of worker N, e.g. bot.prom becomes bot.N.prom"""
+    root, extension = os.path.splitext(path)
+    return f'{root}.{number}{extension}'
+
+
+def build_worker(token: str, base_url: str, workers: int, queue_size: int,
+                 metrics_port: int = None, metrics_file: str = None) -> lanes.LaneDispatcher:
+    """Returns dispatcher of a worker process with all handlers"""
+    dispatcher = lanes.lane_dispatcher(build_bot(token, base_url, workers), workers, queue_size,
+                                       build_persistence())
+    register_handlers(dispatcher)
+    lanes.register_metrics(dispatcher.lanes)
+    if metrics_port:
+        metrics.serve('127.0.0.1', metrics_port)
+    if metrics_file:
+        metrics.write_textfile_periodically(metrics_file)
+    return dispatcher
+
+
+def build_front(token: str, base_url: str, processes: int, workers: int, queue_size: int,
+                metrics_port: int = None, metrics_file: str = None) -> Updater:
+    """Starts worker processes and returns updater that sends updates to them.
+    Worker N serves its metrics on metrics_port + N and writes them to its own metrics file"""
+    partitions, worker_processes = partition.start_workers(queue_size, [
+        partial(build_worker, token, base_url, workers, queue_size,
+                metrics_port + number if metrics_port else None,
+                worker_metrics_file(metrics_file, number) if metrics_file else None)
+        for number in range(1, processes + 1)])
+    bot = Bot(token, base_url=base_url, request=Request(con_pool_size=4))
+    dispatcher = partition.partition_dispatcher(bot, partitions, worker_processes, queue_size)
+    return Updater(dispatcher=dispatcher, workers=None, use_context=True)
+
+
+def webhook_path(path: str, secret: str = None) -> str:
+    """Returns url path the webhook is served on"""
+    path = path.strip('/')
+    return f'{path}/{secret}' if secret else path
+
+
+def start_webhook(updater: Updater, options: dict) -> None:
+    """Starts http server for updates and registers it in Telegram.
+    TLS is expected to be terminated by a proxy or load balancer in front of the bot."""
+    url_path = webhook_path(options['path'], options['secret'])
+    updater.start_webhook(listen=options['host'], port=options['port'], url_path=url_path)
+    if options['url']:
+        updater.bot.set_webhook(url=f"{options['url'].rstrip('/')}/{url_path}",
+                                max_connections=options['max_connections'])
@@ -0,0 +1,180 @@
+"""
+Metrics of the bot in Prometheus text format.
+Handlers are instrumented with wall time, SQL queries and Bot API calls per update,
+metrics are served over http or written to a textfile for node exporter.
+"""
+
+import bisect
+import os
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, Tuple
+from django.db import connection
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+
+class Histogram:
+    """Cumulative histogram with labels"""
+
+    def __init__(self, name: str, documentation: str, label: str, buckets: Tuple[float, ...] = TIME_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = buckets
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label: str, value: float):
+        """Adds observation of the value"""
+        with self._lock:
+            counts, total = self.values.get(label, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[label] = (counts, total + value)
+
+    def samples(self) -> Dict[str, Tuple[list, float]]:
+        """Returns counts per bucket and sum of observations for every label"""
+        with self._lock:
+            return {label: (list(counts), total) for label, (counts, total) in self.values.items()}
+
+    def render(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        for label, (counts, total) in sorted(self.samples().items()):
+            labels = f'{self.label}="{label}"'
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+            yield f'{self.name}_sum{{{labels}}} {total}'
+            yield f'{self.name}_count{{{labels}}} {cumulative}'
+
+
+class Collector:
+    """Gauge or counter which values are taken from a function when metrics are rendered"""
+
+    def __init__(self, name: str, documentation: str, kind: str,
+                 collect: Callable[[], Iterable[Tuple[dict, float]]]):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.collect = collect
+
+    def render(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.kind}'
+        for labels, value in self.collect():
+            labels = ','.join(f'{key}="{label}"' for key, label in labels.items())
+            yield f'{self.name}{{{labels}}} {value}' if labels else f'{self.name} {value}'
+
+
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Wall time of update handlers', 'handler')
+HANDLER_QUERIES = Histogram('bot_handler_queries', 'SQL queries per update', 'handler', COUNT_BUCKETS)
+HANDLER_QUERY_SECONDS = Histogram('bot_handler_query_seconds', 'Time of SQL queries per update', 'handler')
+HANDLER_API_CALLS = Histogram('bot_handler_api_calls', 'Bot API calls made per update', 'handler',
+                              COUNT_BUCKETS)
+API_SECONDS = Histogram('bot_api_call_seconds', 'Latency of Bot API calls', 'method')
+
+registry = [HANDLER_SECONDS, HANDLER_QUERIES, HANDLER_QUERY_SECONDS, HANDLER_API_CALLS, API_SECONDS]
+
+
+def register(metric):
+    """Adds metric to the rendered ones"""
+    registry.append(metric)
+
+
+def render() -> str:
+    """Returns all metrics in Prometheus text format"""
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+
+class UpdateStats:
+    """Cost of the update that is handled in the current thread"""
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0
+        self.api_calls = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_seconds += time.perf_counter() - started
+
+
+_local = threading.local()
+
+
+def count_api_call():
+    """Counts Bot API call made by the handler running in the current thread"""
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.api_calls += 1
+
+
+def instrument(handler: Callable) -> Callable:
+    """Records wall time, SQL queries and Bot API calls of every run of the handler"""
+    name = handler.__name__
+
+    @wraps(handler)
+    def instrumented(update, context):
+        stats = _local.stats = UpdateStats()
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(stats):
+                return handler(update, context)
+        finally:
+            _local.stats = None
+            HANDLER_SECONDS.observe(name, time.perf_counter() - started)
+            HANDLER_QUERIES.observe(name, stats.queries)
+            HANDLER_QUERY_SECONDS.observe(name, stats.query_seconds)
+            HANDLER_API_CALLS.observe(name, stats.api_calls)
+    return instrumented
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves metrics on any path"""
+
+    def do_GET(self):
+        payload = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(host: str, port: int) -> ThreadingHTTPServer:
+    """Serves metrics over http in a background thread"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+def write_textfile(path: str):
+    """Atomically replaces the file with actual metrics"""
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w') as file:
+        file.write(render())
+    os.replace(temporary, path)
+
+
+def write_textfile_periodically(path: str, interval: float = 15) -> threading.Thread:
+    """Rewrites the metrics file every interval seconds in a background thread"""
+    def write():
+        while True:
+            write_textfile(path)
+            time.sleep(interval)
+    thread = threading.Thread(target=write, name='metrics', daemon=True)
+    thread.start()
+    return thread
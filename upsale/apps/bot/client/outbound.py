@@ -0,0 +1,284 @@
+"""
+Outbound queue of Bot API calls.
+Every send and edit of the bot goes through one scheduler that keeps Telegram rate limits
+per chat and per bot, serves interactive replies before bulk sends
+and retries calls rejected with 429.
+Edits of the same message that are still waiting are merged into one call with the latest content,
+debounced edits wait a short window to collect such changes.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future
+from telegram.error import BadRequest, RetryAfter
+from upsale.settings import BOTS
+from upsale.apps.bot.client import metrics
+
+LOGGER = logging.getLogger(__name__)
+LIMITS = BOTS['client']['RATE_LIMITS']
+
+(INTERACTIVE, BULK) = range(2)
+PRIORITIES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+
+class TokenBucket:
+    """Allows rate calls per second on average with bursts up to capacity calls"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Returns seconds to wait until a call is allowed"""
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Spends a token on a call"""
+        self._refill()
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        """Forbids calls for given seconds"""
+        self._refill()
+        self.tokens = min(self.tokens, 1) - seconds * self.rate
+
+    def is_idle(self) -> bool:
+        """Returns True if bucket is full and could be dropped"""
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class BotTransport:
+    """Makes calls with the bot that submitted them"""
+
+    def send(self, bot, method: str, params: dict):
+        return getattr(bot, method)(**params)
+
+
+class Job:
+    """Bot API call waiting in the queue"""
+    __slots__ = ('bot', 'chat_id', 'method', 'params', 'priority', 'key', 'future', 'attempt')
+
+    def __init__(self, bot, chat_id: int, method: str, params: dict, priority: int, key=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.method = method
+        self.params = params
+        self.priority = priority
+        self.key = key
+        self.future = Future()
+        self.attempt = 0
+
+
+class OutboundQueue:
+    """Schedules calls over worker threads.
+    Calls to one chat are made one at a time in order of submission within a priority,
+    calls to different chats run concurrently.
+    Debounced calls are queued debounce seconds after submission."""
+
+    def __init__(self, transport, global_rate: float, chat_rate: float, chat_burst: float,
+                 workers: int, retries: int = 3, debounce: float = 0):
+        self.transport = transport
+        self.workers = workers
+        self.retries = retries
+        self.debounce = debounce
+        self.bot_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self.delayed = []
+        self.pending = {}
+        self.busy = set()
+        self.counters = Counter()
+        self._threads = []
+        self._cond = threading.Condition()
+        self._sequence = itertools.count()
+
+    def submit(self, bot, chat_id: int, method: str, params: dict, priority: int = INTERACTIVE,
+               key=None, debounce: bool = False) -> Future:
+        """Queues a call of the bot method. Returns future of its result.
+        A call with the key of a call that is still waiting replaces its parameters
+        and shares its future"""
+        metrics.count_api_call()
+        with self._cond:
+            if key is not None and key in self.pending:
+                job = self.pending[key]
+                job.params = params
+                self.counters['coalesced'] += 1
+                return job.future
+            if not self._threads:
+                self._start()
+            job = Job(bot, chat_id, method, params, priority, key)
+            if key is not None:
+                self.pending[key] = job
+            if debounce and self.debounce:
+                heapq.heappush(self.delayed, (time.monotonic() + self.debounce, next(self._sequence), job))
+            else:
+                self.queues[priority].setdefault(chat_id, deque()).append(job)
+            self._cond.notify()
+        return job.future
+
+    def metrics(self) -> dict:
+        """Returns queue depth per priority and counters of calls"""
+        with self._cond:
+            return {
+                'queued': {name: sum(len(jobs) for jobs in self.queues[priority].values())
+                           for priority, name in PRIORITIES.items()},
+                'chats': len(set().union(*(queue.keys() for queue in self.queues.values()))),
+                'delayed': len(self.delayed),
+                'in_flight': len(self.busy),
+                **{key: self.counters[key] for key in ('sent', 'retried', 'failed', 'coalesced')}
+            }
+
+    def drain(self, timeout: float = None) -> bool:
+        """Waits until all queued calls are made. Returns False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self.busy and not self.delayed and not any(self.queues.values()), timeout)
+
+    def _start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'outbound_{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items()
+                                     if not value.is_idle()}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _release_delayed(self):
+        """Queues debounced jobs whose window has passed.
+        Returns seconds until the next one is due or None"""
+        now = time.monotonic()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, _, job = heapq.heappop(self.delayed)
+            self.queues[job.priority].setdefault(job.chat_id, deque()).append(job)
+        return self.delayed[0][0] - now if self.delayed else None
+
+    def _next(self):
+        """Takes the most urgent job allowed by rate limits.
+        Returns the job or None and seconds to wait before the next try"""
+        delayed = self._release_delayed()
+        wait = self.bot_bucket.delay()
+        if wait:
+            return None, wait
+        wait = delayed
+        for priority in PRIORITIES:
+            queue = self.queues[priority]
+            for chat_id, jobs in queue.items():
+                if chat_id in self.busy:
+                    continue
+                bucket = self._chat_bucket(chat_id)
+                delay = bucket.delay()
+                if delay:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                job = jobs.popleft()
+                if jobs:
+                    queue.move_to_end(chat_id)
+                else:
+                    del queue[chat_id]
+                bucket.take()
+                self.bot_bucket.take()
+                self.busy.add(chat_id)
+                if job.key is not None and self.pending.get(job.key) is job:
+                    del self.pending[job.key]
+                return job, None
+        return None, wait
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job, wait = self._next()
+                while job is None:
+                    self._cond.wait(wait)
+                    job, wait = self._next()
+            self._run(job)
+
+    def _run(self, job: Job):
+        started = time.perf_counter()
+        try:
+            result = self.transport.send(job.bot, job.method, job.params)
+        except RetryAfter as error:
+            if job.attempt < self.retries:
+                self._retry(job, error.retry_after)
+            else:
+                self._fail(job, error)
+        except BadRequest as error:
+            if 'not modified' in error.message.lower():
+                self._count('sent')
+                job.future.set_result(True)
+            else:
+                self._fail(job, error)
+        except Exception as error:  # pylint: disable=broad-except
+            self._fail(job, error)
+        else:
+            self._count('sent')
+            job.future.set_result(result)
+        finally:
+            metrics.API_SECONDS.observe(job.method, time.perf_counter() - started)
+            with self._cond:
+                self.busy.discard(job.chat_id)
+                self._cond.notify_all()
+
+    def _retry(self, job: Job, retry_after: float):
+        LOGGER.warning('Flood control for chat %s, retry in %ss', job.chat_id, retry_after)
+        job.attempt += 1
+        with self._cond:
+            self.counters['retried'] += 1
+            self._chat_bucket(job.chat_id).pause(retry_after)
+            queue = self.queues[job.priority]
+            queue.setdefault(job.chat_id, deque()).appendleft(job)
+            queue.move_to_end(job.chat_id, last=False)
+
+    def _fail(self, job: Job, error: Exception):
+        LOGGER.error('Failed to call %s for chat %s: %s', job.method, job.chat_id, error)
+        self._count('failed')
+        job.future.set_exception(error)
+
+    def _count(self, key: str):
+        with self._cond:
+            self.counters[key] += 1
+
+
+queue = OutboundQueue(BotTransport(), LIMITS['GLOBAL_RATE'], LIMITS['CHAT_RATE'],
+                      LIMITS['CHAT_BURST'], LIMITS['WORKERS'], debounce=LIMITS['EDIT_DEBOUNCE'])
+
+
+def submit(bot, chat_id: int, method: str, params: dict, priority: int = INTERACTIVE,
+           key=None, debounce: bool = False) -> Future:
+    """Queues a call of the bot method in the outbound queue of the process"""
+    return queue.submit(bot, chat_id, method, params, priority, key, debounce)
+
+
+metrics.register(metrics.Collector(
+    'bot_outbound_queued', 'Bot API calls waiting in the outbound queue', 'gauge',
+    lambda: [({'priority': name}, value) for name, value in queue.metrics()['queued'].items()]))
+metrics.register(metrics.Collector(
+    'bot_outbound_delayed', 'Debounced Bot API calls waiting for their window', 'gauge',
+    lambda: [({}, queue.metrics()['delayed'])]))
+metrics.register(metrics.Collector(
+    'bot_outbound_in_flight', 'Bot API calls being made', 'gauge',
+    lambda: [({}, queue.metrics()['in_flight'])]))
+metrics.register(metrics.Collector(
+    'bot_outbound_calls_total', 'Finished Bot API calls by result', 'counter',
+    lambda: [({'result': key}, value) for key, value in queue.metrics().items()
+             if key in ('sent', 'retried', 'failed', 'coalesced')]))
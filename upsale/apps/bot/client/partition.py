@@ -0,0 +1,114 @@
+"""
+Handling of updates in several processes.
+The front process receives updates by polling or over the webhook and sends every update
+to the worker process of its chat, so updates of one chat are handled by one process in order.
+Workers run the handlers in lanes and exit after they handled everything sent to them.
+A worker that dies stops the whole bot: its partition would fill up and block receiving
+of updates for every chat, and a new worker can't be forked from the running front process.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import signal
+from queue import Full, Queue
+from typing import Callable, List, Tuple
+from django.db import connections
+from telegram import Update
+from telegram.ext import Dispatcher, JobQueue
+from upsale.apps.bot.client.lanes import chat_lane, LaneDispatcher
+
+LOGGER = logging.getLogger(__name__)
+STOP = None
+# Seconds a full partition is waited for before its worker is checked again
+PUT_TIMEOUT = 1
+
+
+class PartitionDispatcher(Dispatcher):
+    """Dispatcher of the front process that sends updates to partitions by chat id.
+    A partition is a queue of serialized updates read by one worker process"""
+
+    def __init__(self, bot, update_queue: Queue, partitions: List, processes: List = (), **kwargs):
+        super().__init__(bot, update_queue, workers=0, **kwargs)
+        self.partitions = partitions
+        self.processes = list(processes)
+        self.failed = False
+
+    def process_update(self, update):
+        lane = chat_lane(update)
+        if lane is None:
+            super().process_update(update)
+        elif not self.send(lane % len(self.partitions), update.to_json()):
+            if not self.failed:
+                self.failed = True
+                LOGGER.critical('Worker of partition %s has exited, stopping the bot',
+                                lane % len(self.partitions))
+                os.kill(os.getpid(), signal.SIGTERM)
+            LOGGER.error('Update %s is lost, worker of its chat has exited', update.update_id)
+
+    def send(self, number: int, data) -> bool:
+        """Puts data to the partition while its worker is alive. Returns False if the worker has exited"""
+        process = self.processes[number] if self.processes else None
+        while True:
+            if process is not None and not process.is_alive():
+                return False
+            try:
+                self.partitions[number].put(data, timeout=PUT_TIMEOUT)
+                return True
+            except Full:
+                continue
+
+    def stop(self):
+        """Stops taking updates, tells workers to stop after the sent ones and waits for them"""
+        super().stop()
+        for number in range(len(self.partitions)):
+            self.send(number, STOP)
+        for process in self.processes:
+            process.join()
+            if process.exitcode:
+                LOGGER.error('%s exited with code %s', process.name, process.exitcode)
+
+
+def serve_partition(partition, dispatcher: LaneDispatcher):
+    """Handles updates of the partition until it is stopped, then waits for the started ones"""
+    while True:
+        data = partition.get()
+        if data is STOP:
+            break
+        dispatcher.process_update(Update.de_json(json.loads(data), dispatcher.bot))
+    dispatcher.drain()
+
+
+def run_worker(partition, build_dispatcher: Callable[[], LaneDispatcher]):
+    """Target of a worker process. Signals are left to the front process,
+    so a worker stops only when its partition is stopped and nothing sent to it is lost"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    try:
+        serve_partition(partition, build_dispatcher())
+    finally:
+        connections.close_all()
+
+
+def start_workers(queue_size: int, builders: List[Callable[[], LaneDispatcher]]) -> Tuple[list, list]:
+    """Forks a worker process for every builder of its dispatcher.
+    Must be called before threads of the front process are started. Returns partitions and processes"""
+    context = multiprocessing.get_context('fork')
+    connections.close_all()
+    partitions = [context.Queue(queue_size) for _ in builders]
+    processes = [context.Process(target=run_worker, args=(partition, build_dispatcher),
+                                 name=f'bot_worker_{number}')
+                 for number, (partition, build_dispatcher) in enumerate(zip(partitions, builders))]
+    for process in processes:
+        process.start()
+    return partitions, processes
+
+
+def partition_dispatcher(bot, partitions: list, processes: list, queue_size: int) -> PartitionDispatcher:
+    """Returns dispatcher of the front process for Updater(dispatcher=...)"""
+    job_queue = JobQueue()
+    dispatcher = PartitionDispatcher(bot, Queue(queue_size), partitions, processes,
+                                     job_queue=job_queue, use_context=True)
+    job_queue.set_dispatcher(dispatcher)
+    return dispatcher
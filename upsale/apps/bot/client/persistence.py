@@ -0,0 +1,72 @@
+"""
+Persistence of conversation states.
+Conversation handlers keep states of chats in memory and check them without queries,
+changes are collected here and written to the database behind them: periodically by a thread
+and on flush when the bot stops. States are read back when handlers are added after a restart.
+"""
+
+import json
+import logging
+import threading
+import time
+from django.db import close_old_connections, transaction
+from telegram.ext import BasePersistence
+from upsale.apps.core.models import Conversation
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ConversationPersistence(BasePersistence):
+    """Stores only conversations, user, chat and bot data are left in memory.
+    Changes are written every interval seconds, without interval only on flush"""
+
+    def __init__(self, interval: float = None):
+        super().__init__(store_user_data=False, store_chat_data=False, store_bot_data=False)
+        self.interval = interval
+        self.changes = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def get_conversations(self, name: str) -> dict:
+        """Returns states of the conversations by their keys"""
+        return {tuple(json.loads(key)): state
+                for key, state in Conversation.objects.filter(name=name).values_list('key', 'state')}
+
+    def update_conversation(self, name: str, key: tuple, new_state):
+        """Remembers the change, None ends the conversation"""
+        with self._lock:
+            self.changes[name, json.dumps(key)] = new_state
+            if self.interval and self._thread is None:
+                self._thread = threading.Thread(target=self._write_periodically, name='conversations',
+                                                daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        """Writes collected changes in one transaction, they are kept for the next flush if it fails"""
+        with self._flush_lock:
+            with self._lock:
+                changes, self.changes = self.changes, {}
+            if not changes:
+                return
+            try:
+                with transaction.atomic():
+                    for (name, key), state in changes.items():
+                        conversations = Conversation.objects.filter(name=name, key=key)
+                        if state is None:
+                            conversations.delete()
+                        elif not conversations.update(state=state):
+                            Conversation.objects.create(name=name, key=key, state=state)
+            except Exception:
+                with self._lock:
+                    self.changes = {**changes, **self.changes}
+                raise
+
+    def _write_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('Failed to write states of conversations')
@@ -0,0 +1,94 @@
+"""
+Router of callback queries.
+Callback data is decoded once per update and the handler of its action is taken from a table,
+so dispatch cost doesn't depend on the number of screens.
+"""
+
+import logging
+import time
+from functools import wraps
+from typing import Callable
+from telegram import Update
+from telegram.ext import Handler
+from upsale.apps.core.models import Cart, Product, StockKeepingUnit
+from upsale.apps.bot.client.callback import decode, InvalidCallback
+from upsale.apps.bot.client import helpers
+
+LOGGER = logging.getLogger(__name__)
+SLOW_CALLBACK = 0.5
+
+
+class CallbackRouter(Handler):
+    """Single handler for all callback queries.
+    Middleware wraps every route: middleware(route) returns a callable with the same signature."""
+
+    def __init__(self, middleware=()):
+        super().__init__(self._unrouted)
+        self.middleware = list(middleware)
+        self.routes = {}
+
+    def route(self, action: int, callback: Callable, *middleware: Callable):
+        """Adds handler of the action with common and action specific middleware"""
+        for layer in reversed([*self.middleware, *middleware]):
+            callback = layer(callback)
+        self.routes[action] = callback
+
+    def check_update(self, update):
+        if not isinstance(update, Update) or not update.callback_query or not update.callback_query.data:
+            return None
+        try:
+            callback = decode(update.callback_query.data)
+        except InvalidCallback:
+            LOGGER.warning('Invalid callback data %r', update.callback_query.data)
+            return None
+        route = self.routes.get(callback.action)
+        return (callback, route) if route else None
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        callback, route = check_result
+        context.callback = callback
+        return route(update, context)
+
+    @staticmethod
+    def _unrouted(update, _):
+        LOGGER.warning('No route for callback %r', update.callback_query.data)
+
+
+def acknowledge(route: Callable) -> Callable:
+    """Answers callback query before the handler runs, so the button stops loading at once"""
+    @wraps(route)
+    def acknowledged(update, context):
+        helpers.answer(update.callback_query)
+        return route(update, context)
+    return acknowledged
+
+
+def measure_time(route: Callable) -> Callable:
+    """Logs handlers slower than SLOW_CALLBACK seconds"""
+    @wraps(route)
+    def measured(update, context):
+        started = time.perf_counter()
+        try:
+            return route(update, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            if elapsed > SLOW_CALLBACK:
+                LOGGER.warning('%s took %.3fs', route.__name__, elapsed)
+    return measured
+
+
+def handle_errors(route: Callable) -> Callable:
+    """Tells the user that a button is outdated if its product was removed
+    and asks to /start if the user has no cart, logs other errors"""
+    @wraps(route)
+    def handled(update, context):
+        try:
+            return route(update, context)
+        except (Product.DoesNotExist, StockKeepingUnit.DoesNotExist):
+            helpers.respond(context.bot, update.effective_chat.id, {'text': 'Товар больше не доступен'})
+        except Cart.DoesNotExist:
+            helpers.respond(context.bot, update.effective_chat.id, {'text': 'Нажмите /start, чтобы начать'})
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception('%s failed for callback %r', route.__name__, update.callback_query.data)
+        return None
+    return handled
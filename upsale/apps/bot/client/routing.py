@@ -0,0 +1,64 @@
+"""
+Registration of all client bot handlers on a dispatcher
+"""
+
+from telegram import Update
+from telegram.ext import Dispatcher, CommandHandler, ConversationHandler, Filters, MessageHandler, \
+    TypeHandler
+from upsale.apps.bot.client.handlers import refresh_connection, start_command, products, \
+    show_info, expand_product, collapse_product, prices, add_sku_to_cart, show_cart, \
+    increase_count, decrease_count, remove_sku, clean_cart, confirm_order, save_contact, \
+    save_city, save_branch_number, ask_branch_number
+from upsale.apps.bot.client.constant import GO_BUTTON, CART_BUTTON, EXIT_BUTTON, \
+    PRODUCTS_BUTTON, CONFIRM_BUTTON, NOOP, SHOW_DESCRIPTION, SHOW_PRODUCT, SHOW_PRICES, \
+    ADD_TO_CART, PLUS_ONE, MINUS_ONE, REMOVE_ONE, CLEAN_CART, ADDRESS_CONVERSATION, CITY, BRANCH_NUMBER
+from upsale.apps.bot.client.metrics import instrument
+from upsale.apps.bot.client.router import CallbackRouter, acknowledge, measure_time, handle_errors
+
+
+def register_handlers(dispatcher: Dispatcher) -> None:
+    """Adds handlers for all commands, buttons and callbacks to the dispatcher"""
+    dispatcher.add_handler(TypeHandler(Update, refresh_connection), group=-1)
+    dispatcher.add_handler(CommandHandler('start', instrument(start_command)))
+
+    dispatcher.add_handler(MessageHandler(Filters.text(GO_BUTTON), instrument(products)))
+    dispatcher.add_handler(MessageHandler(Filters.text(PRODUCTS_BUTTON), instrument(products)))
+    dispatcher.add_handler(MessageHandler(Filters.text(EXIT_BUTTON), instrument(start_command)))
+    dispatcher.add_handler(MessageHandler(Filters.text(CART_BUTTON), instrument(show_cart)))
+    dispatcher.add_handler(address_conversation(persistent=dispatcher.persistence is not None))
+    dispatcher.add_handler(MessageHandler(Filters.contact, instrument(save_contact)))
+
+    dispatcher.add_handler(callback_router())
+
+
+def address_conversation(persistent: bool) -> ConversationHandler:
+    """Builds steps of delivery address after the order is confirmed.
+    Buttons are handled before it, messages of chats outside the steps don't match it
+    and are dropped without queries"""
+    answer = Filters.text & ~Filters.command
+    return ConversationHandler(
+        entry_points=[MessageHandler(Filters.text(CONFIRM_BUTTON), instrument(confirm_order))],
+        states={
+            CITY: [MessageHandler(answer, instrument(save_city))],
+            BRANCH_NUMBER: [MessageHandler(Filters.regex(r'^\s*\d{1,9}\s*$'), instrument(save_branch_number)),
+                            MessageHandler(answer, instrument(ask_branch_number))],
+        },
+        fallbacks=[],
+        allow_reentry=True,
+        name=ADDRESS_CONVERSATION,
+        persistent=persistent)
+
+
+def callback_router() -> CallbackRouter:
+    """Builds router of all inline buttons"""
+    router = CallbackRouter(middleware=[instrument, handle_errors, measure_time, acknowledge])
+    router.route(NOOP, show_info)
+    router.route(SHOW_DESCRIPTION, expand_product)
+    router.route(SHOW_PRODUCT, collapse_product)
+    router.route(SHOW_PRICES, prices)
+    router.route(ADD_TO_CART, add_sku_to_cart)
+    router.route(PLUS_ONE, increase_count)
+    router.route(MINUS_ONE, decrease_count)
+    router.route(REMOVE_ONE, remove_sku)
+    router.route(CLEAN_CART, clean_cart)
+    return router
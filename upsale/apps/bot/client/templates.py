@@ -2,47 +2,55 @@
 Build messages
 """
 
-from typing import List
-import itertools
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Iterable, List, Tuple
 from telegram import ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton, KeyboardButton
-from upsale.apps.core.models import Product, Cart, StockKeepingUnit
-from upsale.apps.bot.client.constant import ID, ACTION
+from upsale.apps.core.models import Product, StockKeepingUnit
+from upsale.apps.core.session import Session, CartLine
+from upsale.apps.bot.client.constant import NOOP, SHOW_DESCRIPTION, SHOW_PRODUCT, SHOW_PRICES, \
+    ADD_TO_CART, PLUS_ONE, MINUS_ONE, REMOVE_ONE, CLEAN_CART
+from upsale.apps.bot.client.callback import encode
 from upsale.apps.bot.client.constant import GO_BUTTON, CART_BUTTON, EXIT_BUTTON, \
     PRODUCTS_BUTTON, CONFIRM_BUTTON, EMPTY_CART_BUTTON
 
+RENDER_CACHE_SIZE = 10000
+NOOP_DATA = encode(NOOP)
+
 
 def get_show_description_button(product_id: int) -> InlineKeyboardButton:
-    callback = str({ID: product_id, ACTION: 'description'})
+    callback = encode(SHOW_DESCRIPTION, product_id)
     return InlineKeyboardButton("Описание товара", callback_data=callback)
 
 
 def get_add_to_cart_button(product_id: int) -> InlineKeyboardButton:
-    callback = str({ID: product_id, ACTION: 'show_prices'})
+    callback = encode(SHOW_PRICES, product_id)
     return InlineKeyboardButton("Добавить в корзину", callback_data=callback)
 
 
-def get_hide_description_button(product_id: str) -> InlineKeyboardButton:
-    callback = str({ID: product_id, ACTION: 'product'})
+def get_hide_description_button(product_id: int) -> InlineKeyboardButton:
+    callback = encode(SHOW_PRODUCT, product_id)
     return InlineKeyboardButton('Скрыть описание', callback_data=callback)
 
 
-def get_back_button(product_id: str) -> InlineKeyboardButton:
-    callback = str({ID: product_id, ACTION: 'product'})
+def get_back_button(product_id: int) -> InlineKeyboardButton:
+    callback = encode(SHOW_PRODUCT, product_id)
     return InlineKeyboardButton("Назад", callback_data=callback)
 
 
-def get_plus_button(pack_id: str) -> InlineKeyboardButton:
-    callback = str({ID: pack_id, ACTION: 'plus_one'})
+def get_plus_button(pack_id: int) -> InlineKeyboardButton:
+    callback = encode(PLUS_ONE, pack_id)
     return InlineKeyboardButton("➕", callback_data=callback)
 
 
-def get_minus_button(pack_id: str) -> InlineKeyboardButton:
-    callback = str({ID: pack_id, ACTION: 'minus_one'})
+def get_minus_button(pack_id: int) -> InlineKeyboardButton:
+    callback = encode(MINUS_ONE, pack_id)
     return InlineKeyboardButton("➖", callback_data=callback)
 
 
-def get_remove_button(pack_id: str) -> InlineKeyboardButton:
-    callback = str({ID: pack_id, ACTION: 'remove_one'})
+def get_remove_button(pack_id: int) -> InlineKeyboardButton:
+    callback = encode(REMOVE_ONE, pack_id)
     return InlineKeyboardButton("❌", callback_data=callback)
 
 
@@ -76,51 +84,110 @@ def cart_message() -> dict:
     return {'text': CART_BUTTON, 'reply_markup': reply_markup}
 
 
+class RenderCache:
+    """Bounded LRU cache of rendered parts of product views.
+    Parts are built once per view kind and catalog version of the product,
+    products that are not from the catalog are rendered every time"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._parts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, kind: str, product: Product, build: Callable[[Product], Any]):
+        """Returns parts of the view of the product, builds them on a miss"""
+        version = getattr(product, 'catalog_version', None)
+        if version is None:
+            return build(product)
+        key = (kind, product.id, version)
+        with self._lock:
+            parts = self._parts.get(key)
+            if parts is not None:
+                self._parts.move_to_end(key)
+                return parts
+        parts = build(product)
+        with self._lock:
+            self._parts[key] = parts
+            while len(self._parts) > self.size:
+                self._parts.popitem(last=False)
+        return parts
+
+    def clear(self):
+        with self._lock:
+            self._parts.clear()
+
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+
+
+def inline_keyboard(rows: List[List[str]]) -> str:
+    """Joins serialized buttons to serialized InlineKeyboardMarkup, Bot API accepts it as is"""
+    return '{"inline_keyboard": [%s]}' % ', '.join('[%s]' % ', '.join(row) for row in rows)
+
+
+def _product_parts(product: Product) -> Tuple[str, str]:
+    buttons = [[get_show_description_button(product.id).to_json()],
+               [get_add_to_cart_button(product.id).to_json()]]
+    return product.short_caption(), inline_keyboard(buttons)
+
+
+def _description_parts(product: Product) -> Tuple[str, str]:
+    buttons = [[get_hide_description_button(product.id).to_json()],
+               [get_add_to_cart_button(product.id).to_json()]]
+    return product.long_caption(), inline_keyboard(buttons)
+
+
+def _price_parts(product: Product) -> Tuple[str, str, list]:
+    buttons = []
+    for sku in product.stockkeepingunit_set.all():
+        text = f'{sku.pack.size}{sku.pack.unit} - {sku.price} грн'
+        in_cart = InlineKeyboardButton(text=f'{text} - В корзине', callback_data=encode(NOOP))
+        add = InlineKeyboardButton(text=text, callback_data=encode(ADD_TO_CART, sku.id))
+        buttons.append((sku.id, in_cart.to_json(), add.to_json()))
+    return product.short_caption(), get_back_button(product.id).to_json(), buttons
+
+
+def _cart_item_parts(product: Product) -> Tuple[str, dict]:
+    return product.short_caption(), {sku.id: _cart_line_parts(sku)
+                                     for sku in product.stockkeepingunit_set.all()}
+
+
+def _cart_line_parts(sku: StockKeepingUnit) -> Tuple[str, str, str, str]:
+    return (get_plus_button(sku.id).to_json(), f'/{sku.pack.size}{sku.pack.unit}',
+            get_minus_button(sku.id).to_json(), get_remove_button(sku.id).to_json())
+
+
 def product_view(product: Product) -> dict:
-    action_buttons = [[get_show_description_button(product.id)],
-                      [get_add_to_cart_button(product.id)]]
-    action_markup = InlineKeyboardMarkup(action_buttons)
-    return {'caption': product.short_caption(), 'photo': product.image, 'reply_markup': action_markup}
+    caption, markup = render_cache.get('product', product, _product_parts)
+    return {'caption': caption, 'photo': product.photo(), 'reply_markup': markup}
 
 
 def product_description_view(product: Product) -> dict:
-    action_buttons = [[get_hide_description_button(product.id)],
-                      [get_add_to_cart_button(product.id)]]
-    action_markup = InlineKeyboardMarkup(action_buttons)
-    return {'caption': product.long_caption(), 'photo': product.image, 'reply_markup': action_markup}
+    caption, markup = render_cache.get('description', product, _description_parts)
+    return {'caption': caption, 'photo': product.photo(), 'reply_markup': markup}
 
 
-def product_price_view(product: Product, cart: Cart) -> dict:
-    action_buttons = [get_back_button(product.id)]
-    for sku in product.stockkeepingunit_set.all():
-        if cart.contains(sku):
-            price_button = InlineKeyboardButton(
-                text=f'{sku.pack.size}{sku.pack.unit} - {sku.price} грн - В корзине', callback_data='empty')
-        else:
-            callback = str({ID: sku.id, ACTION: 'add_to_cart'})
-            price_button = InlineKeyboardButton(text=f'{sku.pack.size}{sku.pack.unit} - {sku.price} грн', callback_data=callback)
-        action_buttons.append(price_button)
-    action_markup = InlineKeyboardMarkup.from_column(action_buttons)
-    return {'caption': product.short_caption(), 'reply_markup': action_markup}
-
-
-def cart_item_view(product, sku_set):
-    buttons = []
-    items = sorted(sku_set, key=lambda x: x.id)
-    groups = itertools.groupby(items, lambda x: x)
-    for sku, group in groups:
-        plus = get_plus_button(sku.id)
-        minus = get_minus_button(sku.id)
-        remove = get_remove_button(sku.id)
-        count = InlineKeyboardButton(f'{len(list(group))}/{sku.pack.size}{sku.pack.unit}', callback_data='empty')
-        buttons.append([plus, count, minus, remove])
-    reply_markup = InlineKeyboardMarkup(buttons, one_time_keyboard=False, resize_keyboard=True)
-    return {'caption': product.short_caption(), 'photo': product.image, 'reply_markup': reply_markup}
+def product_price_view(product: Product, session: Session) -> dict:
+    caption, back, buttons = render_cache.get('price', product, _price_parts)
+    in_cart = session.sku_ids()
+    rows = [[back]] + [[in_cart_button if sku_id in in_cart else add_button]
+                       for sku_id, in_cart_button, add_button in buttons]
+    return {'caption': caption, 'reply_markup': inline_keyboard(rows)}
+
+
+def cart_item_view(product: Product, lines: Iterable[CartLine]) -> dict:
+    caption, skus = render_cache.get('cart_item', product, _cart_item_parts)
+    rows = []
+    for line in lines:
+        plus, pack, minus, remove = skus.get(line.sku.id) or _cart_line_parts(line.sku)
+        count = json.dumps({'text': f'{line.quantity}{pack}', 'callback_data': NOOP_DATA})
+        rows.append([plus, count, minus, remove])
+    return {'caption': caption, 'photo': product.photo(), 'reply_markup': inline_keyboard(rows)}
 
 
 def total_price_view(price):
-    buttons = [InlineKeyboardButton(f'{price} грн', callback_data='empty'),
-               InlineKeyboardButton(EMPTY_CART_BUTTON, callback_data='clean_cart')]
+    buttons = [InlineKeyboardButton(f'{price} грн', callback_data=encode(NOOP)),
+               InlineKeyboardButton(EMPTY_CART_BUTTON, callback_data=encode(CLEAN_CART))]
     reply_markup = InlineKeyboardMarkup.from_column(buttons)
     return {'text': 'Общая сумма заказа:', 'reply_markup': reply_markup}
 
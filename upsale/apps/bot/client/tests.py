@@ -0,0 +1,589 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from io import StringIO
+from queue import Queue
+from unittest import mock
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, Filters, MessageHandler
+from telegram.error import BadRequest, RetryAfter, Unauthorized
+from upsale.settings import BOTS
+from upsale.apps.core import models
+from upsale.apps.core.catalog import catalog
+from upsale.apps.core.session import sessions, SessionCache
+from upsale.apps.bot.client.constant import GO_BUTTON, SHOW_PRICES, ADD_TO_CART, PLUS_ONE, NOOP, \
+    CONFIRM_BUTTON
+from upsale.apps.bot.client.fakeapi import FakeBotApi, FakeBotApiServer, FakeRequest, FakeTransport, \
+    message_update, callback_update, post_update
+from upsale.apps.bot.client.routing import register_handlers
+from upsale.apps.bot.client import outbound, callback, router, metrics, benchmark, templates, lanes, \
+    partition, helpers
+from upsale.apps.bot.client.management.commands.startbot import start_webhook, build_updater, \
+    worker_metrics_file
+from upsale.apps.bot.client.persistence import ConversationPersistence
+
+TOKEN = '123456:fake-token'
+
+
+def wait_until(predicate, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def is_listening(port: int) -> bool:
+    with socket.socket() as sock:
+        return sock.connect_ex(('127.0.0.1', port)) == 0
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class WebhookTest(TransactionTestCase):
+    """Updates delivered to the webhook are handled against the fake Bot API"""
+
+    def setUp(self):
+        sessions.clear()
+        self.server = FakeBotApiServer().start()
+        self.api = self.server.api
+        self.updater = build_updater(TOKEN, self.server.url, workers=4, queue_size=100)
+        register_handlers(self.updater.dispatcher)
+        self.port = free_port()
+        start_webhook(self.updater, {
+            'host': '127.0.0.1', 'port': self.port, 'path': '/client/', 'secret': 's3cret',
+            'url': 'https://bot.example.com', 'max_connections': 100})
+        self.url = f'http://127.0.0.1:{self.port}/client/s3cret'
+        self.assertTrue(wait_until(lambda: is_listening(self.port)))
+
+    def tearDown(self):
+        self.updater.stop()
+        self.server.stop()
+
+    def test_webhook_is_registered(self):
+        self.assertEqual(self.api.webhook['url'], 'https://bot.example.com/client/s3cret')
+        self.assertEqual(int(self.api.webhook['max_connections']), 100)
+
+    def test_start_command(self):
+        self.assertEqual(post_update(self.url, message_update(1, 42, '/start')), 200)
+        sent = self.api.wait_for('sendMessage')
+        self.assertEqual(int(sent[0]['chat_id']), 42)
+        self.assertTrue(models.Buyer.objects.filter(pk=42).exists())
+        self.assertTrue(models.Cart.objects.filter(buyer=42).exists())
+
+    def test_catalog(self):
+        pack = models.Pack.objects.create(unit='g', size=250)
+        for name in ('Arabica', 'Robusta'):
+            product = models.Product.objects.create(
+                name=name, description='', image=f'https://example.com/{name}.jpg')
+            models.StockKeepingUnit.objects.create(product=product, pack=pack, price=100)
+
+        post_update(self.url, message_update(1, 42, GO_BUTTON))
+        photos = self.api.wait_for('sendPhoto', count=2)
+        self.assertEqual([photo['caption'].split('\n')[0] for photo in photos],
+                         ['☕️ Arabica', '☕️ Robusta'])
+
+    def test_catalog_photos_are_uploaded_once(self):
+        pack = models.Pack.objects.create(unit='g', size=250)
+        product = models.Product.objects.create(
+            name='Arabica', description='', image='https://example.com/arabica.jpg')
+        models.StockKeepingUnit.objects.create(product=product, pack=pack, price=100)
+
+        post_update(self.url, message_update(1, 42, GO_BUTTON))
+        self.assertTrue(wait_until(lambda: models.Product.objects.get().image_file_id))
+        post_update(self.url, message_update(2, 42, GO_BUTTON))
+        photos = self.api.wait_for('sendPhoto', count=2)
+        self.assertEqual(photos[0]['photo'], 'https://example.com/arabica.jpg')
+        self.assertEqual(photos[1]['photo'], 'photo-1')
+        self.assertEqual(models.Product.objects.get().image_file_id, 'photo-1')
+
+    def test_callback_button(self):
+        pack = models.Pack.objects.create(unit='g', size=250)
+        product = models.Product.objects.create(
+            name='Arabica', description='', image='https://example.com/arabica.jpg')
+        sku = models.StockKeepingUnit.objects.create(product=product, pack=pack, price=100)
+        post_update(self.url, message_update(1, 42, '/start'))
+        self.api.wait_for('sendMessage')
+
+        post_update(self.url, callback_update(2, 42, callback.encode(SHOW_PRICES, product.id)))
+        edits = self.api.wait_for('editMessageCaption')
+        markup = json.loads(edits[0]['reply_markup'])
+        buttons = [row[0]['callback_data'] for row in markup['inline_keyboard']]
+        self.assertEqual(callback.decode(buttons[1]), (ADD_TO_CART, (sku.id,)))
+
+    def test_button_of_removed_product(self):
+        post_update(self.url, callback_update(1, 42, callback.encode(SHOW_PRICES, 404)))
+        self.assertEqual(self.api.wait_for('answerCallbackQuery')[0]['callback_query_id'], '1')
+        self.assertEqual(self.api.wait_for('sendMessage')[0]['text'], 'Товар больше не доступен')
+
+    def test_button_without_cart(self):
+        pack = models.Pack.objects.create(unit='g', size=250)
+        product = models.Product.objects.create(
+            name='Arabica', description='', image='https://example.com/arabica.jpg')
+        models.StockKeepingUnit.objects.create(product=product, pack=pack, price=100)
+        post_update(self.url, callback_update(1, 42, callback.encode(SHOW_PRICES, product.id)))
+        self.assertEqual(self.api.wait_for('sendMessage')[0]['text'], 'Нажмите /start, чтобы начать')
+
+    def test_metrics(self):
+        def runs():
+            counts, _ = metrics.HANDLER_QUERIES.samples().get('start_command', ([], 0))
+            return sum(counts)
+        before = runs()
+        post_update(self.url, message_update(1, 42, '/start'))
+        self.api.wait_for('sendMessage')
+        self.assertTrue(wait_until(lambda: runs() == before + 1))
+        self.assertGreater(metrics.HANDLER_QUERIES.samples()['start_command'][1], 0)
+        self.assertIn('bot_handler_api_calls_count{handler="start_command"}', metrics.render())
+
+
+class BenchmarkTest(TransactionTestCase):
+    """Handlers don't make more SQL queries than the stored baseline"""
+
+    def test_within_baseline(self):
+        with benchmark.Benchmark(runs=3) as bench:
+            results = bench.run(catalog_sizes=[10], cart_sizes=[1, 10])
+        self.assertEqual(len(results), 7)
+        self.assertEqual(benchmark.compare(results, benchmark.load_baseline()), [])
+        self.assertEqual(len(bench.api.calls_of('sendPhoto')), 3 * 10 + 3 * 1 + 3 * 5)
+
+
+class RenderTest(TestCase):
+    """Product views are built once per catalog version, cart state is an overlay"""
+
+    def setUp(self):
+        catalog.invalidate()
+        templates.render_cache.clear()
+        pack = models.Pack.objects.create(unit='g', size=250)
+        product = models.Product.objects.create(
+            name='Arabica', description='', image='https://example.com/arabica.jpg')
+        self.skus = [models.StockKeepingUnit.objects.create(product=product, pack=pack, price=price)
+                     for price in (100, 150)]
+        self.cart = models.Cart.objects.create(buyer=models.Buyer.objects.create(id=42, full_name='Buyer'))
+        self.session = SessionCache(size=1, ttl=60).get(42)
+
+    def buttons(self, view):
+        return [button for row in json.loads(view['reply_markup'])['inline_keyboard'] for button in row]
+
+    def test_views_are_reused(self):
+        product = catalog.product(self.skus[0].product_id)
+        self.assertIs(templates.product_view(product)['reply_markup'],
+                      templates.product_view(product)['reply_markup'])
+        product.name = 'Kenya'
+        product.save()
+        self.assertTrue(templates.product_view(catalog.product(product.id))['caption'].startswith('☕️ Kenya'))
+
+    def test_price_view_overlay(self):
+        product = catalog.product(self.skus[0].product_id)
+        self.session.add_sku(self.skus[1])
+        view = templates.product_price_view(product, self.session)
+        self.assertEqual([button['text'] for button in self.buttons(view)],
+                         ['Назад', '250g - 100.0 грн', '250g - 150.0 грн - В корзине'])
+        self.assertEqual(callback.decode(self.buttons(view)[1]['callback_data']),
+                         (ADD_TO_CART, (self.skus[0].id,)))
+
+    def test_cart_item_view_counts(self):
+        product = catalog.product(self.skus[0].product_id)
+        for sku in (self.skus[0], self.skus[0], self.skus[1]):
+            self.session.add_sku(sku)
+        view = templates.cart_item_view(product, self.session.product_lines(product))
+        self.assertEqual([button['text'] for button in self.buttons(view)],
+                         ['➕', '2/250g', '➖', '❌', '➕', '1/250g', '➖', '❌'])
+
+
+class RouterTest(SimpleTestCase):
+    """Callback router finds handler by action and applies middleware"""
+
+    def setUp(self):
+        self.calls = []
+        self.router = router.CallbackRouter(middleware=[self.layer('common')])
+        self.router.route(PLUS_ONE, lambda update, context: self.calls.append(context.callback.id),
+                          self.layer('plus'))
+
+    def layer(self, name):
+        def middleware(route):
+            def wrapped(update, context):
+                self.calls.append(name)
+                return route(update, context)
+            return wrapped
+        return middleware
+
+    def update(self, data):
+        return Update.de_json(callback_update(1, 42, data), None)
+
+    def test_dispatch(self):
+        update = self.update(callback.encode(PLUS_ONE, 5))
+        check = self.router.check_update(update)
+        self.router.handle_update(update, None, check, mock.Mock())
+        self.assertEqual(self.calls, ['common', 'plus', 5])
+
+    def test_unknown_action(self):
+        self.assertIsNone(self.router.check_update(self.update(callback.encode(NOOP))))
+        with self.assertLogs(router.LOGGER, 'WARNING'):
+            self.assertIsNone(self.router.check_update(self.update('garbage')))
+
+
+class MetricsTest(SimpleTestCase):
+    """Metrics are rendered in Prometheus text format"""
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Test', 'handler', (0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe('show_cart', value)
+        self.assertEqual(list(histogram.render()), [
+            '# HELP test_seconds Test',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{handler="show_cart",le="0.1"} 2',
+            'test_seconds_bucket{handler="show_cart",le="1"} 3',
+            'test_seconds_bucket{handler="show_cart",le="+Inf"} 4',
+            'test_seconds_sum{handler="show_cart"} 2.65',
+            'test_seconds_count{handler="show_cart"} 4',
+        ])
+
+    def test_textfile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bot.prom')
+            metrics.write_textfile(path)
+            with open(path) as file:
+                self.assertIn('# TYPE bot_outbound_queued gauge', file.read())
+
+    def test_textfile_of_worker(self):
+        self.assertEqual(worker_metrics_file('/var/lib/node/bot.prom', 2), '/var/lib/node/bot.2.prom')
+
+
+class CallbackTest(SimpleTestCase):
+    """Callback data is compact, versioned and optionally signed"""
+
+    def test_round_trip(self):
+        data = callback.encode(PLUS_ONE, 123456789)
+        self.assertLessEqual(len(data), 8)
+        self.assertEqual(callback.decode(data), (PLUS_ONE, (123456789,)))
+        self.assertEqual(callback.decode(data).id, 123456789)
+
+    def test_legacy_format(self):
+        self.assertEqual(callback.decode("{0: 5, 1: 'add_to_cart'}"), (ADD_TO_CART, (5,)))
+        self.assertEqual(callback.decode('empty'), (NOOP, ()))
+
+    def test_signed(self):
+        data = callback.encode(PLUS_ONE, 7, secret='key')
+        self.assertEqual(callback.decode(data, secret='key').id, 7)
+        forged = callback.encode(PLUS_ONE, 8, secret='other')
+        with self.assertRaises(callback.InvalidCallback):
+            callback.decode(forged, secret='key')
+        with self.assertRaises(callback.InvalidCallback):
+            callback.decode(callback.encode(PLUS_ONE, 7, secret=None), secret='key')
+
+    def test_malformed(self):
+        for data in ('', '!!', 'AA', "{0: 1, 1: 'unknown'}"):
+            with self.assertRaises(callback.InvalidCallback):
+                callback.decode(data)
+
+
+class OutboundTest(SimpleTestCase):
+    """Calls to Bot API keep rate limits, priorities and are retried on flood control"""
+
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.queue = outbound.OutboundQueue(self.transport, global_rate=1000, chat_rate=1000,
+                                            chat_burst=1000, workers=4)
+
+    def test_token_bucket(self):
+        bucket = outbound.TokenBucket(rate=10, capacity=2)
+        for _ in range(2):
+            self.assertEqual(bucket.delay(), 0)
+            bucket.take()
+        self.assertAlmostEqual(bucket.delay(), 0.1, places=2)
+        bucket.pause(1)
+        self.assertGreater(bucket.delay(), 1)
+
+    def test_result(self):
+        message = self.queue.submit(None, 7, 'send_message', {'chat_id': 7, 'text': 'hi'}).result(5)
+        self.assertEqual(message.chat_id, 7)
+        self.assertEqual(self.queue.metrics()['sent'], 1)
+
+    def test_retry_after(self):
+        self.transport.send = mock.Mock(side_effect=[RetryAfter(0.01), 'sent'])
+        with self.assertLogs(outbound.LOGGER, 'WARNING'):
+            self.assertEqual(self.queue.submit(None, 7, 'send_message', {}).result(5), 'sent')
+        self.assertEqual(self.queue.metrics()['retried'], 1)
+
+    def test_chat_order(self):
+        futures = [self.queue.submit(None, 8, 'send_message', {'chat_id': 8, 'text': str(number)})
+                   for number in range(20)]
+        for future in futures:
+            future.result(5)
+        self.assertEqual([call['text'] for call in self.transport.api.calls_of('sendMessage')],
+                         [str(number) for number in range(20)])
+
+    def test_interactive_before_bulk(self):
+        self.queue.bot_bucket = outbound.TokenBucket(rate=0.001, capacity=1)
+        self.queue.bot_bucket.tokens = 0
+        bulk = self.queue.submit(None, 9, 'send_message', {'text': 'bulk'}, outbound.BULK)
+        reply = self.queue.submit(None, 10, 'send_message', {'text': 'reply'})
+        self.assertEqual(self.queue.metrics()['queued'], {'interactive': 1, 'bulk': 1})
+        self.queue.bot_bucket.tokens = 1
+        with self.queue._cond:  # pylint: disable=protected-access
+            self.queue._cond.notify_all()  # pylint: disable=protected-access
+        reply.result(5)
+        self.assertFalse(bulk.done())
+
+    def test_coalesced_edits(self):
+        self.queue.debounce = 0.05
+        key = ('edit_message_caption', 7, 1)
+        futures = [self.queue.submit(None, 7, 'edit_message_caption', {'caption': str(number)},
+                                     key=key, debounce=True) for number in range(5)]
+        self.assertEqual(len(set(futures)), 1)
+        self.assertEqual(self.queue.metrics()['delayed'], 1)
+        futures[0].result(5)
+        self.assertEqual(self.transport.api.calls_of('editMessageCaption'), [{'caption': '4'}])
+        self.assertEqual(self.queue.metrics()['coalesced'], 4)
+
+    def test_answer_not_delayed_by_edit(self):
+        self.queue.debounce = 0.5
+        edit = self.queue.submit(None, 7, 'edit_message_caption', {}, key=('edit', 7, 1), debounce=True)
+        self.queue.submit(None, 7, 'answer_callback_query', {}).result(5)
+        self.assertFalse(edit.done())
+        edit.result(5)
+        self.assertEqual([method for method, _ in self.transport.api.calls],
+                         ['answerCallbackQuery', 'editMessageCaption'])
+
+    def test_not_modified(self):
+        self.transport.send = mock.Mock(side_effect=BadRequest('Message is not modified'))
+        self.assertTrue(self.queue.submit(None, 7, 'edit_message_caption', {}).result(5))
+        self.assertEqual(self.queue.metrics()['failed'], 0)
+
+    def test_sent_callback(self):
+        session = mock.Mock()
+        session.remember_total_message.side_effect = RuntimeError('database is locked')
+        message = self.queue.submit(None, 7, 'send_message', {'chat_id': 7, 'text': 'total'})
+        message.result(5)
+        with mock.patch.object(helpers, 'close_old_connections') as close, self.assertLogs(helpers.LOGGER):
+            helpers.remember_total_message(session, message)
+        self.assertEqual(close.call_count, 2)
+
+
+class LaneTest(SimpleTestCase):
+    """Tasks of one lane run in order, tasks of different lanes in parallel"""
+
+    def setUp(self):
+        self.executor = lanes.LaneExecutor('test', workers=4, capacity=100)
+
+    def test_lane_order(self):
+        done = []
+        for number in range(20):
+            self.executor.submit(1, lambda number=number: (time.sleep(0.001), done.append(number)))
+        self.assertTrue(self.executor.drain(5))
+        self.assertEqual(done, list(range(20)))
+        self.assertEqual(self.executor.metrics()['done'], 20)
+
+    def test_lanes_in_parallel(self):
+        barrier = threading.Barrier(2, timeout=5)
+        self.executor.submit(1, barrier.wait)
+        self.executor.submit(2, barrier.wait)
+        self.assertTrue(self.executor.drain(5))
+        self.assertEqual(self.executor.metrics()['failed'], 0)
+
+    def test_backpressure(self):
+        executor = lanes.LaneExecutor('test', workers=1, capacity=1)
+        release = threading.Event()
+        executor.submit(1, lambda: release.wait(5))
+        self.assertTrue(wait_until(lambda: executor.metrics()['in_flight'] == 1))
+        self.assertTrue(executor.submit(1, lambda: None))
+        self.assertEqual(executor.metrics()['longest_lane'], 1)
+        self.assertFalse(executor.submit(2, lambda: None, timeout=0.01))
+        release.set()
+        self.assertTrue(executor.drain(5))
+        self.assertEqual(executor.metrics()['rejected'], 1)
+
+    def test_chat_lane(self):
+        self.assertEqual(lanes.chat_lane(Update.de_json(message_update(1, 42, '/start'), None)), 42)
+        self.assertIsNone(lanes.chat_lane(RetryAfter(1)))
+
+    def test_drain_sends_replies(self):
+        dispatcher = lanes.LaneDispatcher(Bot(TOKEN), Queue(), lanes.LaneExecutor('test', 2, 10),
+                                          use_context=True)
+        with mock.patch.object(outbound, 'queue') as queue:
+            queue.drain.return_value = True
+            dispatcher.drain()
+        queue.drain.assert_called_once_with(lanes.DRAIN_TIMEOUT)
+
+
+class PartitionTest(SimpleTestCase):
+    """Updates of one chat are sent to one worker in order"""
+
+    def test_partition_by_chat(self):
+        partitions = [Queue(), Queue()]
+        dispatcher = partition.PartitionDispatcher(Bot(TOKEN), Queue(), partitions, use_context=True)
+        for update_id, chat_id in enumerate((1, 2, 3, 1)):
+            dispatcher.process_update(Update.de_json(message_update(update_id, chat_id, str(update_id)), None))
+        chats = [[json.loads(partitions[number].get_nowait())['message']['chat']['id']
+                  for _ in range(partitions[number].qsize())] for number in range(2)]
+        self.assertEqual(chats, [[2], [1, 3, 1]])
+
+    def test_serve_partition(self):
+        handled = []
+        dispatcher = lanes.LaneDispatcher(Bot(TOKEN), Queue(), lanes.LaneExecutor('test', 2, 10),
+                                          use_context=True)
+        dispatcher.add_handler(MessageHandler(Filters.text, lambda update, _: handled.append(
+            (update.effective_chat.id, update.message.text))))
+        updates = Queue()
+        for update_id, chat_id in enumerate((1, 1, 1)):
+            updates.put(json.dumps(message_update(update_id, chat_id, str(update_id))))
+        updates.put(partition.STOP)
+        with mock.patch.object(outbound, 'queue'):
+            partition.serve_partition(updates, dispatcher)
+        self.assertEqual(handled, [(1, '0'), (1, '1'), (1, '2')])
+
+    def test_killed_worker_stops_bot(self):
+        partitions, processes = partition.start_workers(1, [lambda: time.sleep(60)])
+        dispatcher = partition.PartitionDispatcher(Bot(TOKEN), Queue(), partitions, processes, use_context=True)
+        dispatcher.process_update(Update.de_json(message_update(1, 42, '1'), None))
+        processes[0].kill()
+        processes[0].join(5)
+        with mock.patch.object(partition.os, 'kill') as kill, self.assertLogs(partition.LOGGER, 'ERROR') as logs:
+            for update_id in (2, 3):
+                dispatcher.process_update(Update.de_json(message_update(update_id, 42, '2'), None))
+        kill.assert_called_once_with(os.getpid(), partition.signal.SIGTERM)
+        self.assertEqual([record.levelname for record in logs.records], ['CRITICAL', 'ERROR', 'ERROR'])
+
+
+class UnreachableTransport(FakeTransport):
+    """Fake transport that refuses messages to the given chats like Telegram does for blocked bots"""
+
+    def __init__(self, chats):
+        super().__init__()
+        self.chats = chats
+
+    def send(self, bot, method: str, params: dict):
+        if params['chat_id'] in self.chats:
+            raise Unauthorized('Forbidden: bot was blocked by the user')
+        return super().send(bot, method, params)
+
+
+class BroadcastTest(TestCase):
+    """Broadcast reaches every buyer once, resumes after its checkpoint and skips blocked buyers"""
+
+    def setUp(self):
+        for buyer_id in range(1, 8):
+            models.Buyer.objects.create(id=buyer_id, first_name='', last_name='', full_name='', name='',
+                                        language_code='en')
+        self.transport = UnreachableTransport({3})
+
+    def run_broadcast(self, *args) -> str:
+        out = StringIO()
+        with mock.patch.object(outbound, 'BotTransport', return_value=self.transport), \
+                mock.patch.dict(BOTS['client'], API_TOKEN=TOKEN):
+            call_command('broadcast', 'news', '--chunk-size', '2', *args, stdout=out)
+        return out.getvalue()
+
+    def sent_to(self) -> list:
+        return sorted(call['chat_id'] for call in self.transport.api.calls_of('sendMessage'))
+
+    def test_broadcast(self):
+        with self.assertLogs(outbound.LOGGER, 'ERROR'):
+            self.run_broadcast('--text', 'Hello')
+        self.assertEqual(self.sent_to(), [1, 2, 4, 5, 6, 7])
+        broadcast = models.Broadcast.objects.get(name='news')
+        self.assertEqual((broadcast.last_buyer_id, broadcast.sent, broadcast.blocked), (7, 6, 1))
+        self.assertIsNotNone(broadcast.finished)
+        self.assertEqual(list(models.Buyer.objects.filter(blocked=True).values_list('pk', flat=True)), [3])
+
+    def test_resume(self):
+        models.Buyer.objects.filter(pk=5).update(blocked=True)
+        models.Broadcast.objects.create(name='news', text='Hello', last_buyer_id=3)
+        self.assertIn('Resuming news after buyer 3', self.run_broadcast())
+        self.assertEqual(self.sent_to(), [4, 6, 7])
+        self.assertEqual([call['text'] for call in self.transport.api.calls_of('sendMessage')], ['Hello'] * 3)
+        self.assertIn('was finished', self.run_broadcast())
+        self.assertEqual(len(self.sent_to()), 3)
+
+    def test_arguments(self):
+        with self.assertRaises(CommandError):
+            self.run_broadcast('--rate', '100', '--text', 'Hello')
+        with self.assertRaises(CommandError):
+            self.run_broadcast('--rate', '30', '--text', 'Hello')
+        with self.assertRaises(CommandError):
+            self.run_broadcast()
+        models.Broadcast.objects.create(name='news', text='Hello')
+        with self.assertRaises(CommandError):
+            self.run_broadcast('--text', 'Bye')
+
+
+class AddressConversationTest(TestCase):
+    """Address is asked step by step after confirmation, other messages are dropped without queries"""
+
+    def setUp(self):
+        sessions.clear()
+        self.api = FakeBotApi()
+        self.bot = Bot(TOKEN, request=FakeRequest(self.api))
+        queue = outbound.OutboundQueue(FakeTransport(self.api), 1000, 1000, 1000, workers=2)
+        patcher = mock.patch.object(outbound, 'queue', queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.persistence = ConversationPersistence()
+        self.dispatcher = self.build_dispatcher()
+        self.update_ids = iter(range(1, 100))
+        product = models.Product.objects.create(name='Arabica', description='', image='https://example.com/a.jpg')
+        sku = models.StockKeepingUnit.objects.create(
+            product=product, pack=models.Pack.objects.create(unit='g', size=250), price=100)
+        buyer = models.Buyer.objects.create(id=42, full_name='Buyer')
+        models.Cart.objects.create(buyer=buyer).add_sku(sku)
+
+    def build_dispatcher(self) -> Dispatcher:
+        dispatcher = Dispatcher(self.bot, Queue(), workers=0, persistence=self.persistence, use_context=True)
+        register_handlers(dispatcher)
+        return dispatcher
+
+    def send(self, text: str) -> list:
+        """Processes the message and returns texts of replies to it"""
+        before = len(self.api.calls_of('sendMessage'))
+        self.dispatcher.process_update(Update.de_json(message_update(next(self.update_ids), 42, text), self.bot))
+        outbound.queue.drain()
+        return [call['text'] for call in self.api.calls_of('sendMessage')[before:]]
+
+    def stored_states(self) -> list:
+        return list(models.Conversation.objects.values_list('key', 'state'))
+
+    def test_address_steps(self):
+        self.send(CONFIRM_BUTTON)
+        self.assertEqual(self.stored_states(), [])
+        self.persistence.flush()
+        self.assertEqual(self.stored_states(), [('[42, 42]', 'city')])
+        self.send('Kyiv')
+        self.assertEqual(len(self.send('twelve')), 1)
+        self.assertEqual(len(self.send('12')), 2)
+        order = models.Order.objects.get()
+        self.assertEqual((order.city, order.branch_number), ('Kyiv', 12))
+        self.persistence.flush()
+        self.assertEqual(self.stored_states(), [])
+
+    def test_confirm_after_address(self):
+        for text in (CONFIRM_BUTTON, 'Kyiv', '12'):
+            self.send(text)
+        self.assertEqual(self.send(CONFIRM_BUTTON), [templates.cart_is_empty_message()['text']])
+        self.assertEqual(self.send('Lviv'), [])
+
+    def test_messages_outside_steps(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.send('hello'), [])
+        self.assertEqual(len(queries), 0)
+
+    def test_state_survives_restart(self):
+        self.send(CONFIRM_BUTTON)
+        self.send('Kyiv')
+        self.persistence.flush()
+        self.persistence = ConversationPersistence()
+        self.dispatcher = self.build_dispatcher()
+        self.send('7')
+        self.assertEqual(models.Order.objects.get().branch_number, 7)
@@ -0,0 +1 @@
+default_app_config = 'upsale.apps.core.apps.CoreConfig'
@@ -1,9 +1,130 @@
 from django.contrib import admin
-from .models import Buyer, Product, Pack, Cart, Order, StockKeepingUnit
+from .models import Broadcast, Buyer, Product, Pack, Cart, CartItem, DailySales, Order, OrderItem, \
+    StockKeepingUnit
+
+
+class PriceFilter(admin.SimpleListFilter):
+    """Filters products by their lowest price"""
+    title = 'price'
+    parameter_name = 'price'
+    RANGES = {
+        'lt100': ('< 100', 0, 100),
+        '100-300': ('100 - 300', 100, 300),
+        '300-500': ('300 - 500', 300, 500),
+        'gte500': ('500 +', 500, None),
+    }
+
+    def lookups(self, request, model_admin):
+        return [(key, label) for key, (label, _, _) in self.RANGES.items()]
+
+    def queryset(self, request, queryset):
+        if self.value() not in self.RANGES:
+            return queryset
+        _, low, high = self.RANGES[self.value()]
+        queryset = queryset.filter(min_price__gte=low)
+        return queryset.filter(min_price__lt=high) if high is not None else queryset
+
+
+class ProductAdmin(admin.ModelAdmin):
+    list_display = ('name', 'min_price', 'sku_count')
+    list_filter = (PriceFilter,)
+    search_fields = ('name',)
+
+
+class StockKeepingUnitAdmin(admin.ModelAdmin):
+    list_display = ('product', 'pack', 'price')
+    list_select_related = ('product', 'pack')
+    list_filter = ('pack',)
+    search_fields = ('product__name',)
+    autocomplete_fields = ('product',)
+
+
+class ReadOnlyInline(admin.TabularInline):
+    """Lines rendered from one query with their packs and products.
+    Carts are changed by the bot and orders keep prices of checkout, so lines aren't edited here"""
+    extra = 0
+    can_delete = False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('sku__product', 'sku__pack')
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+class CartItemInline(ReadOnlyInline):
+    model = CartItem
+    fields = ('sku', 'quantity')
+
+
+class CartAdmin(admin.ModelAdmin):
+    list_display = ('buyer', 'version')
+    list_select_related = ('buyer',)
+    search_fields = ('buyer__full_name', 'buyer__username')
+    raw_id_fields = ('buyer',)
+    inlines = (CartItemInline,)
+
+
+class OrderItemInline(ReadOnlyInline):
+    model = OrderItem
+    fields = ('sku', 'quantity', 'price', 'total')
+    readonly_fields = ('total',)
+
+    def total(self, item: OrderItem):
+        return item.quantity * item.price
+
+
+def set_status(status: str, label: str):
+    """Returns admin action that moves selected orders to the status in one UPDATE"""
+    def action(model_admin, request, queryset):
+        updated = queryset.set_status(status)
+        model_admin.message_user(request, f'{updated} orders marked as {label}')
+    action.__name__ = f'mark_{status}'
+    action.short_description = f'Mark selected orders as {label}'
+    return action
+
+
+class OrderAdmin(admin.ModelAdmin):
+    list_display = ('id', 'buyer', 'status', 'city', 'branch_number', 'created', 'total')
+    list_select_related = ('buyer',)
+    list_filter = ('status', 'created')
+    search_fields = ('buyer__full_name', 'buyer__phone_number')
+    raw_id_fields = ('buyer',)
+    readonly_fields = ('created', 'total')
+    inlines = (OrderItemInline,)
+    actions = [set_status(status, label) for status, label in Order.STATUS]
+
+
+class DailySalesAdmin(admin.ModelAdmin):
+    list_display = ('day', 'sku', 'city', 'status', 'orders', 'quantity', 'revenue')
+    list_select_related = ('sku__product', 'sku__pack')
+    list_filter = ('status', 'day')
+    search_fields = ('city', 'sku__product__name')
+    date_hierarchy = 'day'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+class BroadcastAdmin(admin.ModelAdmin):
+    list_display = ('name', 'created', 'finished', 'last_buyer_id', 'sent', 'blocked', 'failed')
+    readonly_fields = ('last_buyer_id', 'sent', 'blocked', 'failed', 'created', 'finished')
+
+    def has_add_permission(self, request):
+        return False
+
 
 admin.site.register(Buyer)
-admin.site.register(Product)
+admin.site.register(Product, ProductAdmin)
 admin.site.register(Pack)
-admin.site.register(Cart)
-admin.site.register(Order)
-admin.site.register(StockKeepingUnit)
+admin.site.register(Cart, CartAdmin)
+admin.site.register(Order, OrderAdmin)
+admin.site.register(StockKeepingUnit, StockKeepingUnitAdmin)
+admin.site.register(DailySales, DailySalesAdmin)
+admin.site.register(Broadcast, BroadcastAdmin)
@@ -2,4 +2,8 @@ from django.apps import AppConfig
 
 
 class CoreConfig(AppConfig):
-    name = 'core'
+    name = 'upsale.apps.core'
+    label = 'core'
+
+    def ready(self):
+        from . import signals  # pylint: disable=unused-import,import-outside-toplevel
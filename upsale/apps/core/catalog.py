@@ -0,0 +1,98 @@
+"""
+In-process snapshot of the catalog.
+Products with their stock keeping units and packs are loaded in two queries
+and served from memory until the catalog is changed or the snapshot expires.
+"""
+
+import itertools
+import threading
+import time
+from typing import List
+from django.conf import settings
+from django.db.models import Prefetch
+from .models import Product, StockKeepingUnit
+
+
+class CatalogSnapshot:
+    """Immutable view of all products and stock keeping units.
+    Every snapshot has a new version, products of the snapshot carry it as catalog_version"""
+    versions = itertools.count(1)
+
+    def __init__(self, products: List[Product]):
+        self.version = next(self.versions)
+        self.loaded = time.monotonic()
+        for product in products:
+            product.catalog_version = self.version
+        # Products without skus have no price and nothing to buy, they are left out of the list
+        # but found by id for buttons of messages sent before
+        self.products = [product for product in products if product.stockkeepingunit_set.all()]
+        self.product_by_id = {product.id: product for product in products}
+        self.sku_by_id = {sku.id: sku for product in products
+                          for sku in product.stockkeepingunit_set.all()}
+
+    @classmethod
+    def load(cls) -> 'CatalogSnapshot':
+        """Loads products with prefetched stock keeping units and packs"""
+        skus = StockKeepingUnit.objects.select_related('pack').order_by('id')
+        products = Product.objects.order_by('id') \
+            .prefetch_related(Prefetch('stockkeepingunit_set', queryset=skus))
+        return cls(list(products))
+
+
+class Catalog:
+    """Read-through cache of the catalog snapshot.
+    Snapshot is dropped on catalog changes made in this process and expires after ttl seconds,
+    so changes made by other processes (e.g. admin) become visible too.
+    A missing id reloads the snapshot only if it is older than miss_reload_age seconds,
+    so outdated or forged buttons can't make it reload on every update."""
+
+    def __init__(self, ttl: float, miss_reload_age: float = 0):
+        self.ttl = ttl
+        self.miss_reload_age = miss_reload_age
+        self._snapshot = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> CatalogSnapshot:
+        """Returns actual snapshot, loads it if needed"""
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() < self._expires:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None or time.monotonic() >= self._expires:
+                self._snapshot = CatalogSnapshot.load()
+                self._expires = time.monotonic() + self.ttl
+            return self._snapshot
+
+    def invalidate(self, snapshot: CatalogSnapshot = None):
+        """Drops snapshot, next read loads a new one.
+        With snapshot given it's dropped only if it's still the current one"""
+        with self._lock:
+            if snapshot is None or self._snapshot is snapshot:
+                self._snapshot = None
+
+    def products(self) -> List[Product]:
+        """Returns products that have stock keeping units"""
+        return self.snapshot().products
+
+    def product(self, product_id: int) -> Product:
+        """Returns product by id, raises Product.DoesNotExist if it's absent"""
+        return self._lookup('product_by_id', int(product_id), Product.DoesNotExist)
+
+    def sku(self, sku_id: int) -> StockKeepingUnit:
+        """Returns stock keeping unit by id, raises StockKeepingUnit.DoesNotExist if it's absent"""
+        return self._lookup('sku_by_id', int(sku_id), StockKeepingUnit.DoesNotExist)
+
+    def _lookup(self, index: str, key: int, error: type):
+        snapshot = self.snapshot()
+        item = getattr(snapshot, index).get(key)
+        if item is None and time.monotonic() - snapshot.loaded >= self.miss_reload_age:
+            # It could be created after the snapshot was loaded
+            self.invalidate(snapshot)
+            item = getattr(self.snapshot(), index).get(key)
+        if item is None:
+            raise error(f'{key} is not found in the catalog')
+        return item
+
+
+catalog = Catalog(settings.CATALOG_CACHE_TTL, settings.CATALOG_MISS_RELOAD_AGE)
@@ -0,0 +1,89 @@
+"""
+Removes stale cart items and abandoned orders.
+A cart not changed by its buyer for --cart-days is emptied, an order left without address
+for --order-days is deleted with its lines.
+Rows are removed in batches, each in its own short transaction with a pause after it,
+so the bot never waits long for the database. Run it daily, e.g. from cron.
+"""
+
+import time
+from datetime import timedelta
+from typing import Tuple
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from upsale.apps.core.models import Cart, CartItem, Order, OrderItem
+
+
+def remove_cart_items(items, batch_size: int, pause: float) -> int:
+    """Deletes the cart items in batches and bumps versions of their carts.
+    Items of carts changed since they were selected are kept. Returns number of removed items"""
+    removed = 0
+    while True:
+        batch = list(items.values_list('pk', 'cart_id')[:batch_size])
+        if not batch:
+            return removed
+        with transaction.atomic():
+            deleted, _ = items.filter(pk__in=[pk for pk, _ in batch]).delete()
+            Cart.objects.filter(pk__in={cart_id for _, cart_id in batch}, cartitem__isnull=True) \
+                .update(version=F('version') + 1)
+        removed += deleted
+        time.sleep(pause)
+
+
+def remove_orders(orders, batch_size: int, pause: float) -> Tuple[int, int]:
+    """Deletes the orders with their lines in batches. Returns numbers of removed orders and lines"""
+    removed, lines = 0, 0
+    while True:
+        ids = list(orders.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return removed, lines
+        with transaction.atomic():
+            _, deleted = orders.filter(pk__in=ids).delete()
+        removed += deleted.get(Order._meta.label, 0)
+        lines += deleted.get(OrderItem._meta.label, 0)
+        time.sleep(pause)
+
+
+class Command(BaseCommand):
+    """Reports removed rows and time of every step"""
+    help = 'Empties stale carts and deletes abandoned orders in small transactions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cart-days', type=int, default=30,
+                            help='Empty carts not changed for the days')
+        parser.add_argument('--order-days', type=int, default=7,
+                            help='Delete orders left without address for the days')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per transaction')
+        parser.add_argument('--pause', type=float, default=0.05,
+                            help='Seconds between transactions that let the bot write')
+        parser.add_argument('--dry-run', action='store_true', help='Report rows without removing them')
+
+    def handle(self, *args, **options):
+        if options['cart_days'] < 1 or options['order_days'] < 1 or options['batch_size'] < 1:
+            raise CommandError('Days and batch size must be positive')
+        stale = timezone.now() - timedelta(days=options['cart_days'])
+        items = CartItem.objects.filter(cart__updated__lt=stale)
+        orders = Order.objects.without_address().filter(
+            created__lt=timezone.localdate() - timedelta(days=options['order_days']))
+
+        started = time.perf_counter()
+        if options['dry_run']:
+            counts = {'cart items': items.count(), 'orders': orders.count(),
+                      'order lines': OrderItem.objects.filter(order__in=orders.values('pk')).count()}
+            emptied = finished = time.perf_counter()
+        else:
+            counts = {'cart items': remove_cart_items(items, options['batch_size'], options['pause'])}
+            emptied = time.perf_counter()
+            counts['orders'], counts['order lines'] = remove_orders(orders, options['batch_size'],
+                                                                    options['pause'])
+            finished = time.perf_counter()
+
+        for name, count in counts.items():
+            self.stdout.write(f'{name:<18}{count:>8}')
+        if options['dry_run']:
+            self.stdout.write(f'counted in {finished - started:.2f}s, nothing removed (dry run)')
+        else:
+            self.stdout.write(f'carts emptied in {emptied - started:.2f}s, '
+                              f'orders deleted in {finished - emptied:.2f}s')
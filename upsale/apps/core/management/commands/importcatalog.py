@@ -0,0 +1,190 @@
+"""
+Imports catalog from a CSV, JSON or JSON Lines feed.
+Every row of the feed is a pack of a product with columns name, description, image, unit, size, price.
+Products are matched by name, packs by unit and size, the feed is compared with the catalog
+and only the difference is written with batched queries in one transaction.
+Skus that were ever ordered are never pruned, order history keeps its lines.
+"""
+
+import csv
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Dict, Iterator, List, Tuple
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+from upsale.apps.core.catalog import catalog
+from upsale.apps.core.models import Cart, OrderItem, Pack, Product, StockKeepingUnit
+from upsale.apps.core.signals import sku_summary_deferred
+
+FORMATS = ('csv', 'json', 'jsonl')
+# Ids in one UPDATE or DELETE, below the limit of query parameters of SQLite
+IDS_BATCH_SIZE = 500
+
+
+def read_feed(path: str, kind: str) -> Iterator[Tuple[int, dict]]:
+    """Yields number and content of every row of the feed"""
+    with open(path, newline='', encoding='utf-8') as feed:
+        if kind == 'csv':
+            rows = csv.DictReader(feed)
+        elif kind == 'json':
+            rows = json.load(feed)
+            if not isinstance(rows, list):
+                raise CommandError('JSON feed must be an array of rows')
+        else:
+            rows = (json.loads(line) for line in feed if line.strip())
+        yield from enumerate(rows, 1)
+
+
+def parse(number: int, row: dict) -> dict:
+    try:
+        return {'name': row['name'].strip(), 'description': row.get('description') or '',
+                'image': row['image'].strip(), 'unit': row['unit'].strip(), 'size': int(row['size']),
+                'price': float(row['price'])}
+    except (KeyError, AttributeError, TypeError, ValueError) as error:
+        raise CommandError(f'Row {number} is invalid: {error!r}')
+
+
+class Plan:
+    """Changes that make the catalog equal to the feed"""
+
+    def __init__(self):
+        self.packs = []
+        self.products = []
+        self.changed_products = []
+        self.skus = []
+        self.prices = []
+        self.pruned_skus = []
+        self.pruned_products = []
+        # Missing in the feed but kept because they were ordered
+        self.kept_skus = []
+        self.kept_products = []
+
+    def counts(self) -> Dict[str, int]:
+        return {name: len(changes) for name, changes in vars(self).items()}
+
+    def is_empty(self) -> bool:
+        return not any(count for name, count in self.counts().items() if not name.startswith('kept'))
+
+
+def diff(rows: Iterator[Tuple[int, dict]], prune: bool) -> Plan:
+    """Compares the feed with the catalog, the first row of a product gives its description and image"""
+    products, skus = {}, {}
+    for number, row in rows:
+        row = parse(number, row)
+        products.setdefault(row['name'], (row['description'], row['image']))
+        skus[row['name'], row['unit'], row['size']] = row['price']
+
+    current_products = {product.name: product for product in
+                        Product.objects.only('name', 'description', 'image', 'image_file_id').order_by('-id')}
+    names = {product.pk: name for name, product in current_products.items()}
+    current_packs = set(Pack.objects.values_list('unit', 'size'))
+    current_skus = {(names[product_id], unit, size): StockKeepingUnit(pk=pk, price=price)
+                    for pk, product_id, unit, size, price in StockKeepingUnit.objects.values_list(
+                        'pk', 'product_id', 'pack__unit', 'pack__size', 'price')
+                    if product_id in names}
+
+    plan = Plan()
+    plan.packs = sorted({(unit, size) for _, unit, size in skus} - current_packs)
+    for name, (description, image) in products.items():
+        product = current_products.get(name)
+        if product is None:
+            plan.products.append(Product(name=name, description=description, image=image))
+        elif (product.description, product.image) != (description, image):
+            if product.image != image:
+                product.image_file_id = None
+            product.description, product.image = description, image
+            plan.changed_products.append(product)
+    for key, price in skus.items():
+        sku = current_skus.get(key)
+        if sku is None:
+            plan.skus.append((*key, price))
+        elif sku.price != price:
+            sku.price = price
+            plan.prices.append(sku)
+    if prune:
+        ordered = set(OrderItem.objects.order_by().values_list('sku_id', flat=True).distinct())
+        kept_names = set()
+        for key, sku in current_skus.items():
+            if key in skus:
+                continue
+            if sku.pk in ordered:
+                plan.kept_skus.append(sku.pk)
+                kept_names.add(key[0])
+            else:
+                plan.pruned_skus.append(sku.pk)
+        for name, product in current_products.items():
+            if name not in products:
+                (plan.kept_products if name in kept_names else plan.pruned_products).append(product.pk)
+    return plan
+
+
+def update_prices(skus: List[StockKeepingUnit], batch_size: int):
+    """Sets prices with an UPDATE per price and batch of ids.
+    Feeds have far fewer prices than packs and such queries are much cheaper to build than bulk_update"""
+    ids = defaultdict(list)
+    for sku in skus:
+        ids[sku.price].append(sku.pk)
+    for price, price_ids in ids.items():
+        for start in range(0, len(price_ids), batch_size):
+            StockKeepingUnit.objects.filter(pk__in=price_ids[start:start + batch_size]).update(price=price)
+
+
+def apply(plan: Plan, batch_size: int = None):
+    """Writes the plan, summary of products is updated once at the end"""
+    ids_batch_size = batch_size or IDS_BATCH_SIZE
+    with transaction.atomic(), sku_summary_deferred():
+        Pack.objects.bulk_create([Pack(unit=unit, size=size) for unit, size in plan.packs], batch_size)
+        Product.objects.bulk_create(plan.products, batch_size)
+        Product.objects.bulk_update(plan.changed_products, ['description', 'image', 'image_file_id'],
+                                    batch_size)
+        packs = {(unit, size): pk for pk, unit, size in Pack.objects.values_list('pk', 'unit', 'size')}
+        products = dict(Product.objects.order_by('-id').values_list('name', 'pk'))
+        StockKeepingUnit.objects.bulk_create([
+            StockKeepingUnit(product_id=products[name], pack_id=packs[unit, size], price=price)
+            for name, unit, size, price in plan.skus], batch_size)
+        update_prices(plan.prices, ids_batch_size)
+        for start in range(0, len(plan.pruned_skus), ids_batch_size):
+            pruned = plan.pruned_skus[start:start + ids_batch_size]
+            Cart.objects.filter(cartitem__sku__in=pruned).update(version=F('version') + 1)
+            StockKeepingUnit.objects.filter(pk__in=pruned).delete()
+        for start in range(0, len(plan.pruned_products), ids_batch_size):
+            Product.objects.filter(pk__in=plan.pruned_products[start:start + ids_batch_size]).delete()
+        Product.objects.update_sku_summary()
+    catalog.invalidate()
+
+
+class Command(BaseCommand):
+    """Synchronizes catalog with the feed and reports changes and time of every step"""
+    help = 'Imports products, packs and prices from a CSV, JSON array or JSON Lines feed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('feed', help='Path to the feed')
+        parser.add_argument('--format', choices=FORMATS,
+                            help='Format of the feed, taken from the file extension by default')
+        parser.add_argument('--dry-run', action='store_true', help='Report changes without writing them')
+        parser.add_argument('--prune', action='store_true',
+                            help='Delete skus and products missing in the feed with their cart lines, '
+                                 'ordered ones are kept and reported')
+        parser.add_argument('--batch-size', type=int,
+                            help='Rows per query, the most the database accepts by default')
+
+    def handle(self, *args, **options):
+        kind = options['format'] or os.path.splitext(options['feed'])[1].lstrip('.').lower()
+        if kind not in FORMATS:
+            raise CommandError(f'Unknown feed format {kind!r}, use --format')
+
+        started = time.perf_counter()
+        plan = diff(read_feed(options['feed'], kind), options['prune'])
+        compared = time.perf_counter()
+        if not options['dry_run'] and not plan.is_empty():
+            apply(plan, options['batch_size'])
+        finished = time.perf_counter()
+
+        for name, count in plan.counts().items():
+            self.stdout.write(f'{name.replace("_", " "):<18}{count:>8}')
+        self.stdout.write(f'compared in {compared - started:.2f}s, '
+                          + ('nothing written (dry run)' if options['dry_run'] else
+                             f'written in {finished - compared:.2f}s'))
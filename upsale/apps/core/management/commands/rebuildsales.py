@@ -0,0 +1,40 @@
+"""
+Rebuilds daily sales from confirmed orders.
+Use it to backfill the rollup or to repair it after orders were changed bypassing signals.
+"""
+
+import time
+from datetime import date
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from upsale.apps.core.models import DailySales, Order
+
+
+class Command(BaseCommand):
+    """Replaces rows of daily sales with sums of order lines in one transaction"""
+    help = 'Rebuilds daily sales from confirmed orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=date.fromisoformat,
+                            help='Rebuild only days since the date, YYYY-MM-DD')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        sales, orders = DailySales.objects.all(), Order.objects.all()
+        if options['since']:
+            sales = sales.filter(day__gte=options['since'])
+            orders = orders.filter(created__gte=options['since'])
+
+        created, batch = 0, []
+        with transaction.atomic():
+            deleted, _ = sales.delete()
+            for row in DailySales.objects.summarize(orders):
+                batch.append(DailySales(**row))
+                if len(batch) >= options['batch_size']:
+                    created += len(DailySales.objects.bulk_create(batch))
+                    batch = []
+            created += len(DailySales.objects.bulk_create(batch))
+
+        self.stdout.write(f'Replaced {deleted} rows with {created} rows '
+                          f'in {time.perf_counter() - started:.2f}s')
@@ -0,0 +1,142 @@
+"""
+Stress test of the storage profile.
+Bot and admin writers run in parallel threads against a throwaway copy of the configured database,
+every operation that fails with "database is locked" is counted.
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, OperationalError
+from upsale.apps.core import models
+
+PRODUCTS = 20
+
+
+class Stats:
+    """Latencies and errors of operations of one kind of writer"""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def measure(self, operation):
+        """Runs the operation, records its time or the error"""
+        started = time.perf_counter()
+        try:
+            operation()
+        except OperationalError as error:
+            with self._lock:
+                self.errors.append(str(error))
+        else:
+            with self._lock:
+                self.latencies.append(time.perf_counter() - started)
+
+    def p95(self) -> float:
+        latencies = sorted(self.latencies)
+        return latencies[int(len(latencies) * 0.95)] if latencies else 0
+
+
+def bot_writer(number: int, deadline: float, stats: Stats):
+    """Does what handlers do: changes the cart and places orders"""
+    randomizer = random.Random(number)
+    cart = models.Cart.objects.get(buyer=number)
+    skus = list(models.StockKeepingUnit.objects.all())
+    while time.monotonic() < deadline:
+        sku = randomizer.choice(skus)
+        stats.measure(lambda: cart.add_sku(sku))
+        stats.measure(lambda: cart.remove_sku(randomizer.choice(skus)))
+        stats.measure(lambda: models.Cart.objects.filter(pk=number).update(
+            total_message_id=randomizer.randrange(1, 10000)))
+        if randomizer.random() < 0.1:
+            stats.measure(cart.checkout)
+
+
+def admin_writer(number: int, deadline: float, stats: Stats):
+    """Does what admin pages do: edits products and changes status of orders"""
+    randomizer = random.Random(-number)
+
+    def edit_product():
+        product = models.Product.objects.get(pk=randomizer.choice(product_ids))
+        product.description = f'Edited by admin {number} at {time.time()}'
+        product.save()
+
+    def process_orders():
+        list(models.Order.objects.select_related('buyer').order_by('-id')[:100])
+        models.Order.objects.filter(status='new').update(status='in_progress')
+
+    product_ids = list(models.Product.objects.values_list('id', flat=True))
+    while time.monotonic() < deadline:
+        stats.measure(edit_product)
+        stats.measure(process_orders)
+
+
+def populate(bot_writers: int):
+    """Creates catalog and a buyer with a cart for every bot writer"""
+    pack = models.Pack.objects.create(unit='g', size=250)
+    for number in range(PRODUCTS):
+        product = models.Product.objects.create(
+            name=f'Coffee {number}', description='', image=f'https://example.com/{number}.jpg')
+        models.StockKeepingUnit.objects.create(product=product, pack=pack, price=100 + number)
+    for number in range(1, bot_writers + 1):
+        buyer = models.Buyer.objects.create(id=number, full_name=f'Buyer {number}')
+        models.Cart.objects.create(buyer=buyer)
+
+
+def run_writer(writer, number: int, deadline: float, stats: Stats):
+    try:
+        writer(number, deadline, stats)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    """Runs writers in parallel and reports their latency and lock errors"""
+    help = 'Stress tests concurrent bot and admin writes to a throwaway database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=10)
+        parser.add_argument('--bot-writers', type=int, default=8)
+        parser.add_argument('--admin-writers', type=int, default=2)
+
+    def handle(self, *args, **options):
+        database = connection.settings_dict['NAME']
+        directory = tempfile.mkdtemp()
+        if connection.vendor == 'sqlite':
+            connection.settings_dict['TEST']['NAME'] = os.path.join(directory, 'stress.sqlite3')
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            populate(options['bot_writers'])
+            results = self.stress(options['seconds'], options['bot_writers'], options['admin_writers'])
+        finally:
+            connection.creation.destroy_test_db(database, verbosity=0)
+            shutil.rmtree(directory, ignore_errors=True)
+
+        self.stdout.write(f'{"writer":<8}{"ops":>8}{"ops/s":>10}{"p95 ms":>10}{"errors":>8}')
+        for kind, stats in results.items():
+            self.stdout.write(f'{kind:<8}{len(stats.latencies):>8}'
+                              f'{len(stats.latencies) / options["seconds"]:>10.1f}'
+                              f'{stats.p95() * 1000:>10.2f}{len(stats.errors):>8}')
+        errors = [error for stats in results.values() for error in stats.errors]
+        if errors:
+            raise CommandError(f'{len(errors)} operations failed, e.g. {errors[0]}')
+        self.stdout.write(self.style.SUCCESS('No operation failed'))
+
+    @staticmethod
+    def stress(seconds: float, bot_writers: int, admin_writers: int) -> dict:
+        deadline = time.monotonic() + seconds
+        results = {'bot': Stats(), 'admin': Stats()}
+        threads = [threading.Thread(target=run_writer, args=(bot_writer, number, deadline, results['bot']))
+                   for number in range(1, bot_writers + 1)]
+        threads += [threading.Thread(target=run_writer, args=(admin_writer, number, deadline, results['admin']))
+                    for number in range(1, admin_writers + 1)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
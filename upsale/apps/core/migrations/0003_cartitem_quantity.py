@@ -0,0 +1,44 @@
+# Generated by Django 3.0.7 on 2026-10-18 02:43
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def fold_cart_items(apps, schema_editor):
+    """Merges rows of the same pack in a cart into one row with quantity"""
+    CartItem = apps.get_model('core', 'CartItem')
+    duplicates = CartItem.objects.values('cart_id', 'sku_id') \
+        .annotate(count=Count('id'), keep=Min('id')).filter(count__gt=1)
+    for group in duplicates:
+        CartItem.objects.filter(pk=group['keep']).update(quantity=group['count'])
+        CartItem.objects.filter(cart_id=group['cart_id'], sku_id=group['sku_id']) \
+            .exclude(pk=group['keep']).delete()
+
+
+def unfold_cart_items(apps, schema_editor):
+    """Splits cart items back to one row per pack"""
+    CartItem = apps.get_model('core', 'CartItem')
+    for item in CartItem.objects.filter(quantity__gt=1):
+        CartItem.objects.bulk_create(
+            [CartItem(cart_id=item.cart_id, sku_id=item.sku_id) for _ in range(item.quantity - 1)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_auto_20200608_1403'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cartitem',
+            name='quantity',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='quantity',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.RunPython(fold_cart_items, unfold_cart_items),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 3.0.7 on 2026-10-18 03:09
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_prices(apps, schema_editor):
+    """Takes current prices of packs for lines of orders placed before prices were kept"""
+    OrderItem = apps.get_model('core', 'OrderItem')
+    StockKeepingUnit = apps.get_model('core', 'StockKeepingUnit')
+    OrderItem.objects.update(price=Subquery(
+        StockKeepingUnit.objects.filter(pk=OuterRef('sku_id')).values('price')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_cart_order_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='cart_version',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='price',
+            field=models.FloatField(null=True),
+        ),
+        migrations.RunPython(fill_prices, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='price',
+            field=models.FloatField(),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(fields=('buyer', 'cart_version'), name='order_buyer_cart_version'),
+        ),
+    ]
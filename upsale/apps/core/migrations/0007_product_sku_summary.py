@@ -0,0 +1,36 @@
+# Generated by Django 3.0.7 on 2026-10-18 03:15
+
+from django.db import migrations, models
+from django.db.models import Count, Min, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_sku_summary(apps, schema_editor):
+    """Calculates min price and count of skus of existing products"""
+    Product = apps.get_model('core', 'Product')
+    StockKeepingUnit = apps.get_model('core', 'StockKeepingUnit')
+    skus = StockKeepingUnit.objects.filter(product=OuterRef('pk')).order_by().values('product')
+    Product.objects.update(
+        min_price=Subquery(skus.annotate(value=Min('price')).values('value')),
+        sku_count=Coalesce(Subquery(skus.annotate(value=Count('id')).values('value')), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_checkout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='min_price',
+            field=models.FloatField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='sku_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_sku_summary, migrations.RunPython.noop),
+    ]
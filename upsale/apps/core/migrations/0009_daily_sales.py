@@ -0,0 +1,58 @@
+# Generated by Django 3.0.7 on 2026-10-18 03:30
+
+from django.db import migrations, models
+from django.db.models import F, FloatField, OuterRef, Subquery, Sum
+import django.db.models.deletion
+
+
+def fill_totals(apps, schema_editor):
+    """Sums lines of orders placed before totals were kept"""
+    Order = apps.get_model('core', 'Order')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    lines = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+    Order.objects.update(total=Subquery(lines.annotate(
+        value=Sum(F('price') * F('quantity'), output_field=FloatField())).values('value')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_order_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='total',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.RunPython(fill_totals, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('city', models.CharField(max_length=50)),
+                ('status', models.CharField(choices=[('new', 'new'), ('in_progress', 'in progress'), ('done', 'done')], max_length=32)),
+                ('orders', models.IntegerField(default=0)),
+                ('quantity', models.IntegerField(default=0)),
+                ('revenue', models.FloatField(default=0)),
+                ('sku', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='core.StockKeepingUnit')),
+            ],
+            options={
+                'verbose_name_plural': 'daily sales',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='dailysales',
+            index=models.Index(fields=['sku', 'day'], name='dailysales_sku_day'),
+        ),
+        migrations.AddIndex(
+            model_name='dailysales',
+            index=models.Index(fields=['city', 'day'], name='dailysales_city_day'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailysales',
+            constraint=models.UniqueConstraint(fields=('day', 'sku', 'city', 'status'), name='dailysales_key'),
+        ),
+    ]
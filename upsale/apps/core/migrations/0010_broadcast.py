@@ -0,0 +1,32 @@
+# Generated by Django 3.0.7 on 2026-10-18 03:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_daily_sales'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('text', models.TextField()),
+                ('last_buyer_id', models.BigIntegerField(default=0)),
+                ('sent', models.IntegerField(default=0)),
+                ('blocked', models.IntegerField(default=0)),
+                ('failed', models.IntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='buyer',
+            name='blocked',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.0.7 on 2026-10-18 03:42
+
+from django.db import migrations, models
+from django.db.models.functions import Now
+
+
+def start_clock(apps, schema_editor):
+    """Carts with items count as changed at the migration, so cleanup gives them full time"""
+    Cart = apps.get_model('core', 'Cart')
+    Cart.objects.filter(cartitem__isnull=False).update(updated=Now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_broadcast'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='updated',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['updated'], name='cart_updated'),
+        ),
+        migrations.RunPython(start_clock, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.0.7 on 2026-10-18 03:45
+
+import json
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def resume_address_steps(apps, schema_editor):
+    """Buyers with an order without address were asked for it by the bot,
+    they continue from the step the order stopped at. Chat and user are the same in private chats"""
+    Order = apps.get_model('core', 'Order')
+    Conversation = apps.get_model('core', 'Conversation')
+    steps = {}
+    for buyer_id, city in Order.objects.filter(Q(city__isnull=True) | Q(branch_number__isnull=True)) \
+            .order_by('id').values_list('buyer_id', 'city'):
+        steps[buyer_id] = 'city' if city is None else 'branch_number'
+    Conversation.objects.bulk_create(
+        Conversation(name='address', key=json.dumps([buyer_id, buyer_id]), state=state)
+        for buyer_id, state in steps.items())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_cart_updated'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('key', models.CharField(max_length=100)),
+                ('state', models.CharField(max_length=50)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(fields=('name', 'key'), name='conversation_name_key'),
+        ),
+        migrations.RunPython(resume_address_steps, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.0.7 on 2026-10-18 03:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_conversation'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='orderitem',
+            name='sku',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='core.StockKeepingUnit'),
+        ),
+    ]
@@ -1,8 +1,9 @@
 """
 List of models that are used for telegram bot and admin panel
 """
-from functools import reduce
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Count, F, FloatField, Min, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce, Now
 
 
 class Buyer(models.Model):
@@ -17,26 +18,58 @@ class Buyer(models.Model):
     link = models.URLField(max_length=200, null=True)
     is_bot = models.BooleanField(default=False)
     phone_number = models.CharField(max_length=15, null=True)
+    # Set when Telegram refuses messages to the buyer, cleared when the buyer starts the bot again
+    blocked = models.BooleanField(default=False)
 
     def __str__(self):
         return self.full_name
 
 
+class ProductQuerySet(models.QuerySet):
+    """Queries of products with the summary of their stock keeping units"""
+
+    def with_sku_summary(self):
+        """Annotates products with actual_min_price and actual_sku_count computed from their skus"""
+        return self.annotate(actual_min_price=Min('stockkeepingunit__price'),
+                             actual_sku_count=Count('stockkeepingunit'))
+
+    def update_sku_summary(self) -> int:
+        """Stores min price and count of skus of the products in one query.
+        Call it after bulk changes of skus, they don't send signals"""
+        skus = StockKeepingUnit.objects.filter(product=OuterRef('pk')).order_by().values('product')
+        return self.update(
+            min_price=Subquery(skus.annotate(value=Min('price')).values('value')),
+            sku_count=Coalesce(Subquery(skus.annotate(value=Count('id')).values('value')), 0))
+
+
 class Product(models.Model):
-    """Describes product that could be added to the shop"""
+    """Describes product that could be added to the shop.
+    Min price and count of skus are kept in sync by signals of StockKeepingUnit"""
 
     name = models.CharField(max_length=500)
     description = models.TextField()
     image = models.URLField(max_length=500)
+    image_file_id = models.CharField(max_length=200, null=True, blank=True, editable=False)
+    min_price = models.FloatField(null=True, editable=False, db_index=True)
+    sku_count = models.PositiveIntegerField(default=0, editable=False)
 
-    def __min_price(self):
-        return self.stockkeepingunit_set.order_by('price')[0].price
+    objects = ProductQuerySet.as_manager()
 
     def short_caption(self):
-        return f'☕️ {self.name}\n💵 Цена: {self.__min_price()}'
+        price = 'нет в наличии' if self.min_price is None else self.min_price
+        return f'☕️ {self.name}\n💵 Цена: {price}'
 
     def long_caption(self):
-        return f'☕️ {self.name}\n💵 Цена: {self.__min_price()}\n\n{self.description}'
+        return f'{self.short_caption()}\n\n{self.description}'
+
+    def photo(self) -> str:
+        """Returns telegram file id of the image if it was uploaded before, otherwise its url"""
+        return self.image_file_id or self.image
+
+    def remember_photo(self, file_id: str):
+        """Saves telegram file id of the uploaded image unless the image was changed meanwhile"""
+        Product.objects.filter(pk=self.pk, image=self.image).update(image_file_id=file_id)
+        self.image_file_id = file_id
 
     def __str__(self):
         return self.name
@@ -64,38 +97,123 @@ class StockKeepingUnit(models.Model):
 
 
 class Cart(models.Model):
-    """Describes cart that is used by Bayer for keeping stock units"""
+    """Describes cart that is used by Bayer for keeping stock units.
+    Version grows and updated is set on every change of the content by the buyer,
+    code that changes items directly must call bump_version"""
 
     buyer = models.OneToOneField(Buyer, on_delete=models.CASCADE, primary_key=True)
     items = models.ManyToManyField(StockKeepingUnit, through='CartItem')
     total_message_id = models.BigIntegerField(default=0)
+    version = models.PositiveIntegerField(default=0, editable=False)
+    updated = models.DateTimeField(null=True, editable=False)
+
+    class Meta:
+        indexes = [models.Index(fields=['updated'], name='cart_updated')]
 
     def __str__(self):
         return f'{self.buyer.full_name}'
 
-    def contains(self, sku: StockKeepingUnit) -> bool:
-        """Returns True if cart already contains pack"""
-        return self.items.filter(id=sku.id).exists()
-
-    def is_empty(self):
-        """Returns True if no item present in the cart"""
-        return not self.items.exists()
-
-    def get_total_price(self):
-        """Return the sum of prices of all items in the cart"""
-        return reduce(lambda price, item: price + item.price, self.items.all(), 0)
-
-    def add_sku(self, sku: StockKeepingUnit):
-        """Creates CartItem with passed pack"""
-        CartItem(cart=self, sku=sku).save()
-
-    def clear_sku(self, sku: StockKeepingUnit):
-        """Removes pack from the cart"""
-        CartItem.objects.filter(sku=sku).delete()
-
-    def remove_sku(self, sku: StockKeepingUnit):
-        """Decrease count for specific pack"""
-        CartItem.objects.filter(sku=sku)[0].delete()
+    def bump_version(self) -> bool:
+        """Marks content of the cart as changed.
+        Returns False if it was changed by someone else since the instance was loaded"""
+        carts = Cart.objects.filter(pk=self.pk)
+        changes = {'version': F('version') + 1, 'updated': Now()}
+        current = bool(carts.filter(version=self.version).update(**changes))
+        if current:
+            self.version += 1
+        else:
+            carts.update(**changes)
+        return current
+
+    def add_sku(self, sku: StockKeepingUnit) -> bool:
+        """Increase count for specific pack or creates CartItem with it.
+        Returns False if the cart was changed by someone else since the instance was loaded"""
+        with transaction.atomic():
+            current = self.bump_version()
+            if not self.cartitem_set.filter(sku=sku).update(quantity=F('quantity') + 1):
+                CartItem(cart=self, sku=sku).save()
+        return current
+
+    def clear_sku(self, sku: StockKeepingUnit) -> bool:
+        """Removes pack from the cart.
+        Returns False if the cart was changed by someone else since the instance was loaded"""
+        with transaction.atomic():
+            current = self.bump_version()
+            self.cartitem_set.filter(sku=sku).delete()
+        return current
+
+    def remove_sku(self, sku: StockKeepingUnit) -> bool:
+        """Decrease count for specific pack.
+        Returns False if the cart was changed by someone else since the instance was loaded"""
+        with transaction.atomic():
+            current = self.bump_version()
+            items = self.cartitem_set.filter(sku=sku)
+            if not items.filter(quantity__gt=1).update(quantity=F('quantity') - 1):
+                items.delete()
+        return current
+
+    def clear(self) -> bool:
+        """Removes all packs from the cart.
+        Returns False if the cart was changed by someone else since the instance was loaded"""
+        with transaction.atomic():
+            current = self.bump_version()
+            self.cartitem_set.all().delete()
+        return current
+
+    def remember_total_message(self, message_id: int):
+        """Saves id of the message with total price of the cart"""
+        Cart.objects.filter(pk=self.pk).update(total_message_id=message_id)
+        self.total_message_id = message_id
+
+    def checkout(self):
+        """Turns content of the cart into an order with prices at the moment of purchase
+        in a constant number of queries. Returns the order or None if the cart is empty.
+        Repeated checkout finds the cart emptied by the order of the previous version
+        and returns that order while it waits for address, so repeated confirmations
+        don't create duplicates. A concurrent checkout of the same version returns its order
+        the same way"""
+        version = None
+        try:
+            with transaction.atomic():
+                cart = Cart.objects.select_for_update().get(pk=self.pk)
+                self.version = version = cart.version
+                lines = list(cart.cartitem_set.select_related('sku'))
+                if not lines:
+                    return Order.objects.without_address() \
+                        .filter(buyer_id=self.pk, cart_version=version - 1).first()
+                total = sum(line.sku.price * line.quantity for line in lines)
+                order = Order.objects.create(buyer_id=self.pk, cart_version=version, total=total)
+                OrderItem.objects.bulk_create(
+                    OrderItem(order=order, sku_id=line.sku_id, quantity=line.quantity,
+                              price=line.sku.price)
+                    for line in lines)
+                cart.cartitem_set.all().delete()
+                self.bump_version()
+                return order
+        except IntegrityError:
+            return Order.objects.without_address().filter(buyer_id=self.pk, cart_version=version).first()
+
+
+class OrderQuerySet(models.QuerySet):
+    """Queries of orders that keep daily sales in sync"""
+
+    def confirmed(self):
+        """Returns orders with delivery address, only they are counted in sales"""
+        return self.filter(city__isnull=False, branch_number__isnull=False)
+
+    def without_address(self):
+        """Returns orders which buyers haven't finished the address steps"""
+        return self.filter(Q(city__isnull=True) | Q(branch_number__isnull=True))
+
+    def set_status(self, status: str) -> int:
+        """Moves orders to the status in one UPDATE and their sales to rows of the status.
+        Returns number of changed orders"""
+        with transaction.atomic():
+            changed = Order.objects.filter(pk__in=self.values('pk')).exclude(status=status)
+            sales = list(DailySales.objects.summarize(changed))
+            DailySales.objects.apply(sales, -1)
+            DailySales.objects.apply({**row, 'status': status} for row in sales)
+            return changed.update(status=status)
 
 
 class Order(models.Model):
@@ -112,17 +230,131 @@ class Order(models.Model):
     branch_number = models.IntegerField(null=True)
     created = models.DateField(auto_now_add=True)
     items = models.ManyToManyField(StockKeepingUnit, through='OrderItem')
+    cart_version = models.PositiveIntegerField(null=True, editable=False)
+    total = models.FloatField(null=True, editable=False)
+
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['buyer', 'id'], name='order_missing_address',
+                         condition=Q(city__isnull=True) | Q(branch_number__isnull=True)),
+            models.Index(fields=['status'], name='order_status'),
+            models.Index(fields=['created'], name='order_created'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['buyer', 'cart_version'], name='order_buyer_cart_version'),
+        ]
 
     def __str__(self):
         return f'[{self.status}] {self.buyer.full_name} - {self.created}'
 
 class OrderItem(models.Model):
     """Used for many to many relationship"""
-    order = models.ForeignKey(Order, on_delete=models.CASCADE)
-    sku = models.ForeignKey(StockKeepingUnit, on_delete=models.CASCADE)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, db_index=False)
+    # Order history outlives the catalog, ordered skus can't be deleted
+    sku = models.ForeignKey(StockKeepingUnit, on_delete=models.PROTECT)
+    quantity = models.PositiveIntegerField(default=1)
+    price = models.FloatField()
+
+    class Meta:
+        indexes = [models.Index(fields=['order', 'sku'], name='orderitem_order_sku')]
 
 class CartItem(models.Model):
     """Used for many to many relationship"""
     
-    cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, db_index=False)
     sku = models.ForeignKey(StockKeepingUnit, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['cart', 'sku'], name='cartitem_cart_sku')]
+
+
+class DailySalesQuerySet(models.QuerySet):
+    """Queries of daily sales"""
+    KEY = ('day', 'sku_id', 'city', 'status')
+
+    @staticmethod
+    def summarize(orders):
+        """Yields sales of confirmed orders grouped by day, pack, city and status"""
+        lines = OrderItem.objects.filter(order__in=orders.confirmed().values('pk')).order_by() \
+            .values_list('order__created', 'sku_id', 'order__city', 'order__status') \
+            .annotate(order_count=Count('order', distinct=True), units=Sum('quantity'),
+                      amount=Sum(F('quantity') * F('price'), output_field=FloatField()))
+        for day, sku_id, city, status, orders_count, quantity, revenue in lines.iterator():
+            yield {'day': day, 'sku_id': sku_id, 'city': city, 'status': status,
+                   'orders': orders_count, 'quantity': quantity, 'revenue': revenue}
+
+    def apply(self, sales, sign: int = 1):
+        """Adds sales to their rows or subtracts them with sign -1, missing rows are created"""
+        for row in sales:
+            key = {name: row[name] for name in self.KEY}
+            changes = {name: F(name) + sign * row[name] for name in ('orders', 'quantity', 'revenue')}
+            if self.filter(**key).update(**changes) or sign < 0:
+                continue
+            try:
+                with transaction.atomic():
+                    self.create(**row)
+            except IntegrityError:
+                self.filter(**key).update(**changes)
+
+
+class DailySales(models.Model):
+    """Sales of a pack in a city for a day of orders with the status.
+    Kept in sync with confirmed orders by signals of Order, rebuilt by the rebuildsales command"""
+
+    day = models.DateField()
+    sku = models.ForeignKey(StockKeepingUnit, on_delete=models.CASCADE, db_index=False)
+    city = models.CharField(max_length=50)
+    status = models.CharField(max_length=32, choices=Order.STATUS)
+    orders = models.IntegerField(default=0)
+    quantity = models.IntegerField(default=0)
+    revenue = models.FloatField(default=0)
+
+    objects = DailySalesQuerySet.as_manager()
+
+    class Meta:
+        verbose_name_plural = 'daily sales'
+        indexes = [
+            models.Index(fields=['sku', 'day'], name='dailysales_sku_day'),
+            models.Index(fields=['city', 'day'], name='dailysales_city_day'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'sku', 'city', 'status'], name='dailysales_key'),
+        ]
+
+    def __str__(self):
+        return f'{self.day} {self.city} {self.sku_id} [{self.status}]: {self.quantity}'
+
+
+class Broadcast(models.Model):
+    """Message sent to all buyers by the broadcast command.
+    Buyers are served in order of id, last_buyer_id is the checkpoint a stopped run resumes after"""
+
+    name = models.CharField(max_length=100, unique=True)
+    text = models.TextField()
+    last_buyer_id = models.BigIntegerField(default=0)
+    sent = models.IntegerField(default=0)
+    blocked = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+class Conversation(models.Model):
+    """State of a conversation of the bot, key is the json list of chat and user ids.
+    The bot keeps states in memory and writes them here behind its changes to resume after restarts"""
+
+    name = models.CharField(max_length=50)
+    key = models.CharField(max_length=100)
+    state = models.CharField(max_length=50)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['name', 'key'], name='conversation_name_key')]
+
+    def __str__(self):
+        return f'{self.name} {self.key}: {self.state}'
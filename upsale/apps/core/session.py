@@ -0,0 +1,174 @@
+"""
+In-process sessions of buyers.
+A session keeps the cart with its buyer and quantities of packs in it, so handlers render
+the cart from memory and the catalog instead of querying it on every update.
+Changes made through the session keep it actual, changes made elsewhere are found by the version
+of the cart: on the next write through the session or when the session expires.
+Until then a cart changed by another process, e.g. emptied by cleanup or edited in the admin,
+is shown as the session remembers it, for at most SESSION_CACHE_TTL seconds (300 by default).
+Sessions are the only reader of cart content, Cart keeps only the writes.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple
+from django.conf import settings
+from .catalog import catalog
+from .models import Buyer, Cart, Product, StockKeepingUnit
+
+
+class CartLine(NamedTuple):
+    """Pack in the cart with its quantity"""
+    sku: StockKeepingUnit
+    quantity: int
+
+
+class Session:
+    """Cart of a buyer with the summary of its content"""
+
+    def __init__(self, cart: Cart, quantities: Dict[int, int], expires: float):
+        self.cart = cart
+        self.quantities = quantities
+        self.expires = expires
+
+    @classmethod
+    def load(cls, user_id: int, expires: float) -> 'Session':
+        """Loads cart with the buyer and its content, raises Cart.DoesNotExist if there is no cart"""
+        cart = Cart.objects.select_related('buyer').get(buyer=user_id)
+        return cls(cart, dict(cart.cartitem_set.values_list('sku_id', 'quantity')), expires)
+
+    def reload(self):
+        """Replaces the summary with actual content of the cart"""
+        fresh = Session.load(self.cart.pk, self.expires)
+        self.cart, self.quantities = fresh.cart, fresh.quantities
+
+    def is_actual(self) -> bool:
+        """Returns True if the cart wasn't changed bypassing the session"""
+        version = Cart.objects.filter(pk=self.cart.pk).values_list('version', flat=True).first()
+        return version == self.cart.version
+
+    @property
+    def buyer(self) -> Buyer:
+        return self.cart.buyer
+
+    def contains(self, sku: StockKeepingUnit) -> bool:
+        """Returns True if cart already contains pack"""
+        return sku.id in self.quantities
+
+    def sku_ids(self) -> set:
+        """Returns ids of all packs in the cart"""
+        return set(self.quantities)
+
+    def is_empty(self) -> bool:
+        """Returns True if no item present in the cart"""
+        return not self.lines()
+
+    def lines(self) -> List[CartLine]:
+        """Returns packs of the cart ordered by product.
+        Packs removed from the catalog are forgotten, their cart items were deleted with them"""
+        lines, removed = [], []
+        for sku_id, quantity in self.quantities.items():
+            try:
+                lines.append(CartLine(catalog.sku(sku_id), quantity))
+            except StockKeepingUnit.DoesNotExist:
+                removed.append(sku_id)
+        for sku_id in removed:
+            self.quantities.pop(sku_id, None)
+        return sorted(lines, key=lambda line: (line.sku.product_id, line.sku.id))
+
+    def product_lines(self, product: Product) -> List[CartLine]:
+        """Returns packs of the product in the cart"""
+        return [line for line in self.lines() if line.sku.product_id == product.id]
+
+    def total_price(self):
+        """Returns the sum of prices of all packs in the cart"""
+        return sum(line.sku.price * line.quantity for line in self.lines())
+
+    def add_sku(self, sku: StockKeepingUnit):
+        """Adds one pack to the cart"""
+        if self.cart.add_sku(sku):
+            self.quantities[sku.id] = self.quantities.get(sku.id, 0) + 1
+        else:
+            self.reload()
+
+    def remove_sku(self, sku: StockKeepingUnit):
+        """Removes one pack from the cart"""
+        if self.cart.remove_sku(sku):
+            quantity = self.quantities.pop(sku.id, 0)
+            if quantity > 1:
+                self.quantities[sku.id] = quantity - 1
+        else:
+            self.reload()
+
+    def clear_sku(self, sku: StockKeepingUnit):
+        """Removes all packs of the kind from the cart"""
+        if self.cart.clear_sku(sku):
+            self.quantities.pop(sku.id, None)
+        else:
+            self.reload()
+
+    def clear(self):
+        """Removes everything from the cart"""
+        if self.cart.clear():
+            self.quantities = {}
+        else:
+            self.reload()
+
+    def checkout(self):
+        """Turns the cart into an order, see Cart.checkout"""
+        order = self.cart.checkout()
+        self.quantities = {}
+        return order
+
+    def remember_total_message(self, message_id: int):
+        """Saves id of the message with total price of the cart"""
+        self.cart.remember_total_message(message_id)
+
+
+class SessionCache:
+    """Bounded LRU cache of sessions by telegram user id.
+    Expired session is checked against the version of the cart and reloaded only if it was changed"""
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> Session:
+        """Returns session of the user, raises Cart.DoesNotExist if the user has no cart"""
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is not None:
+                self._sessions.move_to_end(user_id)
+        now = time.monotonic()
+        try:
+            if session is None:
+                session = Session.load(user_id, now + self.ttl)
+            elif now >= session.expires:
+                if not session.is_actual():
+                    session.reload()
+                session.expires = now + self.ttl
+        except Cart.DoesNotExist:
+            self.drop(user_id)
+            raise
+        with self._lock:
+            self._sessions[user_id] = session
+            self._sessions.move_to_end(user_id)
+            while len(self._sessions) > self.size:
+                self._sessions.popitem(last=False)
+        return session
+
+    def drop(self, user_id: int):
+        """Forgets session of the user"""
+        with self._lock:
+            self._sessions.pop(user_id, None)
+
+    def clear(self):
+        """Forgets all sessions"""
+        with self._lock:
+            self._sessions.clear()
+
+
+sessions = SessionCache(settings.SESSION_CACHE_SIZE, settings.SESSION_CACHE_TTL)
@@ -0,0 +1,121 @@
+"""
+Signal receivers of the core models
+"""
+
+import threading
+from contextlib import contextmanager
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.db.models import F
+from django.dispatch import receiver
+from .models import Buyer, Cart, DailySales, Order, Product, Pack, StockKeepingUnit
+from .catalog import catalog
+from .session import sessions
+
+_local = threading.local()
+
+
+@receiver(pre_save, sender=StockKeepingUnit)
+def remember_product(instance: StockKeepingUnit, **_):
+    """Keeps product the sku belonged to, it needs new summary if the sku is moved"""
+    instance.previous_product_id = None
+    if instance.pk:
+        instance.previous_product_id = StockKeepingUnit.objects.filter(pk=instance.pk) \
+            .values_list('product_id', flat=True).first()
+
+
+@receiver([post_save, post_delete], sender=StockKeepingUnit)
+def update_sku_summary(instance: StockKeepingUnit, **_):
+    """Recalculates min price and count of skus of the product"""
+    if getattr(_local, 'summary_deferred', False):
+        return
+    products = {instance.product_id, getattr(instance, 'previous_product_id', None)} - {None}
+    products -= deleted_products()
+    if products:
+        Product.objects.filter(pk__in=products).update_sku_summary()
+
+
+@receiver(pre_delete, sender=StockKeepingUnit)
+def bump_cart_versions(instance: StockKeepingUnit, **_):
+    """Marks carts with the sku as changed, their items are deleted with it"""
+    if getattr(_local, 'summary_deferred', False):
+        return
+    Cart.objects.filter(cartitem__sku=instance).update(version=F('version') + 1)
+
+
+@contextmanager
+def sku_summary_deferred():
+    """Turns off summary updates and bumps of cart versions by signals of skus in this thread,
+    bulk changes do both with one query per batch themselves"""
+    _local.summary_deferred = True
+    try:
+        yield
+    finally:
+        _local.summary_deferred = False
+
+
+def deleted_products() -> set:
+    """Returns ids of products that are being deleted in this thread"""
+    if not hasattr(_local, 'deleted_products'):
+        _local.deleted_products = set()
+    return _local.deleted_products
+
+
+@receiver(pre_delete, sender=Product)
+def start_product_deletion(instance: Product, **_):
+    """Skus are deleted before their product, it doesn't need their summary"""
+    deleted_products().add(instance.pk)
+
+
+@receiver(post_delete, sender=Product)
+def finish_product_deletion(instance: Product, **_):
+    deleted_products().discard(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Pack)
+@receiver([post_save, post_delete], sender=StockKeepingUnit)
+def invalidate_catalog(**_):
+    """Drops catalog snapshot when products, packs or stock keeping units change"""
+    catalog.invalidate()
+
+
+@receiver(pre_save, sender=Product)
+def drop_stale_photo(instance: Product, **_):
+    """Forgets telegram file id of the product photo when image url is changed"""
+    if instance.pk and instance.image_file_id:
+        image = Product.objects.filter(pk=instance.pk).values_list('image', flat=True).first()
+        if image != instance.image:
+            instance.image_file_id = None
+
+
+@receiver(post_delete, sender=Buyer)
+@receiver(post_delete, sender=Cart)
+def drop_session(instance, **_):
+    """Forgets session of the removed buyer or cart"""
+    sessions.drop(instance.pk)
+
+
+@receiver(pre_save, sender=Order)
+def remove_sales(instance: Order, **_):
+    """Takes the order out of daily sales before its status or address changes, add_sales puts it back"""
+    if not instance.pk:
+        instance.sales_changed = instance.city is not None and instance.branch_number is not None
+        return
+    previous = Order.objects.filter(pk=instance.pk).values_list('status', 'city', 'branch_number').first()
+    instance.sales_changed = previous != (instance.status, instance.city, instance.branch_number)
+    if previous and instance.sales_changed:
+        DailySales.objects.apply(DailySales.objects.summarize(Order.objects.filter(pk=instance.pk)), -1)
+
+
+@receiver(post_save, sender=Order)
+def add_sales(instance: Order, **_):
+    if getattr(instance, 'sales_changed', False):
+        DailySales.objects.apply(DailySales.objects.summarize(Order.objects.filter(pk=instance.pk)))
+
+
+@receiver(pre_delete, sender=Order)
+def delete_sales(instance: Order, **_):
+    """Takes the order out of daily sales, orders without address are not there"""
+    if instance.city is None or instance.branch_number is None:
+        return
+    DailySales.objects.apply(DailySales.objects.summarize(Order.objects.filter(pk=instance.pk)), -1)
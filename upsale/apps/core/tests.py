@@ -1,3 +1,661 @@
-from django.test import TestCase
+import csv
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.db.models import Q
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from .catalog import catalog
+from .models import Buyer, Cart, CartItem, DailySales, Order, OrderItem, Pack, Product, StockKeepingUnit
+from .session import SessionCache
 
-# Create your tests here.
+
+class CartTest(TestCase):
+    """Cart keeps one row per pack with quantity"""
+
+    def setUp(self):
+        catalog.invalidate()
+        buyer = Buyer.objects.create(id=1, full_name='Buyer')
+        self.cart = Cart.objects.create(buyer=buyer)
+        product = Product.objects.create(name='Arabica', description='', image='https://example.com/a.jpg')
+        self.small = StockKeepingUnit.objects.create(
+            product=product, pack=Pack.objects.create(unit='g', size=250), price=100)
+        self.big = StockKeepingUnit.objects.create(
+            product=product, pack=Pack.objects.create(unit='kg', size=1), price=350)
+
+    def saved(self):
+        """Returns a session loaded from what is stored in the database"""
+        return SessionCache(size=1, ttl=60).get(1)
+
+    def test_add_sku_increments_quantity(self):
+        for _ in range(50):
+            self.cart.add_sku(self.small)
+        self.cart.add_sku(self.big)
+        self.assertEqual([(line.sku, line.quantity) for line in self.saved().lines()],
+                         [(self.small, 50), (self.big, 1)])
+
+    def test_remove_sku_decrements_and_deletes(self):
+        self.cart.add_sku(self.small)
+        self.cart.add_sku(self.small)
+        self.cart.remove_sku(self.small)
+        self.assertEqual([line.quantity for line in self.saved().product_lines(self.small.product)], [1])
+        self.cart.remove_sku(self.small)
+        self.assertTrue(self.saved().is_empty())
+
+    def test_total_price_without_queries(self):
+        for _ in range(3):
+            self.cart.add_sku(self.small)
+        self.cart.add_sku(self.big)
+        session = self.saved()
+        catalog.products()
+        with self.assertNumQueries(0):
+            self.assertEqual(session.total_price(), 650)
+
+    def test_empty_cart_total(self):
+        self.assertEqual(self.saved().total_price(), 0)
+
+
+class CartScopeTest(TestCase):
+    """Cart operations touch only rows of their cart and are served by indexes"""
+
+    def setUp(self):
+        product = Product.objects.create(name='Arabica', description='', image='https://example.com/a.jpg')
+        self.sku = StockKeepingUnit.objects.create(
+            product=product, pack=Pack.objects.create(unit='g', size=250), price=100)
+        self.carts = [Cart.objects.create(buyer=Buyer.objects.create(id=number, full_name='Buyer'))
+                      for number in (1, 2)]
+        for cart in self.carts:
+            cart.add_sku(self.sku)
+
+    def test_clear_sku_keeps_other_carts(self):
+        self.carts[0].clear_sku(self.sku)
+        self.assertFalse(self.carts[0].cartitem_set.filter(sku=self.sku).exists())
+        self.assertTrue(self.carts[1].cartitem_set.filter(sku=self.sku).exists())
+
+    def test_one_row_per_pack(self):
+        CartItem.objects.filter(cart=self.carts[0]).update(quantity=0)
+        self.carts[0].remove_sku(self.sku)
+        self.carts[0].add_sku(self.sku)
+        self.assertEqual(CartItem.objects.filter(cart=self.carts[0]).count(), 1)
+
+    def test_lookups_use_indexes(self):
+        cart = self.carts[0]
+        self.assertIn('USING INDEX', cart.cartitem_set.filter(sku=self.sku).explain())
+        self.assertIn('orderitem_order_sku', OrderItem.objects.filter(order=1, sku=self.sku).explain())
+        incomplete = Order.objects.filter(
+            Q(buyer=1), Q(city__isnull=True) | Q(branch_number__isnull=True)).order_by('pk')[:1]
+        self.assertIn('order_missing_address', incomplete.explain())
+
+
+class CheckoutTest(TestCase):
+    """Checkout is one transaction with a constant number of queries and doesn't repeat"""
+
+    def setUp(self):
+        self.cart = Cart.objects.create(buyer=Buyer.objects.create(id=1, full_name='Buyer'))
+        pack = Pack.objects.create(unit='g', size=250)
+        self.skus = []
+        for number in range(30):
+            product = Product.objects.create(name=str(number), description='', image='https://example.com/a.jpg')
+            self.skus.append(StockKeepingUnit.objects.create(product=product, pack=pack, price=100 + number))
+
+    def fill(self, count):
+        for sku in self.skus[:count]:
+            self.cart.add_sku(sku)
+
+    def test_prices_are_kept(self):
+        self.fill(2)
+        self.cart.add_sku(self.skus[0])
+        order = self.cart.checkout()
+        StockKeepingUnit.objects.filter(pk=self.skus[0].pk).update(price=999)
+        self.assertEqual(sorted(order.orderitem_set.values_list('quantity', 'price')), [(1, 101), (2, 100)])
+        self.assertFalse(self.cart.cartitem_set.exists())
+
+    def test_constant_queries(self):
+        self.fill(3)
+        with self.assertNumQueries(8):
+            self.cart.checkout()
+        self.fill(30)
+        with self.assertNumQueries(8):
+            self.cart.checkout()
+
+    def test_repeated_checkout(self):
+        self.fill(2)
+        order = self.cart.checkout()
+        self.assertEqual(self.cart.checkout(), order)
+        self.fill(1)
+        self.assertNotEqual(self.cart.checkout(), order)
+        self.assertEqual(Order.objects.count(), 2)
+
+    def test_checkout_after_address(self):
+        self.fill(1)
+        order = self.cart.checkout()
+        order.city, order.branch_number = 'Kyiv', 1
+        order.save()
+        self.assertIsNone(self.cart.checkout())
+
+    def test_empty_cart(self):
+        self.assertIsNone(self.cart.checkout())
+        self.assertFalse(Order.objects.exists())
+
+    def test_concurrent_checkout(self):
+        self.fill(1)
+        version = Cart.objects.get(pk=1).version
+        older = Order.objects.create(buyer_id=1, cart_version=version - 1)
+        order = Order.objects.create(buyer_id=1, cart_version=version)
+        self.assertEqual(self.cart.checkout(), order)
+        order.city, order.branch_number = 'Kyiv', 1
+        order.save()
+        self.assertIsNone(self.cart.checkout())
+        self.assertEqual(Order.objects.without_address().get(), older)
+
+
+class AdminTest(TestCase):
+    """Changelists don't query per row and bulk status changes are one UPDATE"""
+
+    def setUp(self):
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+        self.pack = Pack.objects.create(unit='g', size=250)
+        self.product = Product.objects.create(name='Coffee', description='', image='https://example.com/a.jpg')
+
+    def fill(self, count):
+        for number in range(count):
+            buyer = Buyer.objects.create(full_name=f'Buyer {number}')
+            cart = Cart.objects.create(buyer=buyer)
+            cart.add_sku(StockKeepingUnit.objects.create(product=self.product, pack=self.pack, price=number))
+            cart.checkout()
+
+    def queries(self, url) -> int:
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(context)
+
+    def test_changelists(self):
+        self.fill(2)
+        urls = ['/admin/core/order/', '/admin/core/order/?status__exact=new', '/admin/core/cart/',
+                '/admin/core/stockkeepingunit/']
+        few = [self.queries(url) for url in urls]
+        self.fill(20)
+        self.assertEqual([self.queries(url) for url in urls], few)
+
+    def test_lines(self):
+        cart = Cart.objects.create(buyer=Buyer.objects.create(full_name='Buyer'))
+        ContentType.objects.get_for_models(Cart, Order)
+        queries = []
+        for count in (1, 20):
+            for number in range(count):
+                cart.add_sku(StockKeepingUnit.objects.create(product=self.product, pack=self.pack, price=number))
+            cart_queries = self.queries(f'/admin/core/cart/{cart.pk}/change/')
+            order = cart.checkout()
+            queries.append((cart_queries, self.queries(f'/admin/core/order/{order.pk}/change/')))
+        self.assertEqual(queries[0], queries[1])
+
+    def test_order_total(self):
+        self.fill(3)
+        self.assertContains(self.client.get('/admin/core/order/'), '<td class="field-total">2.0</td>')
+
+    def test_bulk_status(self):
+        self.fill(5)
+        with CaptureQueriesContext(connection) as context:
+            self.client.post('/admin/core/order/', {
+                'action': 'mark_done', 'select_across': '1', '_selected_action': [Order.objects.first().pk]})
+        self.assertEqual(set(Order.objects.values_list('status', flat=True)), {'done'})
+        updates = [query['sql'] for query in context if query['sql'].startswith('UPDATE "core_order"')]
+        self.assertEqual(len(updates), 1)
+
+
+class SalesTest(TestCase):
+    """Daily sales follow confirmed orders and match a rebuild"""
+
+    def setUp(self):
+        pack = Pack.objects.create(unit='g', size=250)
+        product = Product.objects.create(name='Coffee', description='', image='https://example.com/a.jpg')
+        self.skus = [StockKeepingUnit.objects.create(product=product, pack=pack, price=price)
+                     for price in (100, 150)]
+
+    def order(self, city='Kyiv', quantity=1):
+        cart = Cart.objects.create(buyer=Buyer.objects.create(full_name='Buyer'))
+        for sku in self.skus:
+            for _ in range(quantity):
+                cart.add_sku(sku)
+        order = cart.checkout()
+        order.city = city
+        order.save()
+        order.branch_number = 1
+        order.save()
+        return order
+
+    @staticmethod
+    def sales():
+        return sorted(DailySales.objects.filter(orders__gt=0).values_list(
+            'sku_id', 'city', 'status', 'orders', 'quantity', 'revenue'))
+
+    def test_confirmed_orders(self):
+        cart = Cart.objects.create(buyer=Buyer.objects.create(full_name='Buyer'))
+        cart.add_sku(self.skus[0])
+        self.assertEqual(cart.checkout().total, 100)
+        self.assertFalse(DailySales.objects.exists())
+        self.order(quantity=2)
+        self.order(quantity=1)
+        first, second = self.skus
+        self.assertEqual(self.sales(), [(first.pk, 'Kyiv', 'new', 2, 3, 300), (second.pk, 'Kyiv', 'new', 2, 3, 450)])
+
+    def test_status_changes(self):
+        order = self.order()
+        other = self.order(city='Lviv')
+        order.status = 'in_progress'
+        order.save()
+        Order.objects.filter(pk=other.pk).set_status('done')
+        self.assertEqual([row[1:3] for row in self.sales()],
+                         [('Kyiv', 'in_progress'), ('Lviv', 'done')] * 2)
+        order.delete()
+        self.assertEqual([row[1:3] for row in self.sales()], [('Lviv', 'done')] * 2)
+
+    def test_rebuild(self):
+        for city in ('Kyiv', 'Lviv', 'Kyiv'):
+            self.order(city)
+        Order.objects.filter(city='Lviv').set_status('done')
+        incremental = self.sales()
+        DailySales.objects.all().delete()
+        call_command('rebuildsales', stdout=StringIO())
+        self.assertEqual(self.sales(), incremental)
+
+
+class ExportTest(TestCase):
+    """Orders are streamed as csv and jsonl to staff only"""
+
+    def setUp(self):
+        pack = Pack.objects.create(unit='g', size=250)
+        product = Product.objects.create(name='Coffee', description='', image='https://example.com/a.jpg')
+        cart = Cart.objects.create(buyer=Buyer.objects.create(full_name='Buyer'))
+        for price in (100, 150):
+            cart.add_sku(StockKeepingUnit.objects.create(product=product, pack=pack, price=price))
+        self.order = cart.checkout()
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+    def test_csv(self):
+        response = self.client.get('/export/orders.csv')
+        self.assertTrue(response.streaming)
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0][:3], ['order', 'created', 'status'])
+        self.assertEqual([row[-3:] for row in rows[1:]], [['250 g', '1', '100.0'], ['250 g', '1', '150.0']])
+
+    def test_jsonl(self):
+        response = self.client.get('/export/orders.jsonl', {'status': 'new'})
+        orders = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([(order['order'], order['total'], len(order['lines'])) for order in orders],
+                         [(self.order.pk, 250, 2)])
+        response = self.client.get('/export/orders.jsonl', {'status': 'done'})
+        self.assertEqual(b''.join(response.streaming_content), b'')
+
+    def test_staff_only(self):
+        self.client.logout()
+        self.assertEqual(self.client.get('/export/orders.csv').status_code, 302)
+
+    def test_invalid_dates(self):
+        for since in ('2024-02-30', 'yesterday'):
+            self.assertEqual(self.client.get('/export/orders.csv', {'since': since}).status_code, 400)
+        response = self.client.get('/export/orders.jsonl', {'since': '2024-02-29', 'until': '2000-01-01'})
+        self.assertEqual(b''.join(response.streaming_content), b'')
+
+
+class SessionTest(TestCase):
+    """Sessions serve cart from memory and notice changes made bypassing them"""
+
+    def setUp(self):
+        catalog.invalidate()
+        self.sessions = SessionCache(size=2, ttl=60)
+        product = Product.objects.create(name='Arabica', description='', image='https://example.com/a.jpg')
+        pack = Pack.objects.create(unit='g', size=250)
+        self.skus = [StockKeepingUnit.objects.create(product=product, pack=pack, price=price)
+                     for price in (100, 150)]
+        for number in (1, 2, 3):
+            Cart.objects.create(buyer=Buyer.objects.create(id=number, full_name='Buyer'))
+
+    def test_reads_are_served_from_memory(self):
+        session = self.sessions.get(1)
+        session.add_sku(self.skus[0])
+        session.add_sku(self.skus[0])
+        session.add_sku(self.skus[1])
+        catalog.products()
+        with self.assertNumQueries(0):
+            session = self.sessions.get(1)
+            self.assertEqual(session.total_price(), 350)
+            self.assertEqual([line.quantity for line in session.lines()], [2, 1])
+            self.assertEqual(session.buyer.id, 1)
+
+    def test_write_notices_other_worker(self):
+        session = self.sessions.get(1)
+        session.add_sku(self.skus[0])
+        Cart.objects.get(pk=1).add_sku(self.skus[1])
+        session.add_sku(self.skus[0])
+        self.assertEqual(session.quantities, {self.skus[0].id: 2, self.skus[1].id: 1})
+
+    def test_deleted_sku(self):
+        session = self.sessions.get(1)
+        session.add_sku(self.skus[0])
+        version = Cart.objects.get(pk=1).version
+        self.skus[0].delete()
+        self.assertEqual(Cart.objects.get(pk=1).version, version + 1)
+        self.assertFalse(session.is_actual())
+        self.assertTrue(session.is_empty())
+        self.assertEqual(session.quantities, {})
+
+    def test_expired_session_checks_version(self):
+        session = self.sessions.get(1)
+        session.expires = 0
+        with self.assertNumQueries(1):
+            self.assertIs(self.sessions.get(1), session)
+        Cart.objects.get(pk=1).add_sku(self.skus[0])
+        session.expires = 0
+        self.assertEqual(self.sessions.get(1).quantities, {self.skus[0].id: 1})
+
+    def test_least_recently_used_is_evicted(self):
+        first = self.sessions.get(1)
+        self.sessions.get(2)
+        self.sessions.get(1)
+        self.sessions.get(3)
+        self.assertIs(self.sessions.get(1), first)
+        with self.assertNumQueries(2):
+            self.sessions.get(2)
+
+    def test_missing_cart(self):
+        with self.assertRaises(Cart.DoesNotExist):
+            self.sessions.get(404)
+
+
+class CatalogTest(TestCase):
+    """Catalog is served from memory and reloaded on changes"""
+
+    def setUp(self):
+        catalog.invalidate()
+        pack = Pack.objects.create(unit='g', size=250)
+        for name in ('Arabica', 'Robusta', 'Liberica'):
+            product = Product.objects.create(name=name, description='', image='https://example.com/a.jpg')
+            StockKeepingUnit.objects.create(product=product, pack=pack, price=200)
+            StockKeepingUnit.objects.create(product=product, pack=pack, price=150)
+
+    def test_catalog_screen_queries(self):
+        with self.assertNumQueries(2):
+            captions = [product.short_caption() for product in catalog.products()]
+            skus = [f'{sku.pack} {sku.product}' for product in catalog.products()
+                    for sku in product.stockkeepingunit_set.all()]
+        self.assertEqual(captions[0], '☕️ Arabica\n💵 Цена: 150.0')
+        self.assertEqual(len(skus), 6)
+
+    def test_snapshot_is_dropped_on_save(self):
+        product = catalog.products()[0]
+        Product.objects.filter(pk=product.pk).update(name='Cached')
+        self.assertEqual(catalog.product(product.pk).name, 'Arabica')
+        product.name = 'Kenya'
+        product.save()
+        self.assertEqual(catalog.product(product.pk).name, 'Kenya')
+
+    def test_missing_product(self):
+        with self.assertRaises(Product.DoesNotExist):
+            catalog.product(0)
+
+    def test_product_without_skus(self):
+        product = Product.objects.create(name='Kenya', description='', image='https://example.com/k.jpg')
+        self.assertNotIn(product, catalog.products())
+        self.assertEqual(catalog.product(product.pk).short_caption(), '☕️ Kenya\n💵 Цена: нет в наличии')
+
+    def test_missing_ids_reload_old_snapshot_only(self):
+        catalog.products()
+        with mock.patch.object(catalog, 'miss_reload_age', 60), self.assertNumQueries(0):
+            for _ in range(10):
+                with self.assertRaises(StockKeepingUnit.DoesNotExist):
+                    catalog.sku(0)
+        with mock.patch.object(catalog, 'miss_reload_age', 0), self.assertNumQueries(2):
+            with self.assertRaises(StockKeepingUnit.DoesNotExist):
+                catalog.sku(0)
+
+
+class ProductSummaryTest(TestCase):
+    """Min price and count of skus are stored on the product and kept in sync"""
+
+    def setUp(self):
+        self.pack = Pack.objects.create(unit='g', size=250)
+        self.product = Product.objects.create(name='Arabica', description='', image='https://example.com/a.jpg')
+        self.cheap = StockKeepingUnit.objects.create(product=self.product, pack=self.pack, price=150)
+        StockKeepingUnit.objects.create(product=self.product, pack=self.pack, price=200)
+
+    def summary(self, product=None):
+        return Product.objects.values_list('min_price', 'sku_count').get(pk=(product or self.product).pk)
+
+    def test_caption_without_queries(self):
+        product = Product.objects.get()
+        with self.assertNumQueries(0):
+            self.assertEqual(product.short_caption(), '☕️ Arabica\n💵 Цена: 150.0')
+
+    def test_sku_changes(self):
+        self.cheap.price = 250
+        self.cheap.save()
+        self.assertEqual(self.summary(), (200, 2))
+        self.cheap.delete()
+        self.assertEqual(self.summary(), (200, 1))
+
+    def test_sku_is_moved(self):
+        other = Product.objects.create(name='Robusta', description='', image='https://example.com/r.jpg')
+        self.cheap.product = other
+        self.cheap.save()
+        self.assertEqual(self.summary(), (200, 1))
+        self.assertEqual(self.summary(other), (150, 1))
+
+    def test_bulk_update(self):
+        StockKeepingUnit.objects.filter(product=self.product).update(price=99)
+        empty = Product.objects.create(name='Empty', description='', image='https://example.com/e.jpg')
+        with self.assertNumQueries(1):
+            Product.objects.update_sku_summary()
+        self.assertEqual(self.summary(), (99, 2))
+        self.assertEqual(self.summary(empty), (None, 0))
+        annotated = Product.objects.with_sku_summary().get(pk=self.product.pk)
+        self.assertEqual((annotated.actual_min_price, annotated.actual_sku_count), (99, 2))
+
+    def test_product_is_deleted_with_skus(self):
+        # Versions of carts with the skus are bumped with an UPDATE per sku
+        with self.assertNumQueries(8):
+            self.product.delete()
+        self.assertFalse(StockKeepingUnit.objects.exists())
+
+
+class ImportCatalogTest(TestCase):
+    """Feed is diffed against the catalog and only changes are written"""
+
+    FEED = [
+        ('Arabica', 'Sweet', 'https://example.com/a.jpg', 'g', 250, 100),
+        ('Arabica', 'Sweet', 'https://example.com/a.jpg', 'g', 1000, 350),
+        ('Robusta', 'Bitter', 'https://example.com/r.jpg', 'g', 250, 80),
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def feed(self, rows, kind='csv') -> str:
+        path = os.path.join(self.directory.name, f'feed.{kind}')
+        columns = ('name', 'description', 'image', 'unit', 'size', 'price')
+        with open(path, 'w', newline='', encoding='utf-8') as feed:
+            if kind == 'csv':
+                writer = csv.writer(feed)
+                writer.writerow(columns)
+                writer.writerows(rows)
+            elif kind == 'json':
+                json.dump([dict(zip(columns, row)) for row in rows], feed)
+            else:
+                feed.writelines(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+        return path
+
+    def run_import(self, rows, *args, kind='csv') -> str:
+        out = StringIO()
+        call_command('importcatalog', self.feed(rows, kind), *args, stdout=out)
+        return out.getvalue()
+
+    @staticmethod
+    def catalog_rows():
+        return sorted(StockKeepingUnit.objects.values_list('product__name', 'pack__size', 'price'))
+
+    def test_import(self):
+        self.run_import(self.FEED)
+        self.assertEqual(self.catalog_rows(), [('Arabica', 250, 100), ('Arabica', 1000, 350), ('Robusta', 250, 80)])
+        self.assertEqual(Pack.objects.count(), 2)
+        self.assertEqual(sorted(Product.objects.values_list('name', 'min_price', 'sku_count')),
+                         [('Arabica', 100, 2), ('Robusta', 80, 1)])
+        self.assertEqual(len(catalog.products()), 2)
+
+    def test_update(self):
+        self.run_import(self.FEED)
+        Product.objects.filter(name='Robusta').update(image_file_id='file')
+        rows = [self.FEED[0], self.FEED[1][:5] + (300,), self.FEED[2][:2] + ('https://example.com/new.jpg', 'g', 250, 80)]
+        report = self.run_import(rows, kind='jsonl')
+        self.assertIn('prices                   1', report)
+        self.assertIn('changed products         1', report)
+        self.assertEqual(self.catalog_rows(), [('Arabica', 250, 100), ('Arabica', 1000, 300), ('Robusta', 250, 80)])
+        self.assertIsNone(Product.objects.get(name='Robusta').image_file_id)
+
+    def test_json_feed(self):
+        self.run_import(self.FEED, kind='json')
+        self.assertEqual(len(self.catalog_rows()), 3)
+        with open(self.feed([], 'json'), 'w', encoding='utf-8') as feed:
+            json.dump({'rows': []}, feed)
+        with self.assertRaisesMessage(CommandError, 'must be an array'):
+            call_command('importcatalog', feed.name, stdout=StringIO())
+
+    def test_unchanged_feed(self):
+        self.run_import(self.FEED)
+        with self.assertNumQueries(3):
+            report = self.run_import(self.FEED)
+        self.assertNotIn(' 1', report)
+
+    def test_dry_run_and_prune(self):
+        self.run_import(self.FEED)
+        self.run_import(self.FEED[:1], '--prune', '--dry-run')
+        self.assertEqual(len(self.catalog_rows()), 3)
+        self.run_import(self.FEED[:1], '--prune')
+        self.assertEqual(self.catalog_rows(), [('Arabica', 250, 100)])
+        self.assertEqual(Product.objects.get().sku_count, 1)
+
+    def test_prune_keeps_ordered_skus(self):
+        self.run_import(self.FEED)
+        robusta = StockKeepingUnit.objects.get(product__name='Robusta')
+        order = Order.objects.create(buyer=Buyer.objects.create(id=1, full_name='Buyer'), total=80)
+        OrderItem.objects.create(order=order, sku=robusta, price=80)
+        report = self.run_import(self.FEED[:1], '--prune')
+        self.assertIn('kept skus                1', report)
+        self.assertIn('kept products            1', report)
+        self.assertEqual(self.catalog_rows(), [('Arabica', 250, 100), ('Robusta', 250, 80)])
+        self.assertEqual(order.orderitem_set.get().sku, robusta)
+
+    def test_invalid_row(self):
+        with self.assertRaisesMessage(CommandError, 'Row 2 is invalid'):
+            self.run_import([self.FEED[0], self.FEED[1][:5] + ('free',)])
+        self.assertFalse(Product.objects.exists())
+
+
+class ProductPhotoTest(TestCase):
+    """Telegram file id is reused until the image url changes"""
+
+    def setUp(self):
+        self.product = Product.objects.create(name='Arabica', description='', image='https://example.com/a.jpg')
+
+    def test_photo_prefers_file_id(self):
+        self.assertEqual(self.product.photo(), 'https://example.com/a.jpg')
+        self.product.remember_photo('file-1')
+        self.assertEqual(Product.objects.get().photo(), 'file-1')
+
+    def test_file_id_is_dropped_when_image_changes(self):
+        self.product.remember_photo('file-1')
+        self.product.description = 'Updated'
+        self.product.save()
+        self.assertEqual(Product.objects.get().image_file_id, 'file-1')
+        self.product.image = 'https://example.com/b.jpg'
+        self.product.save()
+        self.assertIsNone(Product.objects.get().image_file_id)
+
+    def test_file_id_of_replaced_image_is_not_saved(self):
+        stale = Product.objects.get()
+        self.product.image = 'https://example.com/b.jpg'
+        self.product.save()
+        stale.remember_photo('file-1')
+        self.assertIsNone(Product.objects.get().image_file_id)
+
+
+class StorageTest(TestCase):
+    """SQLite connections are tuned for concurrent writers"""
+
+    def test_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+
+class StressTest(SimpleTestCase):
+    """Bot and admin writers don't get "database is locked" on a shared database file"""
+
+    def test_concurrent_writers(self):
+        result = subprocess.run(
+            [sys.executable, 'manage.py', 'stressdb', '--seconds', '1', '--bot-writers', '4'],
+            cwd=settings.BASE_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, timeout=120)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn('No operation failed', result.stdout)
+
+
+class CleanupTest(TestCase):
+    """Stale carts are emptied and abandoned orders deleted, recent ones are kept"""
+
+    def setUp(self):
+        product = Product.objects.create(name='Arabica', description='', image='https://example.com/a.jpg')
+        pack = Pack.objects.create(unit='g', size=250)
+        self.skus = [StockKeepingUnit.objects.create(product=product, pack=pack, price=100 + number)
+                     for number in range(3)]
+        self.carts = [Cart.objects.create(buyer=Buyer.objects.create(id=number, full_name='Buyer'))
+                      for number in (1, 2)]
+        for cart in self.carts:
+            for sku in self.skus:
+                cart.add_sku(sku)
+        Cart.objects.filter(pk=1).update(updated=timezone.now() - timedelta(days=31))
+
+    def order(self, buyer_id: int, days: int, **address) -> Order:
+        order = Order.objects.create(buyer_id=buyer_id, **address)
+        OrderItem.objects.create(order=order, sku=self.skus[0], price=100)
+        Order.objects.filter(pk=order.pk).update(created=timezone.localdate() - timedelta(days=days))
+        return order
+
+    def run_cleanup(self, *args) -> str:
+        out = StringIO()
+        call_command('cleanup', '--batch-size', '2', '--pause', '0', *args, stdout=out)
+        return out.getvalue()
+
+    def test_cleanup(self):
+        abandoned = self.order(1, 8, city='Kyiv')
+        recent = self.order(1, 2)
+        confirmed = self.order(2, 30, city='Kyiv', branch_number=1)
+        report = self.run_cleanup()
+        self.assertRegex(report, r'cart items +3\n')
+        self.assertRegex(report, r'orders +1\n')
+        self.assertRegex(report, r'order lines +1\n')
+        self.assertFalse(self.carts[0].cartitem_set.exists())
+        self.assertEqual(self.carts[1].cartitem_set.count(), 3)
+        self.assertEqual(Cart.objects.get(pk=1).version, self.carts[0].version + 1)
+        self.assertEqual(set(Order.objects.values_list('pk', flat=True)), {recent.pk, confirmed.pk})
+        self.assertFalse(OrderItem.objects.filter(order=abandoned.pk).exists())
+
+    def test_dry_run(self):
+        self.order(1, 8)
+        report = self.run_cleanup('--dry-run')
+        self.assertRegex(report, r'cart items +3\n')
+        self.assertRegex(report, r'orders +1\n')
+        self.assertEqual(CartItem.objects.count(), 6)
+        self.assertEqual(Order.objects.count(), 1)
@@ -1,3 +1,91 @@
-from django.shortcuts import render
+"""
+Export of orders for analysis outside of the admin.
+Lines are read from the database in chunks and written to the response as they come,
+so memory doesn't depend on the number of exported orders.
+"""
 
-# Create your views here.
+import csv
+import json
+from itertools import groupby
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, HttpResponseBadRequest, StreamingHttpResponse
+from django.utils.dateparse import parse_date
+from .models import OrderItem
+
+CHUNK_SIZE = 2000
+ORDER_COLUMNS = ('order', 'created', 'status', 'buyer', 'phone_number', 'city', 'branch_number', 'total')
+LINE_COLUMNS = ('sku', 'product', 'pack', 'quantity', 'price')
+FIELDS = ('order_id', 'order__created', 'order__status', 'order__buyer__full_name',
+          'order__buyer__phone_number', 'order__city', 'order__branch_number', 'order__total',
+          'sku_id', 'sku__product__name', 'sku__pack__size', 'sku__pack__unit', 'quantity', 'price')
+
+
+class Echo:
+    """Buffer that returns what is written to it, so csv.writer yields lines for streaming"""
+
+    @staticmethod
+    def write(value):
+        return value
+
+
+def order_filters(params) -> dict:
+    """Returns lookups of lines by since, until (YYYY-MM-DD) and status from params.
+    Raises ValueError if a date is malformed or doesn't exist"""
+    filters = {}
+    for param, lookup in (('since', 'order__created__gte'), ('until', 'order__created__lte')):
+        if params.get(param):
+            date = parse_date(params[param])
+            if date is None:
+                raise ValueError(f'{param} must be a date in format YYYY-MM-DD')
+            filters[lookup] = date
+    if params.get('status'):
+        filters['order__status'] = params['status']
+    return filters
+
+
+def order_lines(filters: dict):
+    """Yields lines of orders matching the filters with their orders as dicts, ordered by order"""
+    lines = OrderItem.objects.filter(**filters).order_by('order_id', 'id')
+    for row in lines.values_list(*FIELDS).iterator(chunk_size=CHUNK_SIZE):
+        *order, sku_id, product, size, unit, quantity, price = row
+        yield dict(zip(ORDER_COLUMNS, order),
+                   sku=sku_id, product=product, pack=f'{size} {unit}', quantity=quantity, price=price)
+
+
+def csv_rows(lines):
+    """Yields header and a row per line of order"""
+    writer = csv.writer(Echo())
+    columns = ORDER_COLUMNS + LINE_COLUMNS
+    yield writer.writerow(columns)
+    for line in lines:
+        yield writer.writerow([line[column] for column in columns])
+
+
+def jsonl_rows(lines):
+    """Yields an order with its lines per row"""
+    for _, group in groupby(lines, key=lambda line: line['order']):
+        group = list(group)
+        order = {column: group[0][column] for column in ORDER_COLUMNS}
+        order['lines'] = [{column: line[column] for column in LINE_COLUMNS} for line in group]
+        yield json.dumps(order, ensure_ascii=False, default=str) + '\n'
+
+
+EXPORTS = {
+    'csv': (csv_rows, 'text/csv; charset=utf-8'),
+    'jsonl': (jsonl_rows, 'application/x-ndjson; charset=utf-8'),
+}
+
+
+@staff_member_required
+def export_orders(request, kind: str):
+    """Streams orders with their lines as csv, a row per line, or jsonl, a row per order"""
+    if kind not in EXPORTS:
+        raise Http404(f'Unknown export format {kind}')
+    try:
+        filters = order_filters(request.GET)
+    except ValueError as error:
+        return HttpResponseBadRequest(f'Invalid filter: {error}')
+    rows, content_type = EXPORTS[kind]
+    response = StreamingHttpResponse(rows(order_lines(filters)), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="orders.{kind}"'
+    return response
@@ -0,0 +1,38 @@
+"""
+SQLite backend for several processes writing to one database file.
+Besides options of sqlite3.connect, e.g. timeout, OPTIONS may contain:
+    journal_mode, synchronous - pragmas applied to every new connection;
+    transaction_mode - DEFERRED, IMMEDIATE or EXCLUSIVE, how atomic blocks begin.
+With IMMEDIATE a transaction takes the write lock at once and waits for the busy timeout,
+instead of failing with "database is locked" when its first read is upgraded to a write.
+"""
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+PRAGMAS = ('journal_mode', 'synchronous')
+TRANSACTION_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """Applies pragmas and transaction mode from OPTIONS"""
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        for option in (*PRAGMAS, 'transaction_mode'):
+            params.pop(option, None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for pragma in PRAGMAS:
+            value = self.settings_dict['OPTIONS'].get(pragma)
+            if value:
+                conn.execute(f'PRAGMA {pragma} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        mode = (self.settings_dict['OPTIONS'].get('transaction_mode') or 'DEFERRED').upper()
+        if mode not in TRANSACTION_MODES:
+            raise ImproperlyConfigured(f'Unknown SQLite transaction mode {mode}')
+        self.cursor().execute(f'BEGIN {mode}')
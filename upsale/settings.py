@@ -75,20 +75,82 @@ WSGI_APPLICATION = 'upsale.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db', 'db.sqlite3'),
+# Storage profile is chosen by DB_ENGINE: sqlite (default) or postgres.
+# Connections are kept open for DB_CONN_MAX_AGE seconds in every thread.
+# Set DB_PGBOUNCER=1 when postgres is reached through pgbouncer in transaction pooling mode.
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite')
+DB_CONN_MAX_AGE = int(os.getenv('DB_CONN_MAX_AGE', '600'))
+
+if DB_ENGINE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('DB_NAME', 'upsale'),
+            'USER': os.getenv('DB_USER', 'upsale'),
+            'PASSWORD': os.getenv('DB_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', 'localhost'),
+            'PORT': os.getenv('DB_PORT', '5432'),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'DISABLE_SERVER_SIDE_CURSORS': os.getenv('DB_PGBOUNCER') == '1',
+        }
+    }
+else:
+    # The bot, the admin and migrations share one file, so writers wait for each other
+    # up to the busy timeout and readers don't block writers in WAL mode.
+    DATABASES = {
+        'default': {
+            'ENGINE': 'upsale.backends.sqlite3',
+            'NAME': os.getenv('DB_NAME', os.path.join(BASE_DIR, 'db', 'db.sqlite3')),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'OPTIONS': {
+                'timeout': float(os.getenv('SQLITE_BUSY_TIMEOUT', '20')),
+                'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'wal'),
+                'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'normal'),
+                'transaction_mode': os.getenv('SQLITE_TRANSACTION_MODE', 'immediate'),
+            },
+        }
     }
-}
 
 # Telegram bot settings
 BOTS = {
     'client':{
-        'API_TOKEN': os.getenv('BOT_API_TOKEN')
+        'API_TOKEN': os.getenv('BOT_API_TOKEN'),
+        'API_URL': os.getenv('BOT_API_URL'),
+        'WEBHOOK_URL': os.getenv('BOT_WEBHOOK_URL'),
+        'WEBHOOK_SECRET': os.getenv('BOT_WEBHOOK_SECRET'),
+        'CALLBACK_SECRET': os.getenv('BOT_CALLBACK_SECRET'),
+        # Threads handling updates of different chats and updates waiting for them
+        'UPDATE_WORKERS': int(os.getenv('BOT_UPDATE_WORKERS', '8')),
+        'UPDATE_QUEUE_SIZE': int(os.getenv('BOT_UPDATE_QUEUE_SIZE', '1000')),
+        # Worker processes updates are partitioned to by chat id, 1 handles them in the receiving one
+        'PROCESSES': int(os.getenv('BOT_PROCESSES', '1')),
+        # Seconds between writes of conversation states kept in memory to the database
+        'STATE_WRITE_INTERVAL': float(os.getenv('BOT_STATE_WRITE_INTERVAL', '1')),
+        'RATE_LIMITS': {
+            'GLOBAL_RATE': float(os.getenv('BOT_GLOBAL_RATE', '30')),
+            'CHAT_RATE': float(os.getenv('BOT_CHAT_RATE', '1')),
+            'CHAT_BURST': float(os.getenv('BOT_CHAT_BURST', '20')),
+            'WORKERS': int(os.getenv('BOT_SEND_WORKERS', '8')),
+            # Seconds edits of cart messages wait to be merged with following taps
+            'EDIT_DEBOUNCE': float(os.getenv('BOT_EDIT_DEBOUNCE', '0.3')),
+            # Messages per second of GLOBAL_RATE kept for replies of the running bot,
+            # the broadcast command, sending from another process, is limited to the rest
+            'INTERACTIVE_RESERVE': float(os.getenv('BOT_INTERACTIVE_RESERVE', '10')),
+            # Messages per second of the broadcast command, at most GLOBAL_RATE - INTERACTIVE_RESERVE
+            'BROADCAST_RATE': float(os.getenv('BOT_BROADCAST_RATE', '20'))
+        }
     }
 }
 
+# Seconds the in-process catalog snapshot is served before it's reloaded
+CATALOG_CACHE_TTL = float(os.getenv('CATALOG_CACHE_TTL', '60'))
+# Minimal age of the snapshot that is reloaded when a product or sku is missing in it
+CATALOG_MISS_RELOAD_AGE = float(os.getenv('CATALOG_MISS_RELOAD_AGE', '5'))
+
+# Sessions of buyers kept in memory of the bot and seconds before their cart version is checked
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL = float(os.getenv('SESSION_CACHE_TTL', '300'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -15,7 +15,9 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from upsale.apps.core.views import export_orders
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('export/orders.<str:kind>', export_orders, name='export_orders'),
 ]